@@ -25,10 +25,14 @@ class JSTest(TemplateView):
             self.form = AddForm(request.GET)
 
             if self.form.is_valid():    
-                js_code = js_funcs + 'var result = add(%s, %s)' % \
+                js_code = 'var result = add(%s, %s)' % \
                         (self.form.cleaned_data.get('a'),
                                 self.form.cleaned_data.get('b'))
                 self.js_context = interpr.PyJS()
+                # the shared functions are the same on every request, they
+                # are parsed once by the parse cache (or loaded from their 
+                # .jsc file, python -m lib.pyjon.jsparser writes it)
+                self.js_context.eval_(js_funcs, 'core/shared-functions.js')
                 self.js_context.eval_(js_code)
 
         else:
@@ -1,3 +1,3 @@
 
-__all__ = ["defs", "lexer", "jsparser", "interpr"]
+__all__ = ["defs", "lexer", "jsparser", "interpr", "resolver", "jscompiler", "bytecode", "optimizer"]
 
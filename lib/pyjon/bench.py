@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+#
+# Benchmarks for PyJS.
+#
+# Usage:
+#
+#   PYTHONPATH=lib python -m pyjon.bench [benchmark ...]
+#
+# Runs all benchmarks if none is given.
+#
+
+import cPickle, gc, re, StringIO, sys, time
+
+import bytecode, interpr, jsparser, lexer, optimizer, resolver
+
+# benchmarks by name, filled in by @benchmark
+benchmarks = []
+
+def benchmark(f):
+    benchmarks.append(f)
+    return f
+
+# processor time, less disturbed by other processes than wall time
+timer = sys.platform == "win32" and time.time or time.clock
+
+def timeit(f, repeat=3):
+    """ best time of several runs of f() in seconds
+    """
+    best = None
+    for i in range(repeat):
+        # as timeit module does, collection pauses are not measured
+        gc.collect()
+        gc.disable()
+        try:
+            start = timer()
+            f()
+            t = timer() - start
+        finally:
+            gc.enable()
+        if best is None or t < best: best = t
+    return best
+
+def report(name, t, unit="s"):
+    print "  %-40s %10.4f %s" % (name, t, unit)
+
+fib = """
+function fib(n) { if (n < 2) return n; return fib(n-1) + fib(n-2) }
+var r = fib(16);
+"""
+
+loop = """
+var s = 0;
+for (var i = 0; i < 20000; i++) { s = s + i % 7 }
+"""
+
+@benchmark
+def engines():
+    """ tree walker against closure compiler and bytecode VM """
+    for engine in ("tree", "closure", "vm"):
+        for name, source in (("fib", fib), ("loop", loop)):
+            def run():
+                interpr.PyJS(engine=engine).eval_(source)
+            report("%s %s" % (engine, name), timeit(run))
+
+calling = """
+function ret(x) { return x }
+function noret(x) { x }
+function nested(x) { while (true) { if (x) { return x } } }
+var i = 0;
+for (i = 0; i < %(n)d; i++) { %(call)s }
+"""
+
+@benchmark
+def calls():
+    """ per-call overhead of small functions """
+    n = 10000
+    for engine in ("tree", "closure", "vm"):
+        def run(call):
+            source = calling % dict(n=n, call=call)
+            return timeit(lambda: interpr.PyJS(engine=engine).eval_(source), 5)
+        empty = run("")
+        for call in ("ret(i)", "noret(i)", "nested(1)"):
+            t = (run(call) - empty) / n
+            report("%s %s" % (engine, call), t * 1e6, "us/call")
+
+allocating = """
+var fs = [];
+for (var i = 0; i < 5000; i++) { fs.push(function() { return i }); (i).toString() }
+"""
+
+@benchmark
+def allocations():
+    """ closures created in a loop and methods of numbers """
+    for engine in ("tree", "closure"):
+        def run():
+            interpr.PyJS(engine=engine).eval_(allocating)
+        report("%s closures" % engine, timeit(run))
+
+strings = """
+var s = "";
+for (var i = 0; i < 200; i++) { s = s + "x" }
+var n = 0;
+for (var j = 0; j < 20; j++) {
+    for (var i = 0; i < s.length; i++) { n = n + s.substr(i, 1).length }
+}
+"""
+
+@benchmark
+def primitives():
+    """ properties and methods of primitive strings """
+    for engine in ("tree", "closure"):
+        def run():
+            interpr.PyJS(engine=engine).eval_(strings)
+        report("%s strings" % engine, timeit(run))
+
+objects = """
+function P(x) { this.x = x }
+P.prototype.get = function() { return this.x };
+var p = new P(1), a = [], s = 0;
+for (var i = 0; i < 3000; i++) { p.x = i; s = s + p.get() + p.x; a.push(i) }
+"""
+
+@benchmark
+def properties():
+    """ reads and writes of object properties, inline cache hit rate """
+    for engine in ("tree", "closure"):
+        def run():
+            js = interpr.PyJS(engine=engine)
+            js.eval_(objects)
+        report("%s objects" % engine, timeit(run))
+    tree = jsparser.parse(objects)
+    interpr.PyJS(engine="closure").execute(tree)
+    stats = interpr.inlineCacheStats(tree)
+    total = stats["hits"] + stats["misses"]
+    report("hit rate of %i caches" % stats["caches"], 
+            100.0 * stats["hits"] / (total or 1), "%")
+
+@benchmark
+def loading():
+    """ parsing source against loading serialized bytecode and trees """
+    # sources of the other benchmarks make a script of some size
+    source = "\n".join([fib, loop, objects, strings, allocating] * 5)
+    def parse():
+        bytecode.compile(resolver.resolve(jsparser.parse(source)))
+    data = bytecode.dumps(bytecode.compile(
+                resolver.resolve(jsparser.parse(source))))
+    tree = jsparser.dumps(jsparser.parse(source))
+    report("parse", timeit(lambda: jsparser.parse(source)))
+    report("parse and compile", timeit(parse))
+    report("load tree", timeit(lambda: jsparser.loads(tree)))
+    report("load bytecode", timeit(lambda: bytecode.loads(data)))
+    report("source size", len(source), "bytes")
+    report("tree size", len(tree), "bytes")
+    report("bytecode size", len(data), "bytes")
+
+counting = """
+var n = 0, x = 0.5;
+for (var i = 0; i < 20000; i++) {
+    if (i % 3 == 0) n = n + 1;
+    if (i >= 100 && i < 200) x = x * 1.5 - 0.25;
+}
+"""
+
+@benchmark
+def numbers():
+    """ arithmetic and comparison of ints and floats, type feedback """
+    for engine in ("tree", "closure", "vm"):
+        def run():
+            interpr.PyJS(engine=engine).eval_(counting)
+        report("%s counting" % engine, timeit(run))
+    tree = jsparser.parse(counting)
+    interpr.PyJS(engine="closure").execute(tree)
+    stats = interpr.typeFeedbackStats(tree)
+    for kind in ("int", "float", "generic"):
+        report("%s operators" % kind, stats[kind], "nodes")
+
+# toNumber() of strings before StringToNumber, for comparison
+intRe = re.compile(r'^(-|\+)?\d+$')
+floatRe = re.compile(r'^(-|\+)?(\d+)?\.(\d+)$')
+shortFloatRe = re.compile(r'^(-|\+)?(\d+)\.(\d+)e\+(\d+)$')
+hexRe = re.compile(r'^(-|\+)?0x([0-9a-fA-F]+)$')
+
+def regexCascade(y):
+    if y == "": return 0
+    elif re.match(intRe, y): return int(y)
+    elif re.match(floatRe, y): return float(y)
+    elif re.match(shortFloatRe, y): return float(y)
+    elif re.match(hexRe, y): return int(y, 16)
+    return interpr.nan
+
+@benchmark
+def conversions():
+    """ numbers of strings, regex cascade against StringToNumber """
+    # fields of CSV-like data, a few hundred distinct values repeated
+    fields = []
+    for i in range(300):
+        fields += [str(i * 7), "%.2f" % (i / 3.0), "-%i" % i, "", "n/a"]
+    fields = fields * 20
+    def convert(f):
+        def run():
+            for s in fields: f(s)
+        return run
+    report("regex cascade", timeit(convert(regexCascade)))
+    report("StringToNumber", timeit(convert(interpr.stringToNumber)))
+    report("toNumber with cache", timeit(convert(interpr.toNumber)))
+
+optimizable = """
+var debug = false;
+function sq(x) { return x * x }
+function kind(i) {
+    switch (i %% 8) {
+    case 0: return "a"; case 1: return "b"; case 2: return "c";
+    case 3: return "d"; case 4: return "e"; case 5: return "f";
+    default: return "g"
+    }
+}
+var s = 0, k = "";
+for (var i = 0; i < %(n)d; i++) {
+    s = s + sq(i) %% (60 * 60 * 24) + (1 << 10) - 2 * 512;
+    if (false) { s = s + debug }
+    k = kind(i);
+}
+"""
+
+@benchmark
+def optimizations():
+    """ optimizer passes one by one and all together """
+    source = optimizable % dict(n=3000)
+    for passes in [[]] + [[name] for name in optimizer.passes] + [None]:
+        label = passes is None and "all" or ", ".join(passes) or "none"
+        for engine in ("tree", "closure"):
+            def run():
+                interpr.PyJS(engine=engine, optimize=passes is None or 
+                                passes).eval_(source)
+            report("%s %s" % (engine, label), timeit(run))
+
+growing = """
+var a = [];
+for (var i = 0; i < 5000; i++) { a[a.length] = i }
+var b = [];
+b[%(far)d] = 1;
+for (var i = 0; i < 1000; i++) { b[i] = i; b.length }
+var s = a.join(",") + b.length;
+"""
+
+@benchmark
+def arrays():
+    """ appends at the end of arrays and writes far past it """
+    for engine in ("tree", "closure"):
+        for far in (100, 1000000):
+            source = growing % dict(far=far)
+            def run():
+                interpr.PyJS(engine=engine).eval_(source)
+            report("%s b[%i]" % (engine, far), timeit(run))
+
+# the methods as scripts had to write them before they were native
+polyfills = """
+function map(a, f) {
+    var r = [];
+    for (var i = 0; i < a.length; i++) r.push(f(a[i], i, a));
+    return r;
+}
+function filter(a, f) {
+    var r = [];
+    for (var i = 0; i < a.length; i++) if (f(a[i], i, a)) r.push(a[i]);
+    return r;
+}
+function indexOf(a, x) {
+    for (var i = 0; i < a.length; i++) if (a[i] === x) return i;
+    return -1;
+}
+"""
+
+listing = """
+var a = [];
+for (var i = 0; i < 2000; i++) a.push(i);
+var m = %(map)s, f = %(filter)s, k = 0;
+for (var j = 0; j < 20; j++) k += %(indexOf)s;
+var s = m.join(",") + f.join(",");
+"""
+
+@benchmark
+def methods():
+    """ native array methods against scripts doing the same """
+    calls = {
+        "native": dict(map="a.map(function(x) { return x * 2 })",
+                       filter="a.filter(function(x) { return x % 3 })",
+                       indexOf="a.indexOf(1999)"),
+        "script": dict(map="map(a, function(x) { return x * 2 })",
+                       filter="filter(a, function(x) { return x % 3 })",
+                       indexOf="indexOf(a, 1999)")}
+    for engine in ("tree", "closure"):
+        for kind in ("script", "native"):
+            source = polyfills + listing % calls[kind]
+            def run():
+                interpr.PyJS(engine=engine).eval_(source)
+            report("%s %s" % (engine, kind), timeit(run))
+
+templating = """
+function render(n) {
+    var html = "<table>";
+    for (var i = 0; i < n; i++) {
+        %(append)s
+    }
+    return html + "</table>";
+}
+var page = render(%(n)d);
+"""
+
+@benchmark
+def templates():
+    """ strings built up with += against html = html + ... """
+    appends = (("+=", 'html += "<tr><td>" + i + "</td></tr>";'),
+               ("= +", 'html = html + "<tr><td>" + i + "</td></tr>";'))
+    for engine in ("tree", "closure", "vm"):
+        for n in (2000, 20000):
+            for label, append in appends:
+                source = templating % dict(n=n, append=append)
+                def run():
+                    interpr.PyJS(engine=engine).eval_(source)
+                report("%s %s %i rows" % (engine, label, n), timeit(run))
+
+rewriting = """
+var text = "";
+for (var i = 0; i < 50; i++) { text += "item " + i + ", price $" + i * 3 + "; " }
+var out = [];
+for (var j = 0; j < 200; j++) {
+    out.push(text.replace(/(\\w+) (\\d+)/g, "$2:$1").split(/; /).length);
+    out.push(text.match(/\\$\\d+/g).length + text.search(/49/));
+}
+"""
+
+@benchmark
+def regexps():
+    """ replace, split, match and search with regexp literals in a loop """
+    for engine in ("tree", "closure"):
+        def run():
+            interpr.PyJS(engine=engine).eval_(rewriting)
+        report("%s rewriting" % engine, timeit(run))
+
+@benchmark
+def evaluation():
+    """ repeated eval of a library and a call, parsed once by the cache """
+    source = polyfills + templating % dict(n=20, 
+                append='html += "<tr><td>" + i + "</td></tr>";') + \
+             "var r = indexOf(map([1, 2, 3], function(x) { return x * 2 }), 6);"
+    evals = 20
+    jsparser.cache.clear()
+    for engine in ("tree", "closure", "vm"):
+        js = interpr.PyJS(engine=engine)
+        tree = js.parse(source)
+        def parsing():
+            for i in range(evals): js.execute(jsparser.parse(source))
+        def caching():
+            for i in range(evals): js.eval_(source)
+        def executing():
+            for i in range(evals): js.execute(tree)
+        for name, f in (("parsed", parsing), ("cached", caching), 
+                        ("execution", executing)):
+            report("%s %s" % (engine, name), 1000 * timeit(f) / evals, "ms")
+    stats = jsparser.cache.stats()
+    report("hit rate of %i trees" % stats["trees"], 
+           100.0 * stats["hits"] / (stats["hits"] + stats["misses"]), "%")
+
+def sizeof(x):
+    """ bytes taken by object x and by its __dict__ if it has one, asking
+        for __dict__ makes one for objects with slots, it is not counted
+    """
+    size = sys.getsizeof(x)
+    referents = gc.get_referents(x)
+    d = getattr(x, "__dict__", None)
+    if d is not None and [r for r in referents if r is d]: 
+        size += sys.getsizeof(d)
+    return size
+
+def instances(cls):
+    return [x for x in gc.get_objects() if type(x) is cls]
+
+descending = """
+function down(n) { var a = n, b = n + 1; return n ? down(n - 1) : measure() }
+down(%(n)d);
+"""
+
+@benchmark
+def memory():
+    """ bytes per token, per node of a large script and per call frame """
+    source = "\n".join([fib, loop, objects, strings, allocating,
+                        optimizable % dict(n=100)] * 20)
+    t = lexer.Tokenizer(source)
+    sizes = []
+    while t.get(True) != lexer.END: sizes.append(sizeof(t.token))
+    report("token", float(sum(sizes)) / len(sizes), "bytes")
+    # nodes after a run, with the annotations of the engine
+    gc.collect()
+    tree = jsparser.parse(source)
+    interpr.PyJS(engine="closure").execute(tree)
+    nodes = instances(jsparser.Node)
+    report("node of %i" % len(nodes),
+            float(sum(map(sizeof, nodes))) / len(nodes), "bytes")
+    # nodes refer to the source rather than to the tokenizer
+    report("pickled node", 
+            float(len(cPickle.dumps(tree, 2))) / len(nodes), "bytes")
+    for engine in ("tree", "closure", "vm"):
+        js = interpr.PyJS(engine=engine)
+        frames = []
+        def measure(this):
+            frames.extend(instances(interpr.JS_Context))
+        js.globals.measure = measure
+        js.eval_(descending % dict(n=50))
+        size = sum(sizeof(c) + sys.getsizeof(c.scope) + 
+                   (c.frame is not None and sys.getsizeof(c.frame) or 0)
+                   for c in frames)
+        report("%s frame" % engine, float(size) / len(frames), "bytes")
+
+tabulating = """
+function Point(x, y) { this.x = x; this.y = y; this.label = "p" + x }
+var rows = [], points = [], sum = 0;
+for (var i = 0; i < %(n)d; i++) {
+    rows.push({id: i, name: "row" + i, price: i * 3, qty: i %% 7, 
+               tag: null, ok: true});
+    points.push(new Point(i, i + 1));
+}
+for (var j = 0; j < 5; j++) {
+    for (var i = 0; i < rows.length; i++) {
+        sum = sum + rows[i].price * rows[i].qty + points[i].x - points[i].y;
+    }
+}
+"""
+
+@benchmark
+def records():
+    """ many objects of a few shapes, made by literals and by new """
+    for engine in ("tree", "closure", "vm"):
+        def run():
+            interpr.PyJS(engine=engine).eval_(tabulating % dict(n=2000))
+        report("%s records" % engine, timeit(run))
+    js = interpr.PyJS(engine="closure")
+    js.eval_(tabulating % dict(n=2000))
+    for name in ("rows", "points"):
+        objects = [x for i, x in js[name]]
+        # property values are kept in the __dict__ or in a list of values
+        size = sum(sizeof(x) + sum([sys.getsizeof(r) 
+                        for r in gc.get_referents(x) if type(r) is list])
+                   for x in objects)
+        report("object of %s" % name, float(size) / len(objects), "bytes")
+
+@benchmark
+def lazy():
+    """ eager against lazy parse of a library, of which little is called """
+    modules = [fib, loop, objects, strings, allocating, rewriting, polyfills]
+    source = "\n".join(["function module%i() {\n%s\n}" % (i, m)
+                         for i, m in enumerate(modules * 10)]) + \
+             polyfills + \
+             "var r = indexOf(map([1, 2, 3], function(x) { return x * 2 }), 6);"
+    for lazy in (False, True):
+        label = lazy and "lazy" or "eager"
+        report("%s parse" % label, 
+               timeit(lambda: jsparser.parse(source, lazy=lazy)))
+        def run():
+            js = interpr.PyJS(engine="closure")
+            js.execute(jsparser.parse(source, lazy=lazy))
+        report("%s parse and run" % label, timeit(run))
+        # nodes after the run, parsed bodies of lazy functions included
+        gc.collect()
+        tree = jsparser.parse(source, lazy=lazy)
+        interpr.PyJS(engine="closure").execute(tree)
+        nodes = instances(jsparser.Node) + instances(jsparser.LazyFunction)
+        report("%s nodes" % label, len(nodes), "")
+        report("%s tree" % label, sum(map(sizeof, nodes)) / 1024.0, "KB")
+        del tree, nodes
+
+generated = """
+data.push({id: %(i)d, name: "row %(i)d", tags: ["a", "b", %(i)d], ok: true});
+"""
+
+def count(n):
+    """ number of nodes of tree n """
+    return 1 + sum([count(x) for x in resolver.children(n)])
+
+@benchmark
+def streaming():
+    """ large generated script run whole against a statement at a time """
+    source = "var data = [];\n" + "".join([generated % dict(i=i) 
+                                           for i in range(1000)])
+    # one statement, which is many chunks long
+    literal = "var data = [%s];\n" % ",\n".join(
+                ['{id: %i, name: "row %i"}' % (i, i) for i in range(5000)])
+    for engine in ("tree", "closure"):
+        for label, script in (("statements", source), ("literal", literal)):
+            def whole():
+                js = interpr.PyJS(engine=engine)
+                js.execute(jsparser.parse(script))
+            def streamed():
+                js = interpr.PyJS(engine=engine)
+                js.stream_(StringIO.StringIO(script))
+            report("%s %s whole" % (engine, label), timeit(whole))
+            report("%s %s streamed" % (engine, label), timeit(streamed))
+    report("nodes of whole", count(jsparser.parse(source)), "")
+    report("nodes of largest statement", 
+           max(map(count, jsparser.statements(StringIO.StringIO(source)))), "")
+
+# tokens after which a slash divides, elsewhere it starts a regexp
+operandEnds = (lexer.IDENTIFIER, lexer.NUMBER, lexer.STRING, lexer.REGEXP, 
+               lexer.RIGHT_PAREN, lexer.RIGHT_BRACKET)
+
+def tokenize(cls, source):
+    """ number of tokens of source read by tokenizer class cls
+    """
+    t = cls(source)
+    n = 0
+    tt = None
+    while True:
+        tt = t.get(tt not in operandEnds)
+        if tt == lexer.END: return n
+        n += 1
+
+@benchmark
+def tokens():
+    """ master regexps against reading one character at a time """
+    source = "\n".join([fib, loop, objects, strings, allocating, counting,
+                        rewriting, polyfills, tabulating % dict(n=10)] * 20)
+    for cls in (lexer.CharTokenizer, lexer.Tokenizer):
+        n = tokenize(cls, source)
+        t = timeit(lambda: tokenize(cls, source))
+        report(cls.__name__, n / t, "tokens/s")
+    report("parse", timeit(lambda: jsparser.parse(source)))
+
+def main(names):
+    for f in benchmarks:
+        if names and f.__name__ not in names: continue
+        print "%s: %s" % (f.__name__, f.__doc__.strip())
+        f()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
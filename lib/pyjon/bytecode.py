@@ -0,0 +1,1154 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+#
+# Bytecode compiler and virtual machine for PyJS.
+# ------------------------------------------------------------------------------
+#
+# Compiles a parse tree (see jsparser and resolver) into linear code of a
+# stack machine and runs it. Code object consists of
+#
+#   ops         opcodes
+#   args        operands, one for every opcode
+#   lines       source line of every opcode
+#   consts      constant pool (numbers and strings)
+#   sites       operations, which need a parse node for JS_Context helpers
+#               (error positions, property names, inline caches, ...) get
+#               a Site instead of it
+#   functions   codes of nested functions
+#
+# Code is serialized with dumps() and loaded back with loads(), so that
+# a script compiled once (at deploy time or on warm up) runs without the
+# tokenizer and the parser. The format is compressed marshal and therefore
+# bound to the python version. dis() returns readable listing of code.
+#
+# Semantics are borrowed from the tree walker, the VM calls the same
+# JS_Context helpers (arithm, compareOp, getProperty, call, ...).
+#
+# Usage:
+#
+#   code = bytecode.compile(jsparser.parse(source))
+#   data = bytecode.dumps(code)
+#   bytecode.run(bytecode.loads(data), context)
+#
+# or PyJS(engine="vm").
+#
+
+__all__ = ["Code", "compile", "run", "dumps", "loads", "dis"]
+
+import marshal, threading, zlib
+# interpr exports JS Array object as array
+import array as pyarray
+
+import defs, resolver
+import interpr
+from interpr import *
+
+defs.map(globals())
+
+#
+# opcodes
+#
+opnames = """
+    POP_TOP DUP_TOP LOAD_CONST LOAD_NULL LOAD_THIS
+    LOAD_LOCAL STORE_LOCAL LOAD_OUTER STORE_OUTER
+    LOAD_GLOBAL STORE_GLOBAL DECLARE_GLOBAL TYPEOF_GLOBAL
+    GET_PROP SET_PROP DELETE_PROP INC_PROP
+    BINARY_ARITH BINARY_BITWISE COMPARE_OP CASE_EQ ASSIGN_OP
+    BINARY_IN BINARY_INSTANCEOF
+    UNARY_NOT UNARY_NEGATIVE UNARY_POSITIVE UNARY_INVERT UNARY_TYPEOF
+    TO_NUMBER APPEND_STRING FLATTEN
+    JUMP JUMP_IF_FALSE JUMP_IF_TRUE JUMP_IF_FALSE_OR_POP JUMP_IF_TRUE_OR_POP
+    JUMP_TABLE
+    CALL_FUNCTION CALL_METHOD
+    BUILD_ARRAY BUILD_OBJECT MAKE_FUNCTION MAKE_REGEXP
+    GET_ITER FOR_ITER
+    SETUP_TRY POP_TRY ENTER_CATCH LEAVE_CATCH RAISE RERAISE RAISE_ERROR
+    RETURN_VALUE STOP
+""".split()
+
+for i, name in enumerate(opnames):
+    globals()[name] = i
+
+# operands are jump targets
+jumps = (JUMP, JUMP_IF_FALSE, JUMP_IF_TRUE, JUMP_IF_FALSE_OR_POP,
+         JUMP_IF_TRUE_OR_POP, FOR_ITER, SETUP_TRY)
+# operands are indexes of sites
+siteOps = (LOAD_GLOBAL, STORE_GLOBAL, DECLARE_GLOBAL, TYPEOF_GLOBAL,
+           GET_PROP, SET_PROP, DELETE_PROP, INC_PROP,
+           BINARY_ARITH, COMPARE_OP,
+           CALL_FUNCTION, CALL_METHOD, BUILD_OBJECT, MAKE_REGEXP,
+           ENTER_CATCH, RAISE_ERROR)
+# operands are node types
+typeOps = (BINARY_BITWISE, ASSIGN_OP)
+# sites with node type as value and type feedback (see TypeFeedback)
+feedbackOps = (BINARY_ARITH, COMPARE_OP)
+
+# statements leave the stack as it was, anything else is an expression
+# and pushes its value
+statements = (SCRIPT, BLOCK, SEMICOLON, VAR, LET, CONST, IF, WHILE, FOR,
+              FOR_IN, BREAK, CONTINUE, RETURN, SWITCH, TRY, THROW, HEADER,
+              CLASS)
+
+class Site(object):
+    """ stands for parse node in calls of JS_Context helpers
+    """
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+    type_ = None
+    value = None
+    lineno = 0
+    start = 0
+    end = 0
+    filename = None
+
+    feedback = None
+
+    # attributes, which are not saved by dumps()
+    transient = ("ic", "feedback", "filename")
+
+    __repr__ = lambda self: "<Site %s>" % self.value
+
+class Code(object):
+    def __init__(self, name="", params=(), scopeNames=(), lineno=0,
+                    filename=None):
+        self.name = name
+        self.params = params
+        self.scopeNames = scopeNames
+        self.lineno = lineno
+        self.filename = filename
+        self.ops = []
+        self.args = []
+        self.lines = []
+        self.consts = []
+        self.sites = []
+        self.functions = []
+
+    # see interpr.function(), code of function is run by the VM and
+    # not interpreted
+    body = None
+
+    # node of lazy function (see jsparser.LazyFunction), the code is 
+    # compiled on the first call, the VM calls load() then
+    node = None
+    parsed = property(lambda self: self.node is None)
+
+    def load(self):
+        """ compiles code of lazy function, returns its runner
+        """
+        with lazyLock:
+            if self.node is not None:
+                code = compileFunction(self.node, self.filename)
+                self.__dict__.update(vars(code))
+                self.node = None
+        return self.runner
+
+    runner = property(lambda self: lambda ctx: run(self, ctx))
+
+    __repr__ = lambda self: "<Code %s, %i ops>" % (self.name or "script",
+                                                      len(self.ops))
+
+#
+# compiler
+#
+
+# compilers of node types, filled in by @compiles
+compilers = {}
+
+def compiles(*types):
+    def register(f):
+        for t in types:
+            compilers[t] = f
+        return f
+    return register
+
+class Label(object):
+    def __init__(self):
+        self.address = None
+        self.patches = []
+
+class Compiler(object):
+    """ emits code of one script or function body
+    """
+    def __init__(self, code):
+        self.code = code
+        self.lineno = code.lineno
+        # enclosing statements, which are left by break, continue and
+        # return: ("loop", break label, continue label, for-in),
+        # ("switch", break label), ("try",), ("catch",), ("finally", node)
+        self.blocks = []
+        self.constIndex = {}
+
+    def emit(self, op, arg=0):
+        code = self.code
+        code.ops.append(op)
+        code.args.append(arg)
+        code.lines.append(self.lineno)
+        return len(code.ops) - 1
+
+    def const(self, value):
+        # True == 1 and 1.0 == 1, so the type is part of the key
+        key = (type(value), value)
+        if key not in self.constIndex:
+            self.constIndex[key] = len(self.code.consts)
+            self.code.consts.append(value)
+        return self.emit(LOAD_CONST, self.constIndex[key])
+
+    def site(self, n, **attrs):
+        site = Site(type_=getattr(n, "type_", None),
+                    lineno=getattr(n, "lineno", self.lineno),
+                    start=getattr(n, "start", 0) or 0,
+                    end=getattr(n, "end", 0) or 0,
+                    filename=self.code.filename)
+        site.__dict__.update(attrs)
+        self.code.sites.append(site)
+        return len(self.code.sites) - 1
+
+    def jump(self, op, label):
+        i = self.emit(op, label.address or 0)
+        if label.address is None:
+            label.patches.append(i)
+        return i
+
+    def mark(self, label):
+        label.address = len(self.code.ops)
+        for i in label.patches:
+            self.code.args[i] = label.address
+
+    def compile(self, n):
+        lineno = getattr(n, "lineno", None)
+        if lineno: self.lineno = lineno
+        f = compilers.get(n.type_)
+        if f is None:
+            return self.error("NotImplemented_", n.type, n)
+        f(self, n)
+
+    def statement(self, n):
+        if isNull(n) or isUndefined(n): return
+        self.compile(n)
+        if n.type_ not in statements and \
+                not (n.type_ == FUNCTION and n.functionForm == 0):
+            self.emit(POP_TOP)
+
+    def expression(self, n):
+        if isNull(n) or isUndefined(n) or isString(n) or isNumber(n):
+            self.const(n)
+        else:
+            self.compile(n)
+
+    def error(self, ex, message, n):
+        """ emits raising of error, ex is name of the exception class in
+            interpr
+        """
+        self.emit(RAISE_ERROR, self.site(n, error=ex, value=message))
+        if n.type_ not in statements:
+            self.const(undefined)
+
+    def load(self, name, n, raw=False):
+        """ pushes variable, StringBuilder is flattened unless raw
+        """
+        slot = getattr(n, "slot", None)
+        if not slot:
+            self.emit(LOAD_GLOBAL, self.site(n, value=name))
+        elif slot[0] == 0:
+            self.emit(LOAD_LOCAL, slot[1])
+        else:
+            self.emit(LOAD_OUTER, slot[0] << 16 | slot[1])
+        if not raw and getattr(n, "flatten", False):
+            self.emit(FLATTEN)
+
+    def store(self, name, n):
+        slot = getattr(n, "slot", None)
+        if not slot:
+            self.emit(STORE_GLOBAL, self.site(n, value=name))
+        elif slot[0] == 0:
+            self.emit(STORE_LOCAL, slot[1])
+        else:
+            self.emit(STORE_OUTER, slot[0] << 16 | slot[1])
+
+    def property(self, n):
+        """ pushes property name of DOT or INDEX node
+        """
+        if n.type_ == INDEX:
+            self.expression(n[1])
+        elif n[1].type_ == IDENTIFIER:
+            self.const(ustr(n[1].value))
+        else:
+            raise NotImplemented_, str(n[1].type)
+
+    def leave(self, i, unwind=True):
+        """ emits leaving of enclosing statements down to self.blocks[i],
+            unwind pops iterators of for-in loops
+        """
+        blocks = self.blocks
+        for j in range(len(blocks) - 1, i - 1, -1):
+            block = blocks[j]
+            kind = block[0]
+            if kind == "try":
+                self.emit(POP_TRY)
+            elif kind == "catch":
+                self.emit(LEAVE_CATCH)
+            elif kind == "finally":
+                # finally block is copied to every exit of try block
+                self.blocks = blocks[:j]
+                self.statement(block[1])
+                self.blocks = blocks
+            elif kind == "loop" and block[3] and unwind:
+                self.emit(POP_TOP)
+
+    def function(self, f):
+        """ compiles function node, returns index of its code
+        """
+        if not getattr(f, "parsed", True):
+            code = Code(ustr(getattr(f, "name", "") or ""),
+                        tuple([ustr(p) for p in f.params]), None,
+                        f.lineno, self.code.filename)
+            code.node = f
+        else:
+            code = compileFunction(f, self.code.filename)
+        self.code.functions.append(code)
+        return len(self.code.functions) - 1
+
+lazyLock = threading.Lock()
+
+def compileFunction(f, filename):
+    """ compiles function node f, returns its Code
+    """
+    body = f.body
+    if not hasattr(f, "scopeNames"):
+        resolver.resolveFunction(f)
+    code = Code(ustr(getattr(f, "name", "") or ""),
+                tuple([ustr(p) for p in f.params]),
+                tuple([ustr(name) for name in f.scopeNames]),
+                f.lineno, filename)
+    c = Compiler(code)
+    c.statement(body)
+    c.emit(STOP)
+    return code
+
+def compile(n):
+    """ compiles top level script n, returns Code
+    """
+    code = Code(filename=getattr(n, "filename", None),
+                lineno=getattr(n, "lineno", 0))
+    c = Compiler(code)
+    c.statement(n)
+    c.emit(STOP)
+    return code
+
+#
+# terminals
+#
+@compiles(NUMBER)
+def number_(c, n): c.const(toNumber(n.value))
+
+@compiles(STRING)
+def string_(c, n): c.const(n.value)
+
+@compiles(TRUE)
+def true_(c, n): c.const(True)
+
+@compiles(FALSE)
+def false_(c, n): c.const(False)
+
+@compiles(NULL)
+def null_(c, n): c.emit(LOAD_NULL)
+
+@compiles(THIS)
+def this_(c, n): c.emit(LOAD_THIS)
+
+@compiles(REGEXP)
+def regexp_(c, n): c.emit(MAKE_REGEXP, c.site(n, value=n.value))
+
+@compiles(IDENTIFIER)
+def identifier(c, n): c.load(ustr(n.value), n)
+
+@compiles(HEADER)
+def header(c, n): pass
+
+#
+# statements
+#
+@compiles(SCRIPT, BLOCK)
+def block(c, n):
+    for x in n:
+        c.statement(x)
+
+@compiles(SEMICOLON)
+def semicolon(c, n):
+    if n.expression:
+        c.expression(n.expression)
+        c.emit(POP_TOP)
+
+@compiles(VAR, LET, CONST)
+def var_(c, n):
+    for x in n:
+        name = ustr(x.value)
+        if hasattr(x, "initializer"):
+            c.expression(x.initializer)
+            c.store(name, x)
+            c.emit(POP_TOP)
+        elif not getattr(x, "slot", None):
+            c.emit(DECLARE_GLOBAL, c.site(x, value=name))
+
+@compiles(FUNCTION)
+def function_(c, n):
+    c.emit(MAKE_FUNCTION, c.function(n))
+    if n.functionForm == 0:
+        c.store(ustr(n.name), n)
+        c.emit(POP_TOP)
+
+@compiles(CLASS)
+def class_(c, n): c.error("NotImplemented_", n.type, n)
+
+@compiles(IF)
+def if_(c, n):
+    else_, end = Label(), Label()
+    c.expression(n.condition)
+    c.jump(JUMP_IF_FALSE, else_)
+    c.statement(n.thenPart)
+    c.jump(JUMP, end)
+    c.mark(else_)
+    c.statement(n.elsePart)
+    c.mark(end)
+
+@compiles(WHILE)
+def while_(c, n):
+    top, end = Label(), Label()
+    c.mark(top)
+    c.expression(n.condition)
+    c.jump(JUMP_IF_FALSE, end)
+    c.blocks.append(("loop", end, top, False))
+    c.statement(n.body)
+    c.blocks.pop()
+    c.jump(JUMP, top)
+    c.mark(end)
+
+@compiles(FOR)
+def for_(c, n):
+    top, next, end = Label(), Label(), Label()
+    c.statement(n.setup)
+    c.mark(top)
+    if n.condition:
+        c.expression(n.condition)
+        c.jump(JUMP_IF_FALSE, end)
+    c.blocks.append(("loop", end, next, False))
+    c.statement(n.body)
+    c.blocks.pop()
+    c.mark(next)
+    c.statement(n.update)
+    c.jump(JUMP, top)
+    c.mark(end)
+
+@compiles(FOR_IN)
+def for_in(c, n):
+    next, end = Label(), Label()
+    c.expression(n.object)
+    c.emit(GET_ITER)
+    c.mark(next)
+    c.jump(FOR_ITER, end)
+    c.store(ustr(n.iterator.value), n.iterator)
+    c.emit(POP_TOP)
+    c.blocks.append(("loop", end, next, True))
+    c.statement(n.body)
+    c.blocks.pop()
+    c.jump(JUMP, next)
+    c.mark(end)
+
+@compiles(BREAK, CONTINUE)
+def break_(c, n):
+    for i in range(len(c.blocks) - 1, -1, -1):
+        block = c.blocks[i]
+        if block[0] == "loop" or (block[0] == "switch" and n.type_ == BREAK):
+            break
+    else:
+        return c.error("SyntaxError_", "%s outside of loop" % n.type, n)
+    if n.type_ == BREAK:
+        c.leave(i)
+        c.jump(JUMP, block[1])
+    else:
+        c.leave(i + 1)
+        c.jump(JUMP, block[2])
+
+@compiles(RETURN)
+def return_(c, n):
+    c.expression(n.value)
+    # the value stays on top of the stack, so iterators are not popped
+    c.leave(0, unwind=False)
+    c.emit(RETURN_VALUE)
+
+@compiles(SWITCH)
+def switch(c, n):
+    end = Label()
+    matches = [Label() for case in n.cases]
+    bodies = [Label() for case in n.cases]
+    c.expression(n.discriminant)
+    table = getattr(n, "jumpTable", None)
+    if table is not None:
+        # label values to addresses of case bodies, filled in below,
+        # JUMP_TABLE falls through if the value is not there
+        addresses = {}
+        c.code.consts.append(addresses)
+        c.emit(JUMP_TABLE, len(c.code.consts) - 1)
+    else:
+        for i, case in enumerate(n.cases):
+            if case.type_ == CASE:
+                c.emit(DUP_TOP)
+                c.expression(case.caseLabel)
+                c.emit(CASE_EQ)
+                c.jump(JUMP_IF_TRUE, matches[i])
+        c.emit(POP_TOP)
+    if n.defaultIndex >= 0:
+        c.jump(JUMP, bodies[n.defaultIndex])
+    else:
+        c.jump(JUMP, end)
+    for i, case in enumerate(n.cases):
+        if case.type_ == CASE and table is None:
+            c.mark(matches[i])
+            c.emit(POP_TOP)
+            c.jump(JUMP, bodies[i])
+    c.blocks.append(("switch", end))
+    for i, case in enumerate(n.cases):
+        c.mark(bodies[i])
+        for x in case.statements:
+            c.statement(x)
+    c.blocks.pop()
+    c.mark(end)
+    if table is not None:
+        for value, i in table.iteritems():
+            addresses[value] = bodies[i].address
+
+#
+# try statement
+#
+#       SETUP_TRY finally           if finally block
+#       SETUP_TRY catch             if catch clauses
+#       try block
+#       POP_TRY
+#       JUMP done
+#   catch:                          exception is on the stack
+#       ENTER_CATCH                 catch block runs in new context
+#       catch block
+#       LEAVE_CATCH
+#   done:
+#       POP_TRY
+#       finally block
+#       JUMP end
+#   finally:
+#       finally block
+#       RERAISE
+#   end:
+#
+@compiles(TRY)
+def try_(c, n):
+    finallyBlock = getattr(n, "finallyBlock", None)
+    catches = n.catchClauses
+    handler, done, end = Label(), Label(), Label()
+    if finallyBlock:
+        c.jump(SETUP_TRY, handler)
+        # the handler is popped before the copies of the finally block,
+        # which may throw
+        c.blocks.append(("finally", finallyBlock))
+        c.blocks.append(("try",))
+    if catches:
+        catch = Label()
+        c.jump(SETUP_TRY, catch)
+        c.blocks.append(("try",))
+        c.statement(n.tryBlock)
+        c.blocks.pop()
+        c.emit(POP_TRY)
+        c.jump(JUMP, done)
+        c.mark(catch)
+        for i, clause in enumerate(catches):
+            # like the tree walker does, every clause is run
+            if i < len(catches) - 1: c.emit(DUP_TOP)
+            c.emit(ENTER_CATCH, c.site(clause, value=ustr(clause.varName),
+                                names=tuple(clause.scopeNames)))
+            c.blocks.append(("catch",))
+            c.statement(clause.block)
+            c.blocks.pop()
+            c.emit(LEAVE_CATCH)
+    else:
+        c.statement(n.tryBlock)
+    c.mark(done)
+    if finallyBlock:
+        c.blocks.pop()
+        c.blocks.pop()
+        c.emit(POP_TRY)
+        c.statement(finallyBlock)
+        c.jump(JUMP, end)
+        c.mark(handler)
+        c.statement(finallyBlock)
+        c.emit(RERAISE)
+        c.mark(end)
+
+@compiles(THROW)
+def throw(c, n):
+    c.expression(n.exception)
+    c.emit(RAISE)
+
+#
+# expressions
+#
+@compiles(GROUP)
+def group(c, n): c.expression(n[0])
+
+@compiles(COMMA)
+def comma(c, n):
+    for x in n[:-1]:
+        c.expression(x)
+        c.emit(POP_TOP)
+    c.expression(n[-1])
+
+@compiles(ASSIGN)
+def assign(c, n):
+    left = n[0]
+    op = n.assignOp
+    if left.type_ == IDENTIFIER:
+        name = ustr(left.value)
+        if op == PLUS and getattr(left, "builder", False):
+            c.load(name, left, raw=True)
+            c.expression(n[1])
+            c.emit(APPEND_STRING)
+        elif op:
+            c.load(name, left)
+            c.expression(n[1])
+            c.emit(ASSIGN_OP, op)
+        else:
+            c.expression(n[1])
+        c.store(name, left)
+    elif left.type_ in (DOT, INDEX):
+        c.expression(left[0])
+        c.property(left)
+        c.expression(n[1])
+        c.emit(SET_PROP, c.site(left, assignOp=op))
+    else:
+        c.error("ReferenceError", "invalid assignment left-hand side", n)
+
+@compiles(INCREMENT, DECREMENT)
+def increment(c, n):
+    target = n[0]
+    op = n.type_ == INCREMENT and PLUS or MINUS
+    postfix = getattr(n, "postfix", False)
+    if target.type_ == IDENTIFIER:
+        name = ustr(target.value)
+        c.load(name, target)
+        c.emit(TO_NUMBER)
+        if postfix: c.emit(DUP_TOP)
+        c.const(1)
+        c.emit(BINARY_ARITH, c.site(n, value=op))
+        c.store(name, target)
+        if postfix: c.emit(POP_TOP)
+    else:
+        c.expression(target[0])
+        c.property(target)
+        c.emit(INC_PROP, c.site(target, op=op, postfix=postfix))
+
+@compiles(DOT, INDEX)
+def member(c, n):
+    c.expression(n[0])
+    c.property(n)
+    c.emit(GET_PROP, c.site(n))
+
+@compiles(CALL, NEW, NEW_WITH_ARGS)
+def call(c, n):
+    t = n.type_
+    callee = n[0]
+    args = t != NEW and n[1] or []
+    if callee.type_ in (DOT, INDEX):
+        c.expression(callee[0])
+        c.emit(DUP_TOP)
+        c.property(callee)
+        c.emit(GET_PROP, c.site(callee))
+        op = CALL_METHOD
+    else:
+        c.expression(callee)
+        op = CALL_FUNCTION
+    for x in args:
+        c.expression(x)
+    c.emit(op, c.site(n, argc=len(args)))
+
+@compiles(ARRAY_INIT)
+def array_init(c, n):
+    for x in n:
+        c.expression(x)
+    c.emit(BUILD_ARRAY, len(n))
+
+@compiles(OBJECT_INIT)
+def object_init(c, n):
+    props = [x for x in n if x.type_ == PROPERTY_INIT]
+    for x in props:
+        c.expression(x[1])
+    c.emit(BUILD_OBJECT, c.site(n, keys=tuple([ustr(x[0].value)
+                                                    for x in props])))
+
+@compiles(PLUS, MINUS, MUL, DIV, MOD)
+def arithm(c, n):
+    c.expression(n[0])
+    c.expression(n[1])
+    c.emit(BINARY_ARITH, c.site(n, value=n.type_))
+
+@compiles(BITWISE_OR, BITWISE_AND, BITWISE_XOR, URSH, RSH, LSH)
+def bitwise(c, n):
+    c.expression(n[0])
+    c.expression(n[1])
+    c.emit(BINARY_BITWISE, n.type_)
+
+@compiles(GT, LT, EQ, NE, GE, LE, STRICT_EQ, STRICT_NE)
+def compare(c, n):
+    c.expression(n[0])
+    c.expression(n[1])
+    c.emit(COMPARE_OP, c.site(n, value=n.type_))
+
+@compiles(AND, OR)
+def logical(c, n):
+    end = Label()
+    c.expression(n[0])
+    c.jump(n.type_ == AND and JUMP_IF_FALSE_OR_POP or JUMP_IF_TRUE_OR_POP,
+            end)
+    c.expression(n[1])
+    c.mark(end)
+
+@compiles(HOOK)
+def hook(c, n):
+    else_, end = Label(), Label()
+    c.expression(n[0])
+    c.jump(JUMP_IF_FALSE, else_)
+    c.expression(n[1])
+    c.jump(JUMP, end)
+    c.mark(else_)
+    c.expression(n[2])
+    c.mark(end)
+
+@compiles(NOT, UNARY_PLUS, UNARY_MINUS, BITWISE_NOT)
+def unary(c, n):
+    c.expression(n[0])
+    c.emit({NOT: UNARY_NOT, UNARY_PLUS: UNARY_POSITIVE,
+            UNARY_MINUS: UNARY_NEGATIVE, BITWISE_NOT: UNARY_INVERT}[n.type_])
+
+@compiles(VOID)
+def void(c, n):
+    c.expression(n[0])
+    c.emit(POP_TOP)
+    c.const(undefined)
+
+@compiles(TYPEOF)
+def typeof_(c, n):
+    x = n[0]
+    if x.type_ == IDENTIFIER and not getattr(x, "slot", None):
+        c.emit(TYPEOF_GLOBAL, c.site(x, value=ustr(x.value)))
+    else:
+        c.expression(x)
+        c.emit(UNARY_TYPEOF)
+
+@compiles(IN)
+def in_(c, n):
+    c.expression(n[0])
+    c.expression(n[1])
+    c.emit(BINARY_IN)
+
+@compiles(INSTANCEOF)
+def instanceof(c, n):
+    c.expression(n[0])
+    c.expression(n[1])
+    c.emit(BINARY_INSTANCEOF)
+
+@compiles(DELETE)
+def delete(c, n):
+    target = n[0]
+    c.expression(target[0])
+    c.property(target)
+    c.emit(DELETE_PROP, c.site(target))
+
+#
+# virtual machine
+#
+def run(code, ctx):
+    """ runs code in JS_Context ctx, function codes set return value and
+        completion of ctx like the tree walker does
+    """
+    ops = code.ops
+    args = code.args
+    consts = code.consts
+    sites = code.sites
+    lines = code.lines
+    base = ctx
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    # handlers of try statements: (address, stack depth, context)
+    handlers = []
+    full = ctx.stackMode == "full"
+    frame = ownFrame(ctx)
+    pc = 0
+    # Calls of functions compiled to bytecode are run by this loop, not 
+    # by recursion, state of the calling code is saved here on call and
+    # restored on return. pushed tells whether the function running put
+    # frame on the call stack (see interpr.function).
+    calls = []
+    pushed = False
+    while True:
+        try:
+            while True:
+                op = ops[pc]
+                arg = args[pc]
+                if full: frame[2] = lines[pc]
+                pc += 1
+
+                if op == LOAD_LOCAL:
+                    push(ctx.frame[arg])
+                elif op == LOAD_CONST:
+                    push(consts[arg])
+                elif op == STORE_LOCAL:
+                    ctx.frame[arg] = stack[-1]
+                elif op == POP_TOP:
+                    pop()
+                elif op == LOAD_GLOBAL:
+                    site = sites[arg]
+                    push(ctx.globalVar(site.value, site))
+                elif op == GET_PROP:
+                    prop = pop()
+                    push(ctx.getProperty(pop(), prop, sites[arg]))
+                elif op == BINARY_ARITH or op == COMPARE_OP:
+                    # see TypeFeedback
+                    b = pop()
+                    a = pop()
+                    site = sites[arg]
+                    feedback = site.feedback
+                    if feedback is None:
+                        feedback = site.feedback = TypeFeedback(site.value)
+                    t = feedback.type
+                    if type(a) is t and type(b) is t:
+                        x = feedback.fast(a, b)
+                        if x is not missing:
+                            push(x)
+                            continue
+                    elif t is not False:
+                        feedback.miss(a, b)
+                    if op == BINARY_ARITH:
+                        push(ctx.arithm(a, b, site.value))
+                    else:
+                        push(ctx.compareOp(a, b, site.value))
+                elif op == JUMP_IF_FALSE:
+                    if not pop(): pc = arg
+                elif op == JUMP:
+                    pc = arg
+                elif op == CALL_FUNCTION or op == CALL_METHOD:
+                    site = sites[arg]
+                    argc = site.argc
+                    if argc:
+                        params = stack[-argc:]
+                        del stack[-argc:]
+                    else:
+                        params = ()
+                    fun = pop()
+                    if op == CALL_METHOD: this = pop()
+                    else: this = ctx.context
+                    if type(fun) is js_function and site.type_ == CALL:
+                        constructor = fun.constructor
+                        if type(constructor.function) is Code:
+                            if ctx.stackMode == "functions" and ctx.pushed:
+                                ctx.callStack[-1][2] = site.lineno
+                            rawset(fun, "caller", ctx.caller)
+                            callee, calleePushed = constructor.enter(this, 
+                                                                     params)
+                            calls.append((code, ops, args, consts, sites, 
+                                lines, pc, stack, handlers, base, ctx, pushed))
+                            code = constructor.function
+                            ops = code.ops
+                            args = code.args
+                            consts = code.consts
+                            sites = code.sites
+                            lines = code.lines
+                            pc = 0
+                            stack = []
+                            push = stack.append
+                            pop = stack.pop
+                            handlers = []
+                            base = ctx = callee
+                            pushed = calleePushed
+                            frame = ownFrame(ctx)
+                            continue
+                    push(ctx.call(fun, this, params, site.type_, site))
+                elif op == RETURN_VALUE or op == STOP:
+                    value = undefined
+                    if op == RETURN_VALUE: value = pop()
+                    if not calls:
+                        if op == RETURN_VALUE:
+                            base.returnValue = value
+                            base.completion = RETURN
+                        return
+                    # back to the caller
+                    base.depth[0] -= 1
+                    if pushed: base.callStack.pop()
+                    code, ops, args, consts, sites, lines, pc, stack, \
+                        handlers, base, ctx, pushed = calls.pop()
+                    push = stack.append
+                    pop = stack.pop
+                    frame = ownFrame(ctx)
+                    push(value)
+                elif op == LOAD_OUTER:
+                    depth = arg >> 16
+                    scope = ctx
+                    while depth:
+                        scope = scope.parent
+                        depth -= 1
+                    push(scope.frame[arg & 0xffff])
+                elif op == STORE_OUTER:
+                    depth = arg >> 16
+                    scope = ctx
+                    while depth:
+                        scope = scope.parent
+                        depth -= 1
+                    scope.frame[arg & 0xffff] = stack[-1]
+                elif op == STORE_GLOBAL:
+                    ctx.root_context.scope[sites[arg].value] = stack[-1]
+                elif op == DUP_TOP:
+                    push(stack[-1])
+                elif op == JUMP_IF_TRUE:
+                    if pop(): pc = arg
+                elif op == JUMP_IF_FALSE_OR_POP:
+                    if not stack[-1]: pc = arg
+                    else: pop()
+                elif op == JUMP_IF_TRUE_OR_POP:
+                    if stack[-1]: pc = arg
+                    else: pop()
+                elif op == TO_NUMBER:
+                    stack[-1] = toNumber(stack[-1])
+                elif op == SET_PROP:
+                    site = sites[arg]
+                    value = pop()
+                    prop = pop()
+                    obj = ctx.toObject(pop())
+                    push(ctx.setProperty(obj, prop, value, site,
+                                            site.assignOp))
+                elif op == INC_PROP:
+                    site = sites[arg]
+                    prop = pop()
+                    obj = ctx.toObject(pop())
+                    x = toNumber(ctx.getProperty(obj, prop, site))
+                    y = ctx.arithmOp(x, 1, site.op)
+                    ctx.setProperty(obj, prop, y, site)
+                    if site.postfix: push(x)
+                    else: push(y)
+                elif op == ASSIGN_OP:
+                    b = pop()
+                    push(ctx.assignOp(pop(), b, arg))
+                elif op == APPEND_STRING:
+                    b = pop()
+                    push(ctx.appendString(pop(), b))
+                elif op == FLATTEN:
+                    if type(stack[-1]) is StringBuilder:
+                        stack[-1] = stack[-1].flatten()
+                elif op == BINARY_BITWISE:
+                    b = toInt(pop())
+                    push(ctx.bitwiseOp(toInt(pop()), b, arg))
+                elif op == CASE_EQ:
+                    b = pop()
+                    push(pop() == b)
+                elif op == JUMP_TABLE:
+                    pc = caseIndex(consts[arg], pop(), pc)
+                elif op == LOAD_THIS:
+                    push(ctx.context)
+                elif op == LOAD_NULL:
+                    push(null)
+                elif op == UNARY_NOT:
+                    stack[-1] = not stack[-1]
+                elif op == UNARY_NEGATIVE:
+                    stack[-1] = -toNumber(stack[-1])
+                elif op == UNARY_POSITIVE:
+                    stack[-1] = +toNumber(stack[-1])
+                elif op == UNARY_INVERT:
+                    try:
+                        stack[-1] = ~toInt(stack[-1])
+                    except TypeError:
+                        stack[-1] = ~0
+                elif op == UNARY_TYPEOF:
+                    stack[-1] = typeof(stack[-1])
+                elif op == TYPEOF_GLOBAL:
+                    site = sites[arg]
+                    try:
+                        push(typeof(ctx.globalVar(site.value, site)))
+                    except ReferenceError:
+                        push("undefined")
+                elif op == BINARY_IN:
+                    b = pop()
+                    push(pop() in b)
+                elif op == BINARY_INSTANCEOF:
+                    b = pop()
+                    push(ctx.instanceOf(pop(), b))
+                elif op == BUILD_ARRAY:
+                    if arg:
+                        items = stack[-arg:]
+                        del stack[-arg:]
+                    else:
+                        items = ()
+                    push(array_proto(*items))
+                elif op == BUILD_OBJECT:
+                    keys = sites[arg].keys
+                    if keys:
+                        values = stack[-len(keys):]
+                        del stack[-len(keys):]
+                    else:
+                        values = ()
+                    push(object_literal(keys, values))
+                elif op == MAKE_FUNCTION:
+                    f = code.functions[arg]
+                    if f.node is None: push(function(ctx, f, f.runner))
+                    else: push(function(ctx, f, f.load))
+                elif op == MAKE_REGEXP:
+                    push(ctx.regexp(sites[arg]))
+                elif op == DECLARE_GLOBAL:
+                    site = sites[arg]
+                    ctx.declareVar(site.value, site)
+                elif op == DELETE_PROP:
+                    prop = pop()
+                    delattr(ctx.toObject(pop()), prop)
+                    push(undefined)
+                elif op == GET_ITER:
+                    stack[-1] = iter(stack[-1])
+                elif op == FOR_ITER:
+                    try:
+                        k, v = stack[-1].next()
+                        push(k)
+                    except StopIteration:
+                        pop()
+                        pc = arg
+                elif op == SETUP_TRY:
+                    handlers.append((arg, len(stack), ctx))
+                elif op == POP_TRY:
+                    handlers.pop()
+                elif op == ENTER_CATCH:
+                    ctx = JS_Context(context=ctx.context, parent=ctx,
+                                        frame=[pop()], names=sites[arg].names)
+                elif op == LEAVE_CATCH:
+                    ctx = ctx.parent
+                elif op == RAISE or op == RERAISE:
+                    raise pop()
+                elif op == RAISE_ERROR:
+                    site = sites[arg]
+                    ctx.err(getattr(interpr, site.error), site.value, site)
+                else:
+                    raise NotImplemented_("unknown opcode %s" % op)
+
+        except Exception, e:
+            # calls without handlers are left
+            while not handlers and calls:
+                base.depth[0] -= 1
+                if pushed: base.callStack.pop()
+                code, ops, args, consts, sites, lines, pc, stack, \
+                    handlers, base, ctx, pushed = calls.pop()
+                push = stack.append
+                pop = stack.pop
+                frame = ownFrame(ctx)
+            if not handlers: raise
+            pc, depth, ctx = handlers.pop()
+            del stack[depth:]
+            push(e)
+
+#
+# serialization
+#
+magic = "PJBC"
+version = 4
+
+# sites are saved as (type_, lineno, start, end, value, other attributes)
+siteAttrs = ("type_", "lineno", "start", "end", "value")
+
+def pack(code):
+    if code.node is not None: code.load()
+    sites = []
+    for site in code.sites:
+        other = dict([(k, v) for k, v in site.__dict__.iteritems()
+                        if k not in Site.transient and k not in siteAttrs])
+        sites.append(tuple([getattr(site, k) for k in siteAttrs]) +
+                     (other or None,))
+    return (code.name, code.params, code.scopeNames, code.lineno,
+            code.filename,
+            pyarray.array("B", code.ops).tostring(),
+            pyarray.array("i", code.args).tostring(),
+            pyarray.array("i", code.lines).tostring(),
+            tuple(code.consts), tuple(sites),
+            tuple([pack(f) for f in code.functions]))
+
+def unpack(data):
+    name, params, scopeNames, lineno, filename, ops, args, lines, \
+        consts, sites, functions = data
+    code = Code(name, params, scopeNames, lineno, filename)
+    code.ops = pyarray.array("B", ops).tolist()
+    code.args = pyarray.array("i", args).tolist()
+    code.lines = pyarray.array("i", lines).tolist()
+    code.consts = list(consts)
+    code.sites = []
+    for site in sites:
+        attrs = dict(zip(siteAttrs, site[:-1]))
+        attrs.update(site[-1] or {})
+        code.sites.append(Site(filename=filename, **attrs))
+    code.functions = [unpack(f) for f in functions]
+    return code
+
+def dumps(code):
+    """ serializes code into string
+    """
+    return magic + chr(version) + zlib.compress(marshal.dumps(pack(code)))
+
+def loads(data):
+    """ loads code serialized by dumps()
+    """
+    if data[:len(magic)] != magic or data[len(magic)] != chr(version):
+        raise ValueError("not a pyjon bytecode of version %i" % version)
+    return unpack(marshal.loads(zlib.decompress(data[len(magic) + 1:])))
+
+#
+# disassembler
+#
+def describe(code, op, arg):
+    if op in jumps:
+        return "to %i" % arg
+    elif op == LOAD_CONST:
+        return repr(code.consts[arg])
+    elif op == JUMP_TABLE:
+        return ", ".join(["%r to %i" % item
+                            for item in sorted(code.consts[arg].items())])
+    elif op in (LOAD_LOCAL, STORE_LOCAL):
+        return code.scopeNames[arg]
+    elif op in (LOAD_OUTER, STORE_OUTER):
+        return "depth %i, slot %i" % (arg >> 16, arg & 0xffff)
+    elif op in typeOps:
+        return arg and defs.tokenstr(arg) or ""
+    elif op in feedbackOps:
+        return defs.tokenstr(code.sites[arg].value)
+    elif op in (CALL_FUNCTION, CALL_METHOD):
+        site = code.sites[arg]
+        return "%s, %i args" % (defs.tokenstr(site.type_), site.argc)
+    elif op == BUILD_OBJECT:
+        return ", ".join(code.sites[arg].keys)
+    elif op in (GET_PROP, SET_PROP, DELETE_PROP, INC_PROP):
+        return ""
+    elif op in siteOps:
+        return str(code.sites[arg].value)
+    elif op == MAKE_FUNCTION:
+        return code.functions[arg].name or "anonymous"
+    elif op == BUILD_ARRAY:
+        return "%i items" % arg
+    return ""
+
+def dis(code):
+    """ returns listing of code and its nested functions
+    """
+    if code.node is not None: code.load()
+    out = []
+    out.append("%s(%s), line %i" % (code.name or "script",
+                                     ", ".join(code.params), code.lineno))
+    lineno = None
+    for i, (op, arg) in enumerate(zip(code.ops, code.args)):
+        line = code.lines[i] != lineno and "%4i" % code.lines[i] or "    "
+        lineno = code.lines[i]
+        out.append("%s %5i %-22s %s" % (line, i, opnames[op],
+                                         describe(code, op, arg)))
+    for f in code.functions:
+        out.append("")
+        out.append(dis(f))
+    return "\n".join(out)
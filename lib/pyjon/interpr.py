@@ -61,8 +61,6 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-# TODO use indeces for vars
-
 from __future__ import division, with_statement
 from functools import wraps
 from functools import partial
@@ -85,17 +83,17 @@ ChangeLog
  * Added JS methods parseInt, parseFloat, isNaN.
 """
 
-import re, math, operator
+import re, math, operator, itertools
 from ctypes import c_int
-import os, random
+import os, sys, random
 
-import defs, jsparser, lexer
+import defs, jsparser, lexer, resolver
 
 defs.map(globals())
 
 class JSError(Exception): 
     def __init__(self, message="", lineno=-1, 
-                    start=0, end=0, filename="", stack=[]):
+                    start=0, end=0, filename="", stack=""):
         Exception.__init__(self, message)
         self.fileName = filename
         self.lineNumber = lineno
@@ -129,9 +127,6 @@ SyntaxError_ = type("SyntaxError", (ECMAScriptError,), {})
 RangeError_ = type("RangeError", (ECMAScriptError,), {})
 class URIError(ECMAScriptError): pass
 
-class BreakOutOfLoops(Exception): pass
-class ContinueLoops(Exception): pass
-
 class Null():
     __int__ = lambda self: 0
     __nonzero__ = lambda self: False
@@ -169,50 +164,65 @@ isArray = lambda x: isinstance(x, array_proto)
 #
 # conversion routines
 #
-intRe = re.compile(r'^(-|\+)?\d+$')
-floatRe = re.compile(r'^(-|\+)?(\d+)?\.(\d+)$')
-shortFloatRe = re.compile(r'^(-|\+)?(\d+)\.(\d+)e\+(\d+)$')
-hexRe = re.compile(r'^(-|\+)?0x([0-9a-fA-F]+)$')
+# StrWhiteSpaceChar of ECMAScript, besides of ascii ones stripped by 
+# str.strip()
+whitespace = u"\xa0\u1680\u180e\u2000\u2001\u2002\u2003\u2004\u2005" \
+             u"\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f" \
+             u"\u3000\ufeff"
+
+# StrNumericLiteral of ECMAScript
+numberRe = re.compile(r"""
+    (?: (?P<sign>[+-])? 
+        (?: (?P<infinity>Infinity)
+          | (?:\d+\.?\d*|\.\d+) (?P<exponent>[eE][+-]?\d+)? )
+      | 0[xX](?P<hex>[0-9a-fA-F]+) 
+    )\Z""", re.VERBOSE)
+
+def stringToNumber(s):
+    """ StringToNumber of ECMAScript in one match, s is utf-8 encoded
+        or unicode string, integers are returned as ints
+    """
+    # digits are ascii only, unicode ones are not StrDecimalLiteral
+    if isinstance(s, unicode): s = ustr(s)
+    if s.isdigit(): return int(s)
+    s = s.strip()
+    if s and (s[0] >= "\x80" or s[-1] >= "\x80"):
+        try:
+            s = s.decode("utf-8").strip(whitespace).encode("utf-8")
+        except UnicodeError:
+            return nan
+    if s == "": return 0
+    m = numberRe.match(s)
+    if m is None: return nan
+    elif m.group("hex"): return int(m.group("hex"), 16)
+    elif m.group("infinity"): return m.group("sign") == "-" and -inf or inf
+    elif m.group("exponent") or "." in s: return float(s)
+    return int(s)
+
+# numbers of recently converted strings, emptied when it is full, long
+# strings are not kept
+numberCache = {}
+numberCacheSize = 1024
+numberCacheKeyLength = 32
 
 def toNumber(y):
+    # the most common types first, ints and floats need no conversion
+    t = type(y)
+    if t is int or t is float: return y
+    elif t is str:
+        x = numberCache.get(y)
+        if x is None:
+            x = stringToNumber(y)
+            if isinstance(x, long): x = float(x)
+            if len(y) <= numberCacheKeyLength:
+                if len(numberCache) >= numberCacheSize: numberCache.clear()
+                numberCache[y] = x
+        return x
+
     x = None
-    if x == 0: x = 0
-    elif isNumber(y): x = y
+    if isNumber(y): x = y
     elif isBoolean(y): x = int(y)
-    elif isString(y):
-        if y == "":
-            x = 0
-        else:
-            # there is some internal pythonic types like nan and +inf,-inf
-            # it may be passed in strings, so using regexp to check
-            m = re.match(intRe, y)
-            if m: x = int(y)
-            else:
-                m = re.match(floatRe, y)
-                if m: 
-                    x = float(y)
-                else:
-                    m = re.match(shortFloatRe, y)
-                    if m:
-                        x = float(y)
-                    else:
-                        m = re.match(hexRe, y)
-                        if m: x = int(y, 16)
-                        else:
-                            x = nan
-            """
-            try: 
-                x = int(y)
-            except ValueError:
-                try: 
-                    x = float(y)
-                except ValueError:
-                    try:
-                        if re.match(hexRe, y): x = int(y, 16)
-                        else: x = nan
-                    except ValueError: 
-                        x = nan
-            """
+    elif isString(y): x = stringToNumber(y)
     elif isNull(y):
         x = 0
     elif isObject(y):
@@ -303,6 +313,33 @@ def typeof(x):
     elif isXML(x): return 'xml' 
     else: return 'object'
 
+# index of the case of a switch with jump table (see optimizer), the 
+# table holds what == would match, default if the value is not there
+def caseIndex(table, value, default):
+    try:
+        return table.get(value, default)
+    except TypeError: # unhashable, e.g. arrays
+        return default
+
+# Local variables, which statements x += y append strings to, hold 
+# StringBuilder in place of the string (see resolver), so that building
+# up a string in a loop takes time linear in its length, not quadratic. 
+# Reads of the variable flatten the builder into the string.
+class StringBuilder(object):
+    __slots__ = ("parts",)
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def flatten(self):
+        parts = self.parts
+        if len(parts) > 1: parts[:] = ["".join(parts)]
+        return parts[0]
+
+def flat(x):
+    if type(x) is StringBuilder: return x.flatten()
+    return x
+
 # public function decorator
 def publicmethod(f):
     def call(this, context, *args):
@@ -315,9 +352,10 @@ def publicmethod(f):
     f.apply_ = apply_
     return staticmethod(f)
 
-def object_iter(obj):
+def object_iter(obj, items=None):
     # dictonary may change during iteration, if not copyed
-    for k, v in obj.__dict__.copy().iteritems():
+    if items is None: items = obj.__dict__.items()
+    for k, v in items:
         # pass some internal props
         if k in ("constructor", "__proto__"): continue
         elif k in illegal.values(): k = "__%s__" % k[2:-2]
@@ -386,32 +424,421 @@ class JS_Function(JS_Object):
     __str__ = lambda self: "function "+self.__python_class__.__name__+"(){[internal]}"
     __repr__ = lambda self: self.__python_class__.__name__
 
+#
+# Inline cache of property access
+#
+# Each DOT node gets a monomorphic cache, which remembers for the class 
+# of the object seen last time where the property has been found: in own 
+# dictonary of object, as class attribute or in dictonary of __proto__. 
+# While objects of the same class come, the property is read from there 
+# without getattr(), JS_Object.__getattribute__ and recursion of 
+# Prototype.__getattr__. Anything unusual (properties of python classes, 
+# __getattr__ tricks, prototype chains longer than one) is not cached and 
+# goes the usual way.
+#
+# Objects with a shape (see object_proto) are known by their shape as 
+# well, the cache remembers the index of an own property in the values 
+# and the same shape tells the property is not own when it was not. 
+# Writes remember the shape the object moves to when the property is 
+# added.
+#
+# Trees of the parse cache are run by several threads at once, so a cache
+# is never changed in place after it has been put on its node. It learns
+# on a copy, which then takes its place on the node (site).
+#
+rawattr = object.__getattribute__
+rawset = object.__setattr__
+# sentinel of failed lookup
+missing = object()
+# answered by __getattr__ of prototype classes, never cached
+specialProps = ("length", "constructor", "__proto__", "__isbool__")
+
+OWN, CLASS, PROTO, UNCACHED = range(4)
+
+def classAttr(cls, k):
+    for c in cls.__mro__:
+        if k in c.__dict__: return c.__dict__[k]
+    return missing
+
+def shapeOf(obj):
+    """ shape of obj, None if it keeps its properties in its __dict__
+    """
+    if isinstance(obj, object_proto):
+        shape = rawattr(obj, SHAPE)
+        if shape is not dictShape: return shape
+    return None
+
+class InlineCache(object):
+    def __init__(self, prop, site=None):
+        self.prop = prop
+        self.site = site
+        self.cls = None
+        self.kind = UNCACHED
+        self.value = None
+        self.holder = None
+        # shape of the object and index in its values of the property 
+        # (OWN) or of __proto__ (PROTO), shape and index of the property
+        # in the holder
+        self.shape = None
+        self.index = None
+        self.holderShape = None
+        self.holderIndex = None
+        # shape of the object before and after a write, index written
+        self.setCls = None
+        self.setShape = None
+        self.setNext = None
+        self.setIndex = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, obj):
+        """ returns property of obj or missing, if the cache doesn't know
+        """
+        if type(obj) is self.cls:
+            kind = self.kind
+            shape = self.shape
+            if shape is not None:
+                if rawattr(obj, SHAPE) is shape:
+                    if kind == OWN:
+                        self.hits += 1
+                        return rawattr(obj, VALUES)[self.index]
+                    elif kind == CLASS:
+                        self.hits += 1
+                        return self.value
+                    # assigning an own __proto__ changes the shape
+                    elif kind == PROTO and (self.index is None or 
+                            rawattr(obj, VALUES)[self.index] is self.holder):
+                        value = self.fromHolder()
+                        if value is not missing:
+                            self.hits += 1
+                            return value
+            elif kind == UNCACHED:
+                self.misses += 1
+                return missing
+            else:
+                prop = self.prop
+                d = rawattr(obj, "__dict__")
+                if kind == OWN:
+                    if prop in d:
+                        self.hits += 1
+                        return d[prop]
+                elif prop not in d:
+                    if kind == CLASS:
+                        self.hits += 1
+                        return self.value
+                    # __proto__ may be assigned since, into the dictonary
+                    proto = d.get("__proto__", missing)
+                    if proto is missing:
+                        proto = getattr(obj, "__proto__", None)
+                    if proto is self.holder:
+                        value = self.fromHolder()
+                        if value is not missing:
+                            self.hits += 1
+                            return value
+        self.misses += 1
+        ic = self.copy()
+        value = ic.learn(obj)
+        ic.publish()
+        return value
+
+    def copy(self):
+        ic = object.__new__(InlineCache)
+        ic.__dict__.update(self.__dict__)
+        return ic
+
+    def publish(self):
+        if self.site is not None: self.site.ic = self
+
+    def fromHolder(self):
+        holder = self.holder
+        if self.holderShape is None:
+            return rawattr(holder, "__dict__").get(self.prop, missing)
+        elif rawattr(holder, SHAPE) is self.holderShape:
+            return rawattr(holder, VALUES)[self.holderIndex]
+        return missing
+
+    def learn(self, obj):
+        cls = type(obj)
+        prop = self.prop
+        if not isinstance(obj, JS_Object): 
+            return missing
+        self.cls = cls
+        self.kind = UNCACHED
+        shape = self.shape = shapeOf(obj)
+        if shape is None and isinstance(obj, object_proto):
+            # other objects of the class have shapes, dictShape is not cached
+            self.shape = dictShape
+            return missing
+        if shape is None:
+            d = rawattr(obj, "__dict__")
+            own = prop in d
+        else:
+            own = prop in shape.index
+        attr = classAttr(cls, prop)
+        if attr is not missing:
+            if hasattr(type(attr), "__set__"): 
+                return missing
+            elif own:
+                return self.learnOwn(obj)
+            elif isinstance(attr, staticmethod):
+                self.value = attr.__get__(None, cls)
+            elif not hasattr(attr, "__get__"):
+                self.value = attr
+            else:
+                return missing
+            self.kind = CLASS
+            return self.value
+        elif own:
+            return self.learnOwn(obj)
+        elif prop in specialProps:
+            return missing
+
+        if shape is not None:
+            self.index = shape.index.get("__proto__")
+        try:
+            holder = getattr(obj, "__proto__")
+        except AttributeError:
+            return missing
+        if holder is obj or not isinstance(holder, JS_Object):
+            return missing
+        holderShape = self.holderShape = shapeOf(holder)
+        if holderShape is None:
+            hd = rawattr(holder, "__dict__")
+            if prop not in hd: return missing
+            value = hd[prop]
+        else:
+            self.holderIndex = holderShape.index.get(prop)
+            if self.holderIndex is None: return missing
+            value = rawattr(holder, VALUES)[self.holderIndex]
+        if classAttr(type(holder), prop) is missing:
+            self.kind = PROTO
+            self.holder = holder
+            return value
+        return missing
+
+    def learnOwn(self, obj):
+        self.kind = OWN
+        if self.shape is None:
+            return rawattr(obj, "__dict__")[self.prop]
+        self.index = self.shape.index[self.prop]
+        return rawattr(obj, VALUES)[self.index]
+
+    def set(self, obj, value):
+        """ sets property of obj, returns False if the cache doesn't know 
+            how to do it
+        """
+        cls = type(obj)
+        if cls is self.setCls:
+            shape = self.setShape
+            if shape is None:
+                self.hits += 1
+                rawattr(obj, "__dict__")[self.prop] = value
+                return True
+            elif rawattr(obj, SHAPE) is shape:
+                self.hits += 1
+                if self.setNext is None:
+                    rawattr(obj, VALUES)[self.setIndex] = value
+                else:
+                    rawattr(obj, VALUES).append(value)
+                    rawset(obj, SHAPE, self.setNext)
+                return True
+        self.misses += 1
+        ic = self.copy()
+        done = ic.learnSet(obj, value)
+        ic.publish()
+        return done
+
+    def learnSet(self, obj, value):
+        cls = type(obj)
+        if not isinstance(obj, JS_Object) \
+            or cls.__setattr__.im_func not in (JS_Object.__setattr__.im_func,
+                                        object_proto.__setattr__.im_func) \
+            or self.prop in interns or self.prop in illegal \
+            or hasattr(type(classAttr(cls, self.prop)), "__set__"):
+            self.setCls = None
+            return False
+        self.setCls = cls
+        shape = self.setShape = shapeOf(obj)
+        if shape is None and isinstance(obj, object_proto):
+            self.setCls = None
+            return False
+        elif shape is None:
+            rawattr(obj, "__dict__")[self.prop] = value
+        else:
+            setattr(obj, self.prop, value)
+            after = shapeOf(obj)
+            if after is None:
+                self.setCls = None
+            else:
+                self.setNext = after is not shape and after or None
+                self.setIndex = after.index[self.prop]
+        return True
+
+    __repr__ = lambda self: "<InlineCache %s %i/%i>" % (self.prop, 
+                                                    self.hits, self.misses)
+
+def inlineCacheStats(n):
+    """ sums hits and misses of the inline caches in tree n
+    """
+    stats = dict(caches=0, hits=0, misses=0)
+    def walk(n):
+        if isNull(n) or isUndefined(n) or isString(n) or isNumber(n): return
+        ic = getattr(n, "ic", None)
+        if ic is not None:
+            stats["caches"] += 1
+            stats["hits"] += ic.hits
+            stats["misses"] += ic.misses
+        for x in resolver.children(n):
+            walk(x)
+    walk(n)
+    return stats
+
+#
+# Type feedback of arithmetic and comparison
+#
+# Each PLUS, MINUS, MUL, DIV, MOD and comparison node remembers the type 
+# of operands it has seen. While both are ints or both are floats, the 
+# python operator is applied directly, which gives the same result as 
+# arithm() and compareOp() do for them, without isString(), toNumber() 
+# and dispatch on the operator. When other types come, the node turns 
+# generic and goes the usual way without testing types again. Some fast 
+# operations hold for part of the values only (MUL of ints overflowing, 
+# DIV by zero, MOD of negative numbers), they return missing for the rest.
+#
+def mulInt(x, y):
+    z = x * y
+    if type(z) is int: return z
+    return missing
+
+def divide(x, y):
+    if y: return x / y
+    return missing
+
+def modPositive(x, y):
+    if x >= 0 and y > 0: return x % y
+    return missing
+
+fastOps = {}
+for t in (int, float):
+    fastOps.update({
+        (t, PLUS): operator.add, (t, MINUS): operator.sub, 
+        (t, MUL): t is int and mulInt or operator.mul, 
+        (t, DIV): divide, (t, MOD): modPositive,
+        (t, LT): operator.lt, (t, LE): operator.le, 
+        (t, GT): operator.gt, (t, GE): operator.ge,
+        (t, EQ): operator.eq, (t, STRICT_EQ): operator.eq,
+        (t, NE): operator.ne, (t, STRICT_NE): operator.ne,
+    })
+del t
+
+class TypeFeedback(object):
+    def __init__(self, op):
+        self.op = op
+        # int or float while specialized, None until the first run and
+        # False when generic
+        self.type = None
+        self.fast = None
+
+    def miss(self, x, y):
+        """ notes operands not matching the type
+        """
+        t = type(x)
+        if self.type is None and type(y) is t and (t, self.op) in fastOps:
+            # the operation goes first, others may read it once type is set
+            self.fast = fastOps[t, self.op]
+            self.type = t
+        else:
+            self.type = False
+
+    __repr__ = lambda self: "<TypeFeedback %s %s>" % (defs.tokenstr(self.op),
+                                    self.type and self.type.__name__ or 
+                                    (self.type is False and "generic" or ""))
+
+def typeFeedbackStats(n):
+    """ counts nodes of tree n by the type of their feedback
+    """
+    stats = dict(int=0, float=0, generic=0)
+    def walk(n):
+        if isNull(n) or isUndefined(n) or isString(n) or isNumber(n): return
+        feedback = getattr(n, "feedback", None)
+        if feedback is not None and feedback.type is not None:
+            stats[feedback.type and feedback.type.__name__ or "generic"] += 1
+        for x in resolver.children(n):
+            walk(x)
+    walk(n)
+    return stats
+
 # 
 # JS_Context
 #
+# Number of JS calls nesting at most in a script, unless PyJS is given
+# another maxDepth
+defaultMaxDepth = 10000
+
 class JS_Context(object):
-    def __init__(self, context=None, parent=None, scope=None, caller=None):
+    # a context is made for every call, its attributes are in slots rather
+    # than in a __dict__ per context
+    __slots__ = ("scope", "frame", "names", "context", "returnValue", 
+                 "completion", "parent", "globals", "root_context", 
+                 "js_objects", "strict", "callStack", "stackMode", "depth", 
+                 "maxDepth", "caller", "pushed")
+
+    def __init__(self, context=None, parent=None, scope=None, caller=None,
+                    frame=None, names=None):
         if scope == None:
             self.scope = {}
         else:
             self.scope = scope
-        self.stack = []
+        # local variables of function or catch clause, indexed by slots 
+        # given by resolver, names is the layout of frame
+        self.frame = frame
+        self.names = names
         self.context = context
+        # return value of function
         self.returnValue = None
+        # BREAK, CONTINUE or RETURN when the last statement completed 
+        # abruptly, the rest of the statements is skipped up to the loop or
+        # the function call, which resets it
+        self.completion = None
         if parent:
             self.parent = parent
             self.globals = parent.globals
             self.root_context = parent.root_context
             self.js_objects = parent.js_objects
             self.strict = parent.strict
+            self.callStack = parent.callStack
+            self.stackMode = parent.stackMode
+            self.depth = parent.depth
+            self.maxDepth = parent.maxDepth
+            self.pushed = parent.pushed
         else:
             self.parent = None
             self.root_context = self
+            self.strict = False
+            # Call stack for stack traces of errors, frames are [function 
+            # name, file name, line number] shared by all the contexts of 
+            # the script. Functions push frame on call and pop it on return,
+            # line number is the line of the call made from the frame 
+            # ("functions" mode) or the line being executed ("full" mode), 
+            # nothing is tracked when "off". Frames deeper than maxStack are
+            # not recorded, pushed tells whether the function running put 
+            # its frame there, lines are tracked only then (see 
+            # ownFrame()).
+            self.callStack = [["", "", 0]]
+            self.pushed = True
+            self.stackMode = "functions"
+            # Number of JS calls in progress, in a list shared by all the 
+            # contexts of the script, calls nesting deeper than maxDepth 
+            # raise RangeError. The tree walker and the closure compiler 
+            # take several python frames per call and may reach the 
+            # recursion limit of python first, which raises RangeError as 
+            # well, the VM runs nested calls of its functions in one loop 
+            # (see bytecode.run) and reaches maxDepth.
+            self.depth = [0]
+            self.maxDepth = defaultMaxDepth
         self.caller = caller
 
-    strict = False
-    # return value of function
-    returnValue = None
+    maxStack = 100
 
     def exec_(self, n):
         #print n
@@ -422,7 +849,8 @@ class JS_Context(object):
 
         #print n.type, n.lineno
         t = n.type_
-        self.stack.append([t, n.lineno])
+        if self.stackMode == "full" and self.pushed: 
+            self.callStack[-1][2] = n.lineno
         try:
             if t == NUMBER: return toNumber(n.value)
             elif t == STRING: return n.value
@@ -439,19 +867,17 @@ class JS_Context(object):
 
             elif n.type_ in (VAR, LET, CONST):
                 for x in n:
-                    self.initVar(x.value, self.exec_(getattr(x, 'initializer', undefined)))
+                    if hasattr(x, 'initializer'):
+                        self.initVar(x.value, self.exec_(x.initializer), x)
+                    else:
+                        self.declareVar(x.value, x)
                 return None
 
             elif t == UNARY_PLUS: return +toNumber(self.exec_(n[0]))
             elif t == UNARY_MINUS: return -toNumber(self.exec_(n[0]))
             elif t in (PLUS, MINUS, DIV, MUL, MOD): 
-                a = self.exec_(n[0])
-                b = self.exec_(n[1])
-                #print t, a, b
-                if t == PLUS and (isString(a) or isString(b)):
-                    return str_(a) + str_(b)
-                else:
-                    return self.arithmOp(toNumber(a), toNumber(b), t)
+                return self.binary(self.exec_(n[0]), self.exec_(n[1]), n,
+                                    self.arithm)
 
             elif t == BITWISE_NOT:
                 try: 
@@ -473,6 +899,7 @@ class JS_Context(object):
             elif t == SCRIPT: 
                 for x in n:
                     self.exec_(x)
+                    if self.completion: break
 
             elif t == GROUP: 
                 return self.exec_(n[0])
@@ -481,15 +908,16 @@ class JS_Context(object):
                 last = undefined
                 for x in n: 
                     last = self.exec_(x)
+                    if self.completion: break
                 return last
 
             elif t == ARRAY_INIT: 
                 return array_proto(*[self.exec_(x) for x in n])
 
             elif t == OBJECT_INIT: 
-                kwargs = dict([[ustr(x[0].value), self.exec_(x[1])]
-                    for x in n if x.type_ == PROPERTY_INIT])
-                return object_proto(**kwargs)
+                props = [x for x in n if x.type_ == PROPERTY_INIT]
+                return object_literal(tuple([ustr(x[0].value) for x in props]),
+                                      [self.exec_(x[1]) for x in props])
 
             elif t in (DOT, INDEX): return self.get_(n)
             elif t == FUNCTION: return self.funDef(n)
@@ -498,32 +926,26 @@ class JS_Context(object):
             elif t in (NEW, NEW_WITH_ARGS, CALL): 
                 #print n
                 if n[0].type_ in (DOT, INDEX):
-                    this = self.object(n[0])
-
-                fun = self.exec_(n[0])
+                    # evaluate the object once, it is both `this` and 
+                    # the holder of the method
+                    this = self.exec_(n[0][0])
+                    fun = self.getProperty(this, self.property(n[0]), n[0])
+                else:
+                    fun = self.exec_(n[0])
 
                 if t in (NEW_WITH_ARGS, CALL):
                     args = [self.exec_(x) for x in n[1]]
-
-                if callable(fun):
-                    if hasattr(fun, "caller"):
-                        setattr(fun, "caller", self.caller)
-                    if t == NEW:
-                        return fun.__newInstance__()
-                    elif t == NEW_WITH_ARGS:
-                        return fun.__newInstance__(*args)
-                    else:
-                        return fun(this, *args)
                 else:
-                    self.err(TypeError_, "%s is not a function" % str_(fun), n)
+                    args = ()
+
+                return self.call(fun, this, args, t, n)
 
             elif t == RETURN: 
                 self.returnValue = self.exec_(n.value)
-                raise BreakOutOfLoops
+                self.completion = RETURN
 
             elif t == FOR_IN: 
-                self.for_in(ustr(n.iterator.value), 
-                                self.exec_(n.object), n.body)
+                self.for_in(n.iterator, self.exec_(n.object), n.body)
 
             elif t == FOR: 
                 self.for_(n.setup, n.condition, n.update, n.body)
@@ -532,29 +954,33 @@ class JS_Context(object):
                 self.while_(n.condition, n.body)
 
             elif t == BREAK: 
-                raise BreakOutOfLoops
+                self.completion = BREAK
 
             elif t == CONTINUE: 
-                raise ContinueLoops
+                self.completion = CONTINUE
 
             elif t == SWITCH: 
-                i = 0
                 desc = self.exec_(n.discriminant)
-                fall = False
-                try:
+                start = n.defaultIndex
+                table = getattr(n, "jumpTable", None)
+                if table is not None:
+                    start = caseIndex(table, desc, start)
+                else:
+                    i = 0
                     for case in n.cases:
                         if case.type_ == CASE:
                             if desc == self.exec_(case.caseLabel):
-                                fall = True
-
-                        if fall:
-                            for x in case.statements:
-                                self.exec_(x)
+                                start = i
+                                break
                         i += 1
 
-                except BreakOutOfLoops: 
-                    # raise again if function context
-                    if self.caller: raise
+                for case in start >= 0 and n.cases[start:] or ():
+                    for x in case.statements:
+                        self.exec_(x)
+                        if self.completion: break
+                    if self.completion:
+                        if self.completion == BREAK: self.completion = None
+                        break
 
             elif t == HOOK: 
                 if self.compare(n[0]):
@@ -569,29 +995,30 @@ class JS_Context(object):
                 try:
                     self.exec_(n.tryBlock)
                 except Exception, e:
+                    if not n.catchClauses: raise
                     for catch in n.catchClauses:
-                        ctx = JS_Context( parent=self )
-                        varName = catch.varName
-                        if varName:
-                            ctx.scope[varName] = e
+                        ctx = JS_Context( context=self.context, parent=self,
+                                          frame=[e], names=catch.scopeNames )
                         ctx.exec_(catch.block)
+                        self.complete(ctx)
                 finally:
                     if hasattr(n, "finallyBlock"):
-                        self.exec_(n.finallyBlock)
+                        self.finally_(n.finallyBlock)
 
             elif t == THROW: 
                 raise self.exec_(n.exception)
 
-            elif t == DECREMENT: 
+            elif t in (INCREMENT, DECREMENT): 
                 x = self.get_(n[0])
-                self.assign(n[0], x+1)
-                return x
-
-            elif t == INCREMENT:
-                x = self.get_(n[0])
-                y = 1
-                self.assign(n[0], self.assignOp(x, 1, PLUS))
-                return x
+                if type(x) is int:
+                    if t == INCREMENT: y = x + 1
+                    else: y = x - 1
+                else:
+                    x = toNumber(x)
+                    y = self.arithmOp(x, 1, t == INCREMENT and PLUS or MINUS)
+                self.assign(n[0], y)
+                if getattr(n, "postfix", False): return x
+                return y
 
             elif t == IF: 
                 if self.compare(n.condition):
@@ -634,14 +1061,8 @@ class JS_Context(object):
                     else:
                         raise
 
-            # FIXME it must walk on all __proto__ chain
             elif t == INSTANCEOF: 
-                inst = self.exec_(n[0])
-                obj = self.exec_(n[1])
-                if isinstance(inst, bool): return obj == boolean
-                elif isinstance(inst, (int, float)): return obj == number
-                elif isinstance(inst, str): return obj == string
-                return inst.__proto__ == obj.prototype
+                return self.instanceOf(self.exec_(n[0]), self.exec_(n[1]))
 
             elif t == HEADER:
                 pass
@@ -657,9 +1078,6 @@ class JS_Context(object):
             else:
                 self.err(NotImplemented_, n.type, n)
 
-        except (BreakOutOfLoops, ContinueLoops), ex: 
-            raise
-
         except (TypeError_, ReferenceError, NotImplemented_), ex:
             raise
 
@@ -674,57 +1092,74 @@ class JS_Context(object):
 
         if tt == IDENTIFIER:
             k = ustr(leftExpr.value)
-            ctx = self
-            while ctx:
-                if k in ctx.scope: break
-                ctx = ctx.parent
-            else:
-                ctx = self.root_context
 
-            if assignOp:
+            if assignOp == PLUS and getattr(leftExpr, "builder", False):
+                # the builder is taken from the frame as it is
+                depth, i = leftExpr.slot
+                ctx = self
+                while depth:
+                    ctx = ctx.parent
+                    depth -= 1
+                y = self.exec_(rightExpr)
+                ctx.frame[i] = self.appendString(ctx.frame[i], y)
+                return undefined
+
+            elif assignOp:
                 x = self.var(k, leftExpr)
                 y = self.exec_(rightExpr)
-                #self.scope[k] = self.assignOp(x, y, assignOp)
-                #value = self.assign(k, self.assignOp(x, y, assignOp))
-                ctx.scope[k] = self.assignOp(x, y, assignOp)
+                value = self.assignOp(x, y, assignOp)
 
             else:
-                #self.scope[k] = self.exec_(rightExpr)
-                #value = self.assign(k, self.exec_(rightExpr))
-                ctx.scope[k] = self.exec_(rightExpr)
+                value = self.exec_(rightExpr)
 
-            return ctx.scope[k]
+            return self.setVar(k, value, leftExpr)
 
         elif tt in (DOT, INDEX):
             obj = self.object(leftExpr)
             prop = self.property(leftExpr)
-            if isUndefined(obj) or isNull(obj):
-                self.err(TypeError_, "cannot set property "
-                            "%r of %s" % (prop, str_(obj)), n)
-            val = self.exec_(rightExpr)
-            if assignOp: 
-                if tt == DOT:
-                    try:
-                        x = getattr(obj, prop)
-                    except AttributeError, e:
-                        x = undefined
-                        defs.err("WARNING: undefined attribute " + prop)
-                        #self.undefPropErr(prop, n)
-                else:  # INDEX
-                    try:
-                        x = operator.getitem(obj, prop)
-                    except (IndexError, AttributeError), e:
-                        x = undefined
-                        defs.err("WARNING: undefined index " + prop)
-                        #self.undefPropErr(prop, n)
-                val = self.assignOp(x, val, assignOp)
+            return self.setProperty(obj, prop, self.exec_(rightExpr), 
+                                        leftExpr, assignOp)
 
+    # set property of an object, n is DOT or INDEX node
+    #
+    def setProperty(self, obj, prop, val, n, assignOp=None):
+        tt = n.type_
+        if isUndefined(obj) or isNull(obj):
+            self.err(TypeError_, "cannot set property "
+                        "%r of %s" % (prop, str_(obj)), n)
+        if assignOp: 
             if tt == DOT:
+                try:
+                    x = getattr(obj, prop)
+                except AttributeError, e:
+                    x = undefined
+                    defs.err("WARNING: undefined attribute " + prop)
+                    #self.undefPropErr(prop, n)
+            else:  # INDEX
+                try:
+                    x = operator.getitem(obj, prop)
+                except (IndexError, AttributeError), e:
+                    x = undefined
+                    defs.err("WARNING: undefined index " + str_(prop))
+                    #self.undefPropErr(prop, n)
+            val = self.assignOp(x, val, assignOp)
+
+        if tt == DOT:
+            ic = getattr(n, "ic", None) or self.inlineCache(prop, n)
+            if not ic.set(obj, val):
                 setattr(obj, prop, val)
-            else:
-                operator.setitem(obj, prop, val)
+        else:
+            operator.setitem(obj, prop, val)
+
+        return val
 
-            return val
+    # inline cache of DOT node n (see InlineCache)
+    #
+    def inlineCache(self, prop, n):
+        prop = str_(prop)
+        if prop in illegal: prop = illegal[prop]
+        n.ic = InlineCache(prop, n)
+        return n.ic
 
     # get identifier or object property
     #
@@ -733,33 +1168,72 @@ class JS_Context(object):
             return self.var(ustr(n.value), n)
 
         else: # => t in (DOT, INDEX)
-            obj = self.object(n)
-            prop = self.property(n)
-
-            if isNull(obj) or isUndefined(obj):
-                self.err(TypeError_, "cannot read property "
-                          "%r of %s" % (getattr(prop, 'value', prop), str_(obj)), n)
+            return self.getProperty(self.exec_(n[0]), self.property(n), n)
 
-            #res = getattr(obj, str_(prop), undefined)
-            if n.type_ == DOT:
+    # get property of an object, n is DOT or INDEX node
+    #
+    def getProperty(self, obj, prop, n):
+        if isNull(obj) or isUndefined(obj):
+            self.err(TypeError_, "cannot read property "
+                      "%r of %s" % (getattr(prop, 'value', prop), str_(obj)), n)
+
+        # length of strings and arrays is read without attribute lookup
+        if prop == 'length' and isinstance(obj, (str, list, arguments)):
+            return len(obj)
+
+        # primitive values are not boxed, their properties are read 
+        # from the shared prototype
+        if not isObject(obj):
+            proto = primitiveProto(obj)
+            if proto is not None:
+                if isString(obj) and isInt(prop) and not isBoolean(prop):
+                    if 0 <= prop < len(obj): return obj[prop]
+                    return undefined
                 try:
-                    #print "get()", obj, str_(prop)
-                    prop = str_(prop)
-                    if prop in illegal: prop = illegal[prop]
-                    res = getattr(obj, prop)
+                    return getattr(proto, str_(prop))
                 except AttributeError, e:
-                    res = undefined
-                    #self.undefPropErr(prop, n)
-            else: # INDEX
-                try:
-                    res = operator.getitem(obj, prop)
-                except (IndexError, AttributeError), e:
-                    res = undefined
-                    #self.undefPropErr(prop, n)
-                except Exception, e:
-                    self.err(TypeError_, e, n)
+                    return undefined
 
-            return res
+        #res = getattr(obj, str_(prop), undefined)
+        if n.type_ == DOT:
+            ic = getattr(n, "ic", None) or self.inlineCache(prop, n)
+            res = ic.get(obj)
+            if res is not missing: return res
+            try:
+                #print "get()", obj, str_(prop)
+                res = getattr(obj, ic.prop)
+            except AttributeError, e:
+                res = undefined
+                #self.undefPropErr(prop, n)
+        else: # INDEX
+            try:
+                res = operator.getitem(obj, prop)
+            except (IndexError, AttributeError), e:
+                res = undefined
+                #self.undefPropErr(prop, n)
+            except Exception, e:
+                self.err(TypeError_, e, n)
+
+        return res
+
+    # call function or construct new object, t is CALL, NEW or NEW_WITH_ARGS
+    #
+    def call(self, fun, this, args, t, n):
+        if self.stackMode == "functions" and self.pushed: 
+            self.callStack[-1][2] = n.lineno
+        if callable(fun):
+            if type(fun) is js_function:
+                rawset(fun, "caller", self.caller)
+            elif hasattr(fun, "caller"):
+                setattr(fun, "caller", self.caller)
+            if t == NEW:
+                return fun.__newInstance__()
+            elif t == NEW_WITH_ARGS:
+                return fun.__newInstance__(*args)
+            else:
+                return fun(this, *args)
+        else:
+            self.err(TypeError_, "%s is not a function" % str_(fun), n)
 
 
     # build actual scope
@@ -774,16 +1248,48 @@ class JS_Context(object):
         branch.reverse()
         for p in branch:
             scope.update(p.scope)
+            if p.frame: 
+                scope.update(zip(p.names, map(flat, p.frame)))
         return scope
 
     def __getitem__(self, k):
         return self.actualScope().get(k)
 
-    # get variable from scope or global object
+    # get variable from frame by its slot or from global object
     #
     def var(self, var, n):
+        slot = getattr(n, "slot", None)
+        if slot:
+            depth, i = slot
+            ctx = self
+            while depth:
+                ctx = ctx.parent
+                depth -= 1
+            value = ctx.frame[i]
+            if type(value) is StringBuilder: return value.flatten()
+            return value
+        return self.globalVar(var, n)
+
+    # set variable in frame by its slot or in global object
+    #
+    def setVar(self, var, value, n=None):
+        slot = getattr(n, "slot", None)
+        if slot:
+            depth, i = slot
+            ctx = self
+            while depth:
+                ctx = ctx.parent
+                depth -= 1
+            ctx.frame[i] = value
+        else:
+            self.root_context.scope[var] = value
+        return value
+
+    # get global variable or built-in object
+    #
+    def globalVar(self, var, n):
         value = None
-        scope = self.actualScope()
+        scope = self.root_context.scope
 
         if var in scope:
             value = scope[var]
@@ -812,19 +1318,22 @@ class JS_Context(object):
         """ returns object from INDEX and DOT nodes 
             or build new from prototype for certain types
         """ 
-        obj = self.exec_(n[0])
+        return self.toObject(self.exec_(n[0]))
+
+    # box primitive value
+    #
+    def toObject(self, obj):
         if isObject(obj): return obj
-        # FIXME this is stupid, no need to build temp object every time, 
-        # it's just required to return prototype object, but prototype
-        # must be read-only, so that no properties can be assigned or
-        # deleted
-        elif isBoolean(obj): return bool_proto()
+        # properties are read from primitives without boxing (see 
+        # getProperty), this is left for assignment and delete, which 
+        # change the temporary object only
+        elif isBoolean(obj): return bool_proto(obj)
         elif isNumber(obj) or isInfinity(obj) or isNaN(obj): 
             return number_proto(obj)
         elif isString(obj): return string_proto(obj)
         return obj
 
-    # get property of an given object
+    # get property name of DOT and INDEX nodes
     #
     def property(self, n):
         if n.type_ == INDEX:
@@ -835,6 +1344,24 @@ class JS_Context(object):
             else:
                 raise NotImplemented_, str(n[1].type)
 
+    # binary +, -, *, / and % on JS values
+    #
+    def arithm(self, a, b, op):
+        if op == PLUS and (isString(a) or isString(b)):
+            return str_(a) + str_(b)
+        return self.arithmOp(toNumber(a), toNumber(b), op)
+
+    # x + y of statement x += y, which keeps StringBuilder in x while 
+    # strings are appended
+    def appendString(self, x, y):
+        if type(x) is StringBuilder:
+            if type(y) is str: x.parts.append(y)
+            else: x.parts.append(str_(y))
+            return x
+        elif isString(x) or isString(y):
+            return StringBuilder([str_(x), str_(y)])
+        return self.assignOp(x, y, PLUS)
+
     # arithmetic operations
     #
     def arithmOp(self, x, y, op):
@@ -911,16 +1438,14 @@ class JS_Context(object):
         else:
             return self.arithmOp(x, y, op)
 
-    def funDef(self, f):
+    def funDef(self, f, code=None):
         #args = id(self.this) == id(self.globals) and [self.this] or []
         #print "funDef()", id(self.this) == id(self.globals)
-        fun = function(self, f)
+        fun = function(self, f, code)
         if f.functionForm == 0:
             #self.scope[f.name] = fun
             #return self.assign(ustr(f.name), fun, local=True)
-            fname = ustr(f.name)
-            self.scope[fname] = fun
-            return self.scope[fname]
+            return self.setVar(ustr(f.name), fun, f)
         return fun
 
     def classDef(self, c):
@@ -932,42 +1457,57 @@ class JS_Context(object):
             return self.scope[cname ]
         return cls
 
-    def initVar(self, var, value):
-        if id(self) == id(self.root_context):
-            self.globals[var] = value
-        else:
-            self.scope[var] = value
+    def initVar(self, var, value, n=None):
+        self.setVar(ustr(var), value, n)
+
+    # var without initializer, it is undefined if not yet defined
+    def declareVar(self, var, n=None):
+        var = ustr(var)
+        if not getattr(n, "slot", None) and var not in self.root_context.scope:
+            self.root_context.scope[var] = undefined
+
+    # completion of loop body, returns True if the loop is to be left
+    def leaveLoop(self):
+        completion = self.completion
+        if completion == RETURN: return True
+        self.completion = None
+        return completion == BREAK
+
+    # takes over completion of catch clause context
+    def complete(self, ctx):
+        if ctx.completion:
+            self.completion = ctx.completion
+            self.returnValue = ctx.returnValue
+
+    # finally block runs even if try block completed abruptly, the 
+    # completion holds unless finally block completes abruptly by itself
+    def finally_(self, block, code=None):
+        completion, self.completion = self.completion, None
+        returnValue = self.returnValue
+        if code: code(self)
+        else: self.exec_(block)
+        if not self.completion:
+            self.completion = completion
+            self.returnValue = returnValue
 
     def while_(self, cond, body):
         while self.compare(cond):
-            try: 
-                self.exec_(body)
-            except BreakOutOfLoops, e: break
-            except ContinueLoops, e: 
-                self.exec_(cond)
-                continue
-            except Exception: raise
+            self.exec_(body)
+            if self.completion and self.leaveLoop(): break
 
     def for_(self, setup, cond, update, body):
         self.exec_(setup)
-        while self.compare(cond):
-            try:
-                self.exec_(body)
-                self.exec_(update)
-            except BreakOutOfLoops, e: break
-            except ContinueLoops, e: 
-                self.exec_(update)
-                continue
-            except Exception: raise
+        while cond is None or self.compare(cond):
+            self.exec_(body)
+            if self.completion and self.leaveLoop(): break
+            self.exec_(update)
 
     def for_in(self, iterator, object_, body):
+        name = ustr(iterator.value)
         for k, v in object_:
-            try:
-                self.scope[iterator] = k
-                self.exec_(body)
-            except BreakOutOfLoops, e: break
-            except ContinueLoops, e: continue
-            except Exception: raise
+            self.setVar(name, k, iterator)
+            self.exec_(body)
+            if self.completion and self.leaveLoop(): break
 
     def compare(self, n):
         #print "compare()", n
@@ -975,50 +1515,66 @@ class JS_Context(object):
         t = n.type_
         if t in (GT, LT, EQ, NE, GE, LE, 
                 STRICT_EQ, STRICT_NE):
-            a = self.exec_(n[0])
-            b = self.exec_(n[1])
-            # reflect javascript behavior
-            #
-            if isNaN(a) and isNaN(b):
-                return t in (NE, STRICT_NE)
-            elif isNull(a) or isNull(b):
-                if t in (EQ, STRICT_EQ):
-                    return isNull(a) and isNull(b)
-                elif t in (NE, STRICT_NE):
-                    return not (isNull(a) and isNull(b))
-                a = toNumber(a)
-                b = toNumber(b)
-            elif isObject(a) and isObject(b):
-                #print a, b
-                if t in (STRICT_EQ, EQ):
-                    return id(a) == id(b)
-                elif t in (STRICT_NE, NE):
-                    return id(a) != id(b)
-                else:
-                    x = object_prio(a)
-                    y = object_prio(b)
-                    if (isNumber(a) or isNumber(b) \
-                            or isBoolean(a) or isBoolean(b)) and x != y:
-                        a = toNumber(a)
-                        b = toNumber(b)
-                    elif x == y:
-                        a = str_(a)
-                        b = str_(b)
-                    else:
-                        a = x
-                        b = y
-                    #print a, b, x, y
-            elif t not in (STRICT_EQ, STRICT_NE):
-                if isNumber(a) or isNumber(b) \
-                        or isBoolean(a) or isBoolean(b):
+            return self.binary(self.exec_(n[0]), self.exec_(n[1]), n,
+                                self.compareOp)
+        else:
+            return self.exec_(n)
+
+    # arithmetic or comparison of node n, the fast operation of its type
+    # feedback (see TypeFeedback) or generic(a, b, op)
+    def binary(self, a, b, n, generic):
+        feedback = getattr(n, "feedback", None)
+        if feedback is None: feedback = n.feedback = TypeFeedback(n.type_)
+        t = feedback.type
+        if type(a) is t and type(b) is t:
+            x = feedback.fast(a, b)
+            if x is not missing: return x
+        elif t is not False:
+            feedback.miss(a, b)
+        return generic(a, b, n.type_)
+
+    # comparison of JS values
+    #
+    def compareOp(self, a, b, t):
+        # reflect javascript behavior
+        #
+        if isNaN(a) and isNaN(b):
+            return t in (NE, STRICT_NE)
+        elif isNull(a) or isNull(b):
+            if t in (EQ, STRICT_EQ):
+                return isNull(a) and isNull(b)
+            elif t in (NE, STRICT_NE):
+                return not (isNull(a) and isNull(b))
+            a = toNumber(a)
+            b = toNumber(b)
+        elif isObject(a) and isObject(b):
+            #print a, b
+            if t in (STRICT_EQ, EQ):
+                return id(a) == id(b)
+            elif t in (STRICT_NE, NE):
+                return id(a) != id(b)
+            else:
+                x = object_prio(a)
+                y = object_prio(b)
+                if (isNumber(a) or isNumber(b) \
+                        or isBoolean(a) or isBoolean(b)) and x != y:
                     a = toNumber(a)
                     b = toNumber(b)
-                elif isString(a) or isString(b):
+                elif x == y:
                     a = str_(a)
                     b = str_(b)
-        else:
-            return self.exec_(n)
-
+                else:
+                    a = x
+                    b = y
+                #print a, b, x, y
+        elif t not in (STRICT_EQ, STRICT_NE):
+            if isNumber(a) or isNumber(b) \
+                    or isBoolean(a) or isBoolean(b):
+                a = toNumber(a)
+                b = toNumber(b)
+            elif isString(a) or isString(b):
+                a = str_(a)
+                b = str_(b)
 
         if t == GT: return a > b 
         elif t == LT: return a < b 
@@ -1031,6 +1587,13 @@ class JS_Context(object):
         elif t == STRICT_NE: 
             return not(a == b) or not type(a) == type(b)
 
+    # FIXME it must walk on all __proto__ chain
+    def instanceOf(self, inst, obj):
+        if isinstance(inst, bool): return obj == boolean
+        elif isinstance(inst, (int, float)): return obj == number
+        elif isinstance(inst, str): return obj == string
+        return inst.__proto__ == obj.prototype
+
     # JS RegExp converted into Python re expression
     def regexp(self, n):
         return regexp_proto(regexp=n.value['regexp'], modifiers=n.value['modifiers'])
@@ -1043,13 +1606,35 @@ class JS_Context(object):
 
     def err(self, ex, msg, n=None):
         if n:
-            raise ex(msg, n.lineno, n.start, n.end, n.filename, self.stack)
+            raise ex(msg, n.lineno, n.start, n.end, n.filename, 
+                        self.stackTrace(n))
         else:
-            raise ex(msg, 0, 0, 0, "", self.stack)
+            raise ex(msg, 0, 0, 0, "", self.stackTrace())
+
+    # stack trace of the current call stack, innermost call first
+    #
+    def stackTrace(self, n=None):
+        if self.stackMode == "off": return ""
+        trace = []
+        for name, filename, lineno in self.callStack:
+            trace.insert(0, "%s@%s:%s" % (name and name + "()", 
+                                            filename or "", lineno))
+        if n and trace:
+            name, filename, lineno = self.callStack[-1]
+            trace[0] = "%s@%s:%s" % (name and name + "()", 
+                                        filename or "", n.lineno)
+        return "\n".join(trace)
 
     def warn(self, msg, n):
         sys.stderr.write("WARNING: %s on line %s!\n" % (msg, n.lineno))
 
+# frame of the call stack, in which the engines keep the line of ctx in
+# "full" mode, a frame of its own if the function running did not put its
+# frame there
+def ownFrame(ctx):
+    if ctx.pushed: return ctx.callStack[-1]
+    return [None, None, 0]
+
 # = = = = = = = = = = = = = = = 
 #   prototype implementation
 # = = = = = = = = = = = = = = = 
@@ -1061,8 +1646,7 @@ class Prototype(JS_Object):
     # if not found. This method will call recursively. 
     def __getattr__(self, k):
         #print "__getattr__", k, k in self.__proto__.__dict__, type(self), type(self.__proto__)
-        if k in self.__dict__: return object.__getattr__(self, k)
-        elif hasattr(self, "__proto__") and id(getattr(self, "__proto__")) != id(self): 
+        if hasattr(self, "__proto__") and id(getattr(self, "__proto__")) != id(self): 
             return getattr(self.__proto__, k)
         elif k == 'constructor': return None
         elif k == '__proto__': return self
@@ -1115,11 +1699,15 @@ class number_proto_(Prototype):
     toString = publicmethod(lambda this, base=10: str_base(int(this), base))
     __str__ = toString
 
+# boxed numbers, all the boxed values share these two classes
+class int_proto(int, number_proto_): pass
+class float_proto(float, number_proto_): pass
+
 def number_proto(x):
     if isInt(x):
-        return type("<int %s>" % x, (int, number_proto_), {}) (x)
+        return int_proto(x)
     if isFloat(x):
-        return type("<float %s>" % x, (float, number_proto_), {}) (x)
+        return float_proto(x)
 
 number_prototype = number_proto(0)
 
@@ -1200,9 +1788,19 @@ class string_proto(str, Prototype):
             return s[start:start+end]
 
     @publicmethod
-    def split(this, sep=None):
+    def split(this, sep=undefined, limit=undefined):
         """Splits a String object into an array of strings by separating the string into substrings."""
-        return array_proto(*str(this).split(sep))
+        s = str(this)
+        if isUndefined(sep): 
+            pieces = [s]
+        elif isinstance(sep, regexp_proto):
+            pieces = splitRegExp(sep.regexp, s)
+        elif str_(sep) == "":
+            pieces = list(s)
+        else:
+            pieces = s.split(str_(sep))
+        if not isUndefined(limit): pieces = pieces[:toInt(limit)]
+        return array_proto(*pieces)
 
     @publicmethod
     def toLowerCase(self):
@@ -1212,45 +1810,59 @@ class string_proto(str, Prototype):
         return self.lower()
 
     @publicmethod
-    def replace(this, regexp, subs):
+    def replace(this, regexp=undefined, subs=undefined):
         """
         Used to find a match between a regular expression and a string, and to replace the matched substring with a new substring.
         """
-        # replace $x with \x
-        # TODO need to escape \x in subs
-        subs = re.sub(r'\$(\d+)', r"\\\g<1>", subs)
-        # Python will raise error if i increase counter inside function
-        t = {"i":0, "g":regexp.global_}
-        # FIXME rude hack
-        def repl(m): 
-            if not t["g"] and t["i"]>0: return m.group(0)
-            t["i"]+=1
-            return re.sub(regexp.regexp, subs, m.group(0))
-        return re.sub(regexp.regexp, repl, str(this))
+        s = str(this)
+        if isinstance(regexp, regexp_proto):
+            pattern = regexp.regexp
+            count = not regexp.global_ and 1 or 0
+        else:
+            # strings are replaced literally, only the first occurence
+            pattern = re.compile(re.escape(str_(regexp)))
+            count = 1
+        if isFunction(subs):
+            f = function_of(subs)
+            def repl(m):
+                args = [m.group(0)] + matchGroups(m) + [m.start(), s]
+                return str_(f(undefined, *args))
+        else:
+            parts = parseReplacement(str_(subs), pattern.groups)
+            if len(parts) == 1 and type(parts[0]) is str:
+                # nothing to expand
+                subs = parts[0]
+                repl = lambda m: subs
+            else:
+                repl = lambda m: expandReplacement(parts, m)
+        return pattern.sub(repl, s, count)
 
     @publicmethod
-    def match(this, regexp):
+    def match(this, regexp=undefined):
         """
         Used to match a regular expression against a string.
         """
+        regexp = toRegExp(regexp)
+        s = str(this)
         if regexp.global_:
-            l = re.findall(regexp.regexp, str(this))
-            return len(l) and array_proto(*l) or null
-        else:
-            m = re.search(regexp.regexp, str(this))
-            if not m: return null
-            groups = m.groups()
-            if len(groups):
-                l = (m.string[m.start():m.end()],) + groups
-            else:
-                l = []
-                i = 0
-                try:
-                    while m.group(i):
-                        l.append(m.group(i))
-                        i += 1
-                except IndexError: pass
+            l = [m.group(0) for m in regexp.regexp.finditer(s)]
+            if not l: return null
             return array_proto(*l)
+        m = regexp.regexp.search(s)
+        if not m: return null
+        result = array_proto(m.group(0), *matchGroups(m))
+        result.index = m.start()
+        result.input = s
+        return result
+
+    @publicmethod
+    def search(this, regexp=undefined):
+        """
+        Executes the search for a match between a regular expression and a specified string.
+        """
+        m = toRegExp(regexp).regexp.search(str(this))
+        if not m: return -1
+        return m.start()
 
     """
     charAt
@@ -1269,8 +1881,6 @@ class string_proto(str, Prototype):
     quote
         Non-standard
         Wraps the string in double quotes ('"').
-    search
-        Executes the search for a match between a regular expression and a specified string.
     slice
         Extracts a section of a string and returns a new string.
     substr
@@ -1341,8 +1951,17 @@ class bool_proto(int, Prototype):
         elif k == '__isbool__': return True
         else: return Prototype.__getattr__(self, k)
 
+    toString = publicmethod(lambda this: this and "true" or "false")
+
 bool_prototype = bool_proto()
 
+# prototype of primitive value, None if x is not primitive
+def primitiveProto(x):
+    if isBoolean(x): return bool_prototype
+    elif isString(x): return string_prototype
+    elif isinstance(x, (int, long, float)): return number_prototype
+    return None
+
 #
 # Boolean object
 #
@@ -1370,20 +1989,145 @@ class Boolean(JS_Function):
 #            object
 # = = = = = = = = = = = = = = = 
 # object prototype
+#
+# Objects made by literals and by new are the most of the objects of a 
+# script, made over and over with the same properties in the same order.
+# Rather than a __dict__ of its own, such an object has a shape (hidden 
+# class) mapping property names to indexes in a list of values of the 
+# object. Adding a property moves the object to the next shape, shapes 
+# remember the shapes they lead to, so that objects built the same way 
+# share the same shapes. An object losing a property or getting more 
+# than maxShapeSize of them, as objects used for dictionaries do, goes 
+# to dictShape for good and keeps its properties in its __dict__ like 
+# other objects.
+#
+maxShapeSize = 64
+
+class Shape(object):
+    __slots__ = ("names", "index", "next")
+
+    def __init__(self, names=()):
+        self.names = names
+        self.index = dict([(k, i) for i, k in enumerate(names)])
+        self.next = {}
+
+    def add(self, k):
+        """ shape of objects of this shape after k is added
+        """
+        shape = self.next.get(k)
+        if shape is None:
+            shape = self.next[k] = Shape(self.names + (k,))
+        return shape
+
+    __repr__ = lambda self: "<Shape %s>" % ",".join(self.names)
+
+emptyShape = Shape()
+dictShape = Shape()
+
+SHAPE = "_object_proto__shape"
+VALUES = "_object_proto__values"
+
+# names of class attributes taking assignment (properties, slots), by 
+# class, these are set on the object and not in its values
+setters = {}
+
+def classSetters(cls):
+    names = setters.get(cls)
+    if names is None:
+        names = setters[cls] = set([k for c in cls.__mro__ 
+                    for k, v in c.__dict__.items() 
+                    if hasattr(type(v), "__set__")])
+    return names
+
 class object_proto(Prototype):
+    __slots__ = ("__shape", "__values")
+
     def __init__(self, **kwargs):
+        rawset(self, SHAPE, emptyShape)
+        rawset(self, VALUES, [])
         Prototype.__init__(self)
         for k, v in kwargs.iteritems():
             setattr(self, k, v)
 
+    def __getattribute__(self, k):
+        if k in illegal: k = illegal[k]
+        i = rawattr(self, SHAPE).index.get(k)
+        if i is not None: return rawattr(self, VALUES)[i]
+        return rawattr(self, k)
+
+    def __setattr__(self, k, v):
+        if k in illegal: k = illegal[k]
+        if k in interns: return
+        if type(k) is not str: k = str_(k)
+        shape = rawattr(self, SHAPE)
+        i = shape.index.get(k)
+        if i is not None:
+            rawattr(self, VALUES)[i] = v
+        elif shape is dictShape or k in classSetters(type(self)):
+            rawset(self, k, v)
+        elif len(shape.names) < maxShapeSize:
+            rawattr(self, VALUES).append(v)
+            rawset(self, SHAPE, shape.add(k))
+        else:
+            object_dict(self)
+            rawset(self, k, v)
+
+    def __delattr__(self, k):
+        if k in rawattr(self, SHAPE).index: object_dict(self)
+        Prototype.__delattr__(self, k)
+
     def __getattr__(self, k):
         if k == 'constructor': return object_
         elif k == '__proto__': return object_prototype
         else: return Prototype.__getattr__(self, k)
 
+    def __iter__(self):
+        shape = rawattr(self, SHAPE)
+        if shape is dictShape: return object_iter(self)
+        return object_iter(self, zip(shape.names, rawattr(self, VALUES)))
+
+    def __contains__(self, k):
+        shape = rawattr(self, SHAPE)
+        if shape is dictShape: return k in rawattr(self, "__dict__")
+        return k in shape.index
+
     toString = publicmethod(lambda *args: "[object Object]")
     __str__ = toString
 
+def object_dict(obj):
+    """ moves properties of obj from its values to its __dict__
+    """
+    shape = rawattr(obj, SHAPE)
+    if shape is not dictShape:
+        rawattr(obj, "__dict__").update(zip(shape.names, 
+                                            rawattr(obj, VALUES)))
+        rawset(obj, SHAPE, dictShape)
+        rawset(obj, VALUES, None)
+
+# shapes of object literals by their names, a literal made again takes 
+# the shape its first object ended with
+literalShapes = {}
+literalShapesSize = 1024
+
+def object_literal(names, values):
+    """ object of properties names with values, added in order
+    """
+    shape = literalShapes.get(names)
+    if shape is not None:
+        obj = object_proto.__new__(object_proto)
+        rawset(obj, SHAPE, shape)
+        rawset(obj, VALUES, list(values))
+        return obj
+    obj = object_proto()
+    for k, v in zip(names, values):
+        setattr(obj, k, v)
+    # names repeated or special keep their way
+    shape = shapeOf(obj)
+    if shape is not None and shape.names == names:
+        if len(literalShapes) >= literalShapesSize: literalShapes.clear()
+        literalShapes[names] = shape
+    return obj
+
 object_prototype = object_proto()
 
 #
@@ -1418,10 +2162,35 @@ class Object(JS_Function):
 #            array
 # = = = = = = = = = = = = = = = 
 # array prototype
+#
+# Elements are kept in the list itself while the array is dense, writes 
+# at the end append to it in amortized constant time, short holes are 
+# filled with undefined. A write leaving a hole longer than sparseGap and
+# than the array itself switches the array to sparse mode: the list keeps 
+# the dense head and the elements past it are kept in dictionary by index,
+# with the length aside. Elements of the dictionary are taken over by the
+# list when writes at its end reach them, the array is dense again when 
+# nothing is left past the list.
+#
+sparseGap = 1024
+
+# state of sparse mode is in slots and not in __dict__, so that it is not
+# a property, these are the (mangled) names of the slots
+SPARSE = "_array_proto__sparse"
+LENGTH = "_array_proto__length"
+
 class array_proto(list, Prototype):
+    # dictionary of elements past the list, None if dense, and length
+    __slots__ = ("__sparse", "__length")
+
     def __init__(self, *args):
         list.__init__(self, args)
         Prototype.__init__(self)
+        rawset(self, SPARSE, None)
+
+    def __len__(self):
+        if rawattr(self, SPARSE) is None: return list.__len__(self)
+        return rawattr(self, LENGTH)
 
     # Setting an item of list and extend it if neccesary
     def __setitem__(self, i, value):
@@ -1431,11 +2200,24 @@ class array_proto(list, Prototype):
         elif isUndefined(i): index = "undefined"
         else: index = toNumber(i)
         if isInt(index) and index >= 0:
-            if index > len(self)-1:
-                arr = list(self)
-                list.__setitem__(self, slice(0, index + 1), [None] * (index + 1))
-                list.__setitem__(self, slice(0, len(arr)), arr)
-            list.__setitem__(self, index, value)
+            n = list.__len__(self)
+            if index < n:
+                return list.__setitem__(self, index, value)
+            sparse = rawattr(self, SPARSE)
+            if sparse is None:
+                if index - n <= max(n, sparseGap):
+                    if index > n: list.extend(self, [undefined] * (index - n))
+                    return list.append(self, value)
+                sparse = {}
+                rawset(self, SPARSE, sparse)
+                rawset(self, LENGTH, n)
+            if index == n:
+                list.append(self, value)
+                array_compact(self)
+            else:
+                sparse[index] = value
+                if index >= rawattr(self, LENGTH):
+                    rawset(self, LENGTH, index + 1)
         else:
             setattr(self, str_(i), value)
 
@@ -1446,10 +2228,13 @@ class array_proto(list, Prototype):
         elif isUndefined(i): index = "undefined"
         else: index = toNumber(i)
         if isInt(index) and index >= 0:
-            if index >= len(self):
-                # reflected JS behavior, get value of prototype
-                return list.__getitem__(self.__proto__, index)
-            return list.__getitem__(self, index)
+            if index < list.__len__(self):
+                return list.__getitem__(self, index)
+            sparse = rawattr(self, SPARSE)
+            if sparse is not None and index < rawattr(self, LENGTH):
+                return sparse.get(index, undefined)
+            # reflected JS behavior, get value of prototype
+            return list.__getitem__(self.__proto__, index)
         return getattr(self, str_(i))
 
     def __getattr__(self, k):
@@ -1458,27 +2243,164 @@ class array_proto(list, Prototype):
         elif k == '__proto__': return array_prototype
         else: return Prototype.__getattr__(self, k)
 
+    def __setattr__(self, k, v):
+        if k == 'length': array_resize(self, v)
+        else: Prototype.__setattr__(self, k, v)
+
     @publicmethod
     def push(self, x): 
-        list.append(self, x)
+        if rawattr(self, SPARSE) is None: list.append(self, x)
+        else: self[len(self)] = x
         return x
 
     @publicmethod
-    def pop(self): return list.pop(self)
+    def pop(self): 
+        sparse = rawattr(self, SPARSE)
+        if sparse is None: 
+            if list.__len__(self) == 0: return undefined
+            return list.pop(self)
+        n = rawattr(self, LENGTH) - 1
+        if n < list.__len__(self):
+            x = list.pop(self)
+        else:
+            x = sparse.pop(n, undefined)
+        rawset(self, LENGTH, n)
+        array_compact(self)
+        return x
 
     @publicmethod
     def slice(this, s=0, i=None): 
         if i == None: i = len(this)
-        return array_proto(*this[s:i])
+        if rawattr(this, SPARSE) is None:
+            return array_proto(*this[s:i])
+        return array_proto(*list(array_values(this))[s:i])
 
     @publicmethod
     def join(this, s=","): 
-        l = []
-        i = 0
-        while i<this.length:
-            l.append(str(this[i]))
-            i += 1
-        return string_proto(s.join(l))
+        return string_proto(str_(s).join([element_str(x) 
+                                            for x in array_values(this)]))
+
+    # methods taking a callback call it as f(element, index, array), 
+    # elements missing in sparse arrays are passed over
+    @publicmethod
+    def forEach(this, f=undefined, context=undefined):
+        f = function_of(f)
+        for i, x in array_items(this):
+            f(context, x, i, this)
+
+    @publicmethod
+    def map(this, f=undefined, context=undefined):
+        f = function_of(f)
+        result = array_sized(len(this))
+        for i, x in array_items(this):
+            result[i] = f(context, x, i, this)
+        return result
+
+    @publicmethod
+    def filter(this, f=undefined, context=undefined):
+        f = function_of(f)
+        return array_proto(*[x for i, x in array_items(this) 
+                                if f(context, x, i, this)])
+
+    @publicmethod
+    def reduce(this, f=undefined, value=missing):
+        f = function_of(f)
+        items = array_items(this)
+        if value is missing:
+            for i, value in items: break
+            else: raise TypeError_, \
+                    "reduce of empty array with no initial value"
+        for i, x in items:
+            value = f(undefined, value, x, i, this)
+        return value
+
+    @publicmethod
+    def indexOf(this, x=undefined, start=0):
+        n = len(this)
+        start = toInt(start)
+        if isNaN(start): start = 0
+        elif start < 0: start = max(n + start, 0)
+        equal = strictlyEqual(x)
+        for i, y in array_items(this):
+            if i >= start and equal(y): return i
+        return -1
+
+    @publicmethod
+    def lastIndexOf(this, x=undefined, start=missing):
+        n = len(this)
+        if start is missing: start = n - 1
+        else:
+            start = toInt(start)
+            if isNaN(start): start = 0
+            elif start < 0: start = n + start
+        equal = strictlyEqual(x)
+        for i, y in reversed(list(array_items(this))):
+            if i <= start and equal(y): return i
+        return -1
+
+    @publicmethod
+    def concat(this, *args):
+        values = list(array_values(this))
+        for x in args:
+            if isArray(x): values.extend(array_values(x))
+            else: values.append(x)
+        return array_proto(*values)
+
+    # methods rearranging elements work on dense arrays, holes of sparse
+    # ones become undefined
+    @publicmethod
+    def splice(this, start=0, count=missing, *items):
+        array_dense(this)
+        n = list.__len__(this)
+        start = toInt(start)
+        if isNaN(start): start = 0
+        elif start < 0: start = max(n + start, 0)
+        else: start = min(start, n)
+        if count is missing: count = n - start
+        else: 
+            count = toInt(count)
+            if isNaN(count): count = 0
+            count = min(max(count, 0), n - start)
+        removed = list.__getitem__(this, slice(start, start + count))
+        list.__setitem__(this, slice(start, start + count), items)
+        return array_proto(*removed)
+
+    @publicmethod
+    def sort(this, f=undefined):
+        array_dense(this)
+        # undefined goes to the end, as ECMAScript says
+        values = [x for x in list.__iter__(this) if not isUndefined(x)]
+        if isUndefined(f):
+            values.sort(key=str_)
+        else:
+            f = function_of(f)
+            def compare(a, b):
+                x = toNumber(f(undefined, a, b))
+                if x > 0: return 1
+                elif x < 0: return -1
+                return 0
+            values.sort(cmp=compare)
+        values.extend([undefined] * (list.__len__(this) - len(values)))
+        list.__setitem__(this, slice(None), values)
+        return this
+
+    @publicmethod
+    def reverse(this):
+        array_dense(this)
+        list.reverse(this)
+        return this
+
+    @publicmethod
+    def shift(this):
+        array_dense(this)
+        if list.__len__(this) == 0: return undefined
+        return list.pop(this, 0)
+
+    @publicmethod
+    def unshift(this, *items):
+        array_dense(this)
+        list.__setitem__(this, slice(0, 0), items)
+        return list.__len__(this)
 
     __iter__ = lambda self: array_iter(self)
     """
@@ -1487,17 +2409,129 @@ class array_proto(list, Prototype):
     return list.__iter__(self)
     """
 
-    __str__ = lambda self: ",".join([str_(x)
-                  for x in list.__iter__(self)])
+    __str__ = lambda self: ",".join([element_str(x)
+                  for x in array_values(self)])
 
 array_prototype = array_proto()
 
+# array of given length without elements
+def array_sized(length):
+    arr = array_proto()
+    if length > sparseGap:
+        rawset(arr, SPARSE, {})
+        rawset(arr, LENGTH, length)
+    else:
+        list.extend(arr, [undefined] * length)
+    return arr
+
+# sets length of array, elements past it are dropped, a large growth
+# makes the array sparse
+def array_resize(arr, length):
+    length = toNumber(length)
+    if isFloat(length) and length == int(length): length = int(length)
+    if not isInt(length) or length < 0:
+        raise RangeError_, "Invalid array length"
+    n = list.__len__(arr)
+    sparse = rawattr(arr, SPARSE)
+    if length <= n:
+        list.__delslice__(arr, length, n)
+        rawset(arr, SPARSE, None)
+        return
+    if sparse is None:
+        if length - n <= max(n, sparseGap):
+            list.extend(arr, [undefined] * (length - n))
+            return
+        sparse = {}
+        rawset(arr, SPARSE, sparse)
+    for i in [i for i in sparse if i >= length]: del sparse[i]
+    rawset(arr, LENGTH, length)
+    array_compact(arr)
+
+# takes over elements of sparse array following its list, makes the array 
+# dense if nothing is left
+def array_compact(arr):
+    sparse = rawattr(arr, SPARSE)
+    n = list.__len__(arr)
+    while n in sparse:
+        list.append(arr, sparse.pop(n))
+        n += 1
+    if not sparse and n >= rawattr(arr, LENGTH):
+        rawset(arr, SPARSE, None)
+
+# elements of array from 0 to length - 1, holes are undefined
+def array_values(arr):
+    sparse = rawattr(arr, SPARSE)
+    if sparse is None: 
+        return list.__iter__(arr)
+    return itertools.chain(list.__iter__(arr), 
+                (sparse.get(i, undefined) for i in 
+                    xrange(list.__len__(arr), rawattr(arr, LENGTH))))
+
+# indexes and elements of array, but holes of sparse arrays
+def array_items(arr):
+    sparse = rawattr(arr, SPARSE)
+    items = enumerate(list.__iter__(arr))
+    if sparse is None: return items
+    return itertools.chain(items, 
+                ((i, sparse[i]) for i in sorted(sparse)))
+
+# sparse array turned into a dense one
+def array_dense(arr):
+    if rawattr(arr, SPARSE) is None: return
+    list.__setitem__(arr, slice(None), list(array_values(arr)))
+    rawset(arr, SPARSE, None)
+
+# predicate of values strictly equal (===) to x: numbers and strings are
+# compared by value, whatever python type they are, objects only to 
+# themselves
+def strictlyEqual(x):
+    if isinstance(x, bool):
+        return lambda y: isinstance(y, bool) and y == x
+    elif isNumber(x):
+        return lambda y: isNumber(y) and y == x
+    elif isinstance(x, basestring):
+        return lambda y: isinstance(y, basestring) and y == x
+    return lambda y: y is x
+
+# Python callable running JS function f as f(this, *args), functions of 
+# scripts are called by their constructor directly
+def function_of(f):
+    if isinstance(f, js_function): return f.constructor
+    elif not isFunction(f):
+        raise TypeError_, "%s is not a function" % str_(f)
+    return f
+
+# String.prototype.split() by pattern, captured groups are put between
+# the pieces, empty matches at the end of a piece do not split
+def splitRegExp(pattern, s):
+    if s == "":
+        if pattern.match(s): return []
+        return [s]
+    pieces = []
+    p = 0
+    for m in pattern.finditer(s):
+        if m.start() >= len(s): break
+        if m.end() == p: continue
+        pieces.append(s[p:m.start()])
+        pieces.extend(matchGroups(m))
+        p = m.end()
+    pieces.append(s[p:])
+    return pieces
+
+# element in join() and toString(), null and undefined are empty
+def element_str(x):
+    if isUndefined(x) or isNull(x): return ""
+    return str_(x)
+
 def array_iter(arr):
     collect = list()
     i = 0
     for x in list.__iter__(arr):
         collect.append((str(i), x))
         i+=1
+    sparse = rawattr(arr, SPARSE)
+    if sparse is not None:
+        collect.extend([(str(k), sparse[k]) for k in sorted(sparse)])
     collect.extend(arr.__dict__.items())
     for k, v in collect:
         yield (k, v)
@@ -1518,7 +2552,7 @@ class Array(JS_Function):
     def __getattr__(self, k):
         if k == 'constructor': return array
         elif k == '__proto__': return array_prototype
-        else: Prototype.__getattr__(self, k)
+        raise AttributeError, k
 
     def __newInstance__(self, *args):
         return self.__call__(None, *args)
@@ -1532,8 +2566,7 @@ class Array(JS_Function):
                     if args[0] < 0 or isNaN(args[0]) or \
                             isInfinity(args[0]) or isFloat(args[0]): 
                         raise RangeError_, "Invalid array length"
-                    _args = [None] * args[0]
-                    return array_proto(*_args)
+                    return array_sized(args[0])
                 else:
                     return array_proto(*args)
             else:
@@ -1568,7 +2601,7 @@ class func_proto(Prototype):
         return self.constructor(context, *args)
 
     def __newInstance__(self, *args):
-        instance = Prototype()
+        instance = object_proto()
         instance.__proto__ = self.prototype
         instance.constructor = self.constructor
         obj = instance.constructor(instance, *args)
@@ -1583,35 +2616,122 @@ class func_proto(Prototype):
                                 
 func_prototype = func_proto()
 
+# function object, all the JS functions share this class and differ 
+# by the constructor, which runs the function body
+class js_function(func_proto):
+    def __init__(self, constructor):
+        func_proto.__init__(self)
+        self.constructor = constructor
+        self.prototype = object_proto()
+        self.caller = None
+
+    # prototype and caller are not enumerable
+    __iter__ = lambda self: ((k, v) for k, v in object_iter(self) 
+                                if k not in ("prototype", "caller"))
+    __repr__ = lambda self: self.constructor.__name__
+
 class arguments(tuple):
     length = property(lambda self: len(self))
 
 # function  constructor
+# code is compiled body (see jscompiler), the body node is interpreted if None
+# fun is the lazy function being loaded (see lazyFunction)
 #
-def function(parent, f):
+def function(parent, f, code=None, fun=None):
+    if not getattr(f, "parsed", True):
+        return lazyFunction(parent, f, code)
     params = f.params
     body = f.body
     name = getattr(f, 'name', None)
+    # functions built by Function() are not resolved with the script
+    if not hasattr(f, "scopeNames"):
+        resolver.resolveFunction(f)
+    names = f.scopeNames
+    nslots = len(names)
+    nparams = len(params)
+    # see resolver, parameters take first slots, arguments is next if
+    # the function refers to it
+    hasArguments = nslots > nparams and names[nparams] == "arguments"
+    padding = [undefined] * (nslots - nparams)
+    filename = getattr(f, "filename", "")
+    lineno = getattr(f, "lineno", 0)
+    # new context of a call, the call is counted and put on the call 
+    # stack, returns the context and whether it was put there 
+    def enter(context, args):
+        n = len(args)
+        if n == nparams: frame = list(args)
+        elif n > nparams: frame = list(args[:nparams])
+        else: frame = list(args) + [undefined] * (nparams - n)
+        frame += padding
+        if hasArguments:
+            frame[nparams] = arguments(args)
+        ctx = JS_Context(context=context, parent=parent, caller=fun, 
+                            frame=frame, names=names)
+        depth = ctx.depth
+        if depth[0] >= ctx.maxDepth:
+            raise RangeError_, "maximum call stack size exceeded"
+        depth[0] += 1
+        stack = ctx.callStack
+        push = ctx.stackMode != "off" and len(stack) < ctx.maxStack
+        if push: stack.append([name, filename, lineno])
+        ctx.pushed = push
+        return ctx, push
+
     def constructor(context, *args):
         #print "constructor()", context, args
         #print "call %s(), # %s" % (name, f.lineno)
-        returnValue = undefined
-        # initialize new context
-        ctx = JS_Context(parent=parent, caller=fun)
-        ctx.scope['arguments'] = arguments(args)
-        ctx.context = context
-        for i in range(len(params)):
-            if i < len(args):
-                ctx.scope[params[i]] = ctx.scope['arguments'][i]
-            else:
-                ctx.scope[params[i]] = undefined
+        ctx, push = enter(context, args)
         try:
-            returnValue = ctx.exec_(body)
-        except BreakOutOfLoops: 
-            returnValue = ctx.returnValue
-        
-        return returnValue
+            if code: code(ctx)
+            else: ctx.exec_(body)
+        except RuntimeError, e:
+            if "recursion" not in str(e): raise
+            raise RangeError_, "maximum call stack size exceeded"
+        finally:
+            ctx.depth[0] -= 1
+            if push: ctx.callStack.pop()
+        if ctx.completion == RETURN:
+            return ctx.returnValue
+        return undefined
+
+    # engines running the code of f themselves call enter() and leave 
+    # the context like the constructor does
+    constructor.function = f
+    constructor.enter = enter
+    constructor.__name__ = ustr(getattr(f, "name", 'anonymous'))
+    constructor.toString = lambda this, *args:  \
+        "function %s(%s) %s" % (
+            constructor.__name__, 
+            ",".join([p for p in f.params]),
+            "{/*stub*/}") 
+
+    if fun is None:
+        fun = js_function(constructor)
+    else:
+        rawset(fun, "constructor", constructor)
+    return fun
+
+# function of lazy f (see jsparser.LazyFunction), its body is parsed when
+# it is called first, then its constructor is made as function() makes it
+# and put in place of this one, code is a function returning the compiled 
+# body
+#
+def lazyFunction(parent, f, code=None):
+    loaded = []
+    def load():
+        if not loaded:
+            body = None
+            if code: body = code()
+            # the body node is parsed to be interpreted
+            else: f.body
+            loaded.append(function(parent, f, body, fun).constructor)
+        return loaded[0]
 
+    def constructor(context, *args):
+        return load()(context, *args)
+
+    constructor.function = f
+    constructor.enter = lambda context, args: load().enter(context, args)
     constructor.__name__ = ustr(getattr(f, "name", 'anonymous'))
     constructor.toString = lambda this, *args:  \
         "function %s(%s) %s" % (
@@ -1619,12 +2739,7 @@ def function(parent, f):
             ",".join([p for p in f.params]),
             "{/*stub*/}") 
 
-    init = dict(
-        constructor = staticmethod(constructor),
-        prototype = object_proto(),
-        caller = None
-    )
-    fun = type(ustr(getattr(f, "name", 'empty')), (func_proto,), init) ()
+    fun = js_function(constructor)
     return fun
 
 #
@@ -1657,6 +2772,117 @@ class Function(JS_Function):
     def __newInstance__(self, *args):
         return self.__call__(None, *args)
 
+#
+# regular expressions
+#
+# Patterns of JS differ from those of python re in a few points, they 
+# are translated by translateRegExp():
+#
+#   $           end of input only (not before the last newline) unless m
+#   [^]         any character, [] nothing
+#   \uXXXX      character by its code, strings are utf-8 encoded
+#   \cX         control character
+#
+# Compiled patterns are kept by source and modifiers, literals in loops
+# and functions called over and over compile their pattern only once.
+#
+regexpTokenRe = re.compile(r"""
+    \\u(?P<unicode>[0-9a-fA-F]{4}) | \\c(?P<control>[a-zA-Z])
+  | (?P<escape>\\.) | (?P<anything>\[\^\]) | (?P<nothing>\[\])
+  | (?P<class>\[) | (?P<classEnd>\]) | (?P<end>\$) | .
+    """, re.VERBOSE | re.DOTALL)
+
+def translateRegExp(source, multiline=False):
+    """ python re pattern of JS pattern source
+    """
+    out = []
+    inClass = False
+    for m in regexpTokenRe.finditer(source):
+        kind = m.lastgroup
+        if kind == "unicode":
+            c = int(m.group(kind), 16)
+            if c < 0x80: out.append("\\x%02x" % c)
+            else: out.append(re.escape(unichr(c).encode("utf-8")))
+        elif kind == "control":
+            out.append("\\x%02x" % (ord(m.group(kind).upper()) - 64))
+        elif inClass:
+            if kind == "classEnd": inClass = False
+            out.append(m.group(0))
+        elif kind == "anything": out.append(r"[\s\S]")
+        elif kind == "nothing": out.append("(?!)")
+        elif kind == "class":
+            inClass = True
+            out.append("[")
+        elif kind == "end" and not multiline: out.append(r"\Z")
+        else: out.append(m.group(0))
+    return "".join(out)
+
+# compiled patterns by (source, modifiers), emptied when it is full
+regexpCache = {}
+regexpCacheSize = 256
+
+def compileRegExp(source, modifiers=""):
+    key = (source, modifiers)
+    pattern = regexpCache.get(key)
+    if pattern is None:
+        flags = 0
+        if "m" in modifiers: flags |= re.MULTILINE
+        if "i" in modifiers: flags |= re.IGNORECASE
+        try:
+            pattern = re.compile(translateRegExp(source, "m" in modifiers), 
+                                    flags)
+        except re.error, e:
+            raise SyntaxError_, "invalid regular expression /%s/: %s" % (
+                                    source, e)
+        if len(regexpCache) >= regexpCacheSize: regexpCache.clear()
+        regexpCache[key] = pattern
+    return pattern
+
+# regexp of argument of string methods, strings are patterns
+def toRegExp(x):
+    if isinstance(x, regexp_proto): return x
+    if isUndefined(x): return regexp_proto(regexp="(?:)")
+    return regexp_proto(regexp=str_(x))
+
+# groups of match, undefined if they did not participate
+def matchGroups(m):
+    return [g is None and undefined or g for g in m.groups()]
+
+# JS replacement string parsed once, list of strings and group numbers,
+# $& is group 0, $` and $' are beforeMatch and afterMatch
+replacementRe = re.compile(r"\$(?:(\$)|(&)|(`)|(')|(\d\d?))")
+
+beforeMatch, afterMatch = object(), object()
+
+def parseReplacement(subs, groups):
+    parts = []
+    i = 0
+    for m in replacementRe.finditer(subs):
+        dollar, whole, before, after, n = m.groups()
+        if n:
+            # $nn is $n followed by a digit if there are less groups 
+            if len(n) == 2 and int(n) > groups: 
+                n, rest = n[0], n[1]
+            else: rest = ""
+            if not 0 < int(n) <= groups: continue
+            parts.extend([subs[i:m.start()], int(n), rest])
+        elif dollar: parts.append(subs[i:m.start()] + "$")
+        elif whole: parts.extend([subs[i:m.start()], 0])
+        elif before: parts.extend([subs[i:m.start()], beforeMatch])
+        else: parts.extend([subs[i:m.start()], afterMatch])
+        i = m.end()
+    parts.append(subs[i:])
+    return [x for x in parts if x != ""]
+
+def expandReplacement(parts, m):
+    out = []
+    for x in parts:
+        if type(x) is int: out.append(m.group(x) or "")
+        elif x is beforeMatch: out.append(m.string[:m.start()])
+        elif x is afterMatch: out.append(m.string[m.end():])
+        else: out.append(x)
+    return "".join(out)
+
 # regexp prototype
 class regexp_proto(Prototype):
     def __init__(self, **kwargs):
@@ -1665,25 +2891,27 @@ class regexp_proto(Prototype):
         self.global_ = False
         self.multiline = False
         self.ignorecase = False
-        self.flags = 0
 
         if 'regexp' in kwargs:
             modifiers = kwargs.get("modifiers") or ""
             if "m" in modifiers: 
-                self.flags |= re.MULTILINE
                 self.multiline = True
             if "i" in modifiers: 
-                self.flags |= re.IGNORECASE
                 self.ignorecase = True
             if "g" in modifiers: 
                 self.global_ = True
-            #print kwargs['regexp'], modifiers, self.flags, self.global_
-            self.regexp = re.compile(kwargs['regexp'], self.flags)
+            self.source = kwargs['regexp']
+            self.regexp = compileRegExp(self.source, 
+                                        modifiers.replace("g", ""))
 
     def __getattr__(self, k):
         if k == 'constructor': return regexp
         elif k == '__proto__': return regexp_prototype
-        else: return prototype.__getattr__(self, k)
+        else: return Prototype.__getattr__(self, k)
+
+    @publicmethod
+    def test(this, s=undefined):
+        return this.regexp.search(str_(s)) is not None
 
     __str__ = lambda self: "[object Object]"
 
@@ -1694,8 +2922,10 @@ class RegExp(JS_Function):
     def __init__(self):
         JS_Function.__init__(self)
 
-    def __newInstance__(self, this, regexp={}, modifiers=None):
-        return regexp_proto(regexp=regexp, modifiers=modifiers)
+    def __newInstance__(self, source="(?:)", modifiers=None):
+        if isinstance(source, regexp_proto): source = source.source
+        if isUndefined(modifiers): modifiers = None
+        return regexp_proto(regexp=str_(source), modifiers=modifiers)
 
     def __call__(self, this, *args):
         return self.__newInstance__(*args)
@@ -1795,8 +3025,24 @@ class Globals(JS_Object):
 #
 # Main PyJS class
 #
+# engine is "tree" to interpret the parse tree node by node, or "closure" 
+# to compile it into python closures first (see jscompiler)
 class PyJS(JS_Context):
-    def __init__(self):
+    def __init__(self, engine="tree", stack="functions", optimize=False,
+                    maxDepth=defaultMaxDepth):
+        if engine not in ("tree", "closure", "vm"):
+            raise ValueError("unknown engine %r" % engine)
+        if stack not in ("off", "functions", "full"):
+            raise ValueError("unknown stack mode %r" % stack)
+        if maxDepth < 1:
+            raise ValueError("maxDepth must be positive")
+        self.engine = engine
+        # names of optimizer passes run on every script, True for all
+        if optimize is True: optimize = optimizer.passes
+        for name in optimize or ():
+            if name not in optimizer.passes:
+                raise ValueError("unknown optimization %r" % name)
+        self.optimizations = list(optimize or ())
         self.globals = Globals()
         # Hidden read-only global objects
         self.js_objects = dict(
@@ -1828,22 +3074,68 @@ class PyJS(JS_Context):
         )
 
         JS_Context.__init__(self, context=self.globals, scope=self.globals)
+        self.stackMode = stack
+        self.maxDepth = maxDepth
         setattr(self.globals, "load", lambda this, *args: self.load_(*args))
         setattr(self.globals, "print", lambda this, *args: self.print_(*args))
         setattr(self.globals, "eval",  lambda this, s: self.eval_(s))
 
-    # safe eval
-    def eval_(self, s):
-        n = jsparser.parse(s)
-        return self.root_context.exec_(n)
+    # safe eval, source s of file filename is loaded from its .jsc file
+    # if there is a fresh one (see jsparser.loadCompiled)
+    def eval_(self, s, filename=None):
+        return self.execute(self.parse(s, filename))
     
     # safe load
     # TODO load script from current dir for script
     def load_(self, *args):
         for path in args:
             filename = os.path.split(path)[1]
-            n = jsparser.parse(file(filename, 'r').read())
-            self.root_context.exec_(n)
+            self.execute(self.parse(file(filename, 'r').read(), filename))
+
+    # runs script read from source, a file object or an iterable of 
+    # strings, one top level statement at a time, dropping the tree of 
+    # each when it is done (see jsparser.statements)
+    def stream_(self, source, filename=None):
+        if filename is None: filename = getattr(source, "name", None)
+        for n in jsparser.statements(source, filename, 
+                                     lazy=not self.optimizations):
+            self.execute(n)
+
+    # shared tree of source s from the parse cache, prepared for the 
+    # engines (see jsparser.ParseCache)
+    # bodies of functions are parsed lazily, unless the optimizer needs 
+    # them
+    def parse(self, s, filename=None):
+        return jsparser.cache.parse(s, filename, prepare=self.prepare,
+                                    variant=tuple(self.optimizations),
+                                    lazy=not self.optimizations)
+
+    # optimizes and resolves parse tree n
+    def prepare(self, n):
+        if self.optimizations:
+            n = optimizer.optimize(n, self.optimizations)
+        return resolver.resolve(n)
+
+    # run parsed script with selected engine
+    def execute(self, n):
+        # shared trees are prepared already and may not be changed
+        if not getattr(n, "shared", False):
+            n = self.prepare(n)
+        if self.engine == "closure":
+            return jscompiler.compile(n)(self.root_context)
+        elif self.engine == "vm":
+            return bytecode.run(bytecode.compile(n), self.root_context)
+        return self.root_context.exec_(n)
+
+    # runs compiled script, code is bytecode.Code or its serialized form 
+    # (see bytecode.dumps)
+    def run_(self, code):
+        if isinstance(code, str):
+            code = bytecode.loads(code)
+        return bytecode.run(code, self.root_context)
 
     def print_(self, *args):
         print (" ".join([str(s) for s in args]))
+
+# engines built on top of the definitions above
+import jscompiler, bytecode, optimizer
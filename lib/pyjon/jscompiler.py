@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+#
+# Closure compiler for PyJS.
+# ------------------------------------------------------------------------------
+#
+# Translates a parse tree (see jsparser) into nested python closures, one
+# closure per node with its operands already compiled and bound. Compiled
+# code is a callable taking JS_Context, so that the node type dispatch of
+# JS_Context.exec_() is done only once, when the tree is compiled, and not
+# every time the node is evaluated in a loop or a function body.
+#
+# Semantics are borrowed from the tree walker, compiled code calls the
+# same JS_Context helpers (var, assignOp, compareOp, getProperty, ...).
+#
+# Usage:
+#
+#   code = jscompiler.compile(jsparser.parse(source))
+#   code(context)
+#
+# or PyJS(engine="closure").
+#
+
+__all__ = ["compile"]
+
+import defs, resolver
+from interpr import *
+
+defs.map(globals())
+
+# compilers of node types, filled in by @compiles
+compilers = {}
+
+def compiles(*types):
+    def register(f):
+        for t in types:
+            compilers[t] = f
+        return f
+    return register
+
+def compile(n):
+    """ returns closure evaluating node n in the given JS_Context
+    """
+    if isNull(n) or isUndefined(n) or isString(n) or isNumber(n):
+        return constant(n)
+    f = compilers.get(n.type_)
+    if f is None:
+        return notImplemented(n)
+    return f(n)
+
+def constant(value):
+    return lambda ctx: value
+
+def notImplemented(n):
+    def run(ctx):
+        ctx.err(NotImplemented_, n.type, n)
+    return run
+
+# compiles read of variable, frames of the nearest scopes are accessed
+# directly (see resolver)
+def reader(name, n):
+    read = rawReader(name, n)
+    if getattr(n, "flatten", False):
+        return lambda ctx: flat(read(ctx))
+    return read
+
+# compiles read of variable leaving StringBuilder as it is
+def rawReader(name, n):
+    slot = getattr(n, "slot", None)
+    if not slot:
+        return lambda ctx: ctx.globalVar(name, n)
+    depth, i = slot
+    if depth == 0:
+        return lambda ctx: ctx.frame[i]
+    elif depth == 1:
+        return lambda ctx: ctx.parent.frame[i]
+    return lambda ctx: ctx.var(name, n)
+
+# compiles write of variable, returns closure taking context and value
+def writer(name, n):
+    slot = getattr(n, "slot", None)
+    if not slot:
+        def run(ctx, value):
+            ctx.root_context.scope[name] = value
+            return value
+        return run
+    depth, i = slot
+    if depth == 0:
+        def run(ctx, value):
+            ctx.frame[i] = value
+            return value
+    elif depth == 1:
+        def run(ctx, value):
+            ctx.parent.frame[i] = value
+            return value
+    else:
+        def run(ctx, value):
+            return ctx.setVar(name, value, n)
+    return run
+
+# tells whether statement n can complete abruptly (see 
+# JS_Context.completion), the sequences without such statements need 
+# not check completion after every statement
+def abrupt(n):
+    if isNull(n) or isUndefined(n) or isString(n) or isNumber(n):
+        return False
+    t = n.type_
+    if t in (BREAK, CONTINUE, RETURN): return True
+    if t == FUNCTION: return False
+    for x in resolver.children(n):
+        if abrupt(x): return True
+    return False
+
+# compiles property name of DOT or INDEX node
+def property_(n):
+    if n.type_ == INDEX:
+        return compile(n[1])
+    elif n[1].type_ == IDENTIFIER:
+        return constant(ustr(n[1].value))
+    raise NotImplemented_, str(n[1].type)
+
+#
+# terminals
+#
+@compiles(NUMBER)
+def number_(n): return constant(toNumber(n.value))
+
+@compiles(STRING)
+def string_(n): return constant(n.value)
+
+@compiles(TRUE)
+def true_(n): return constant(True)
+
+@compiles(FALSE)
+def false_(n): return constant(False)
+
+@compiles(NULL)
+def null_(n): return constant(null)
+
+@compiles(THIS)
+def this_(n): return lambda ctx: ctx.context
+
+@compiles(HEADER)
+def header(n): return constant(None)
+
+@compiles(REGEXP)
+def regexp_(n): return lambda ctx: ctx.regexp(n)
+
+@compiles(IDENTIFIER)
+def identifier(n): return reader(ustr(n.value), n)
+
+#
+# statements
+#
+# statements of sequence n with the line numbers, which are tracked
+# in "full" stack mode (see JS_Context.callStack)
+def traced(n, codes):
+    lines = [getattr(x, "lineno", 0) for x in n]
+    def run(ctx):
+        frame = ownFrame(ctx)
+        last = undefined
+        for lineno, code in zip(lines, codes):
+            frame[2] = lineno
+            last = code(ctx)
+            if ctx.completion: break
+        return last
+    return run
+
+@compiles(SCRIPT)
+def script(n):
+    codes = [compile(x) for x in n]
+    full = traced(n, codes)
+    if not abrupt(n):
+        def run(ctx):
+            if ctx.stackMode == "full": return full(ctx)
+            for code in codes:
+                code(ctx)
+    else:
+        def run(ctx):
+            if ctx.stackMode == "full": return full(ctx)
+            for code in codes:
+                code(ctx)
+                if ctx.completion: break
+    return run
+
+@compiles(BLOCK, COMMA)
+def sequence(n):
+    codes = [compile(x) for x in n]
+    full = traced(n, codes)
+    if not abrupt(n):
+        def run(ctx):
+            if ctx.stackMode == "full": return full(ctx)
+            last = undefined
+            for code in codes:
+                last = code(ctx)
+            return last
+    else:
+        def run(ctx):
+            if ctx.stackMode == "full": return full(ctx)
+            last = undefined
+            for code in codes:
+                last = code(ctx)
+                if ctx.completion: break
+            return last
+    return run
+
+@compiles(GROUP)
+def group(n): return compile(n[0])
+
+@compiles(SEMICOLON)
+def semicolon(n): return compile(n.expression)
+
+@compiles(VAR, LET, CONST)
+def var_(n):
+    decls = [(writer(ustr(x.value), x), compile(x.initializer)) 
+                for x in n if hasattr(x, 'initializer')]
+    declared = [(ustr(x.value), x) for x in n if not hasattr(x, 'initializer')]
+    def run(ctx):
+        for set, init in decls:
+            set(ctx, init(ctx))
+        for name, x in declared:
+            ctx.declareVar(name, x)
+    return run
+
+@compiles(FUNCTION)
+def function_def(n):
+    if not getattr(n, "parsed", True):
+        # the body is compiled on the first call (see interpr.lazyFunction)
+        compiled = []
+        def load():
+            if not compiled:
+                body = n.body
+                if not hasattr(n, "scopeNames"):
+                    resolver.resolveFunction(n)
+                compiled.append(compile(body))
+            return compiled[0]
+        def lazy(ctx):
+            # parsed by another call or another engine sharing the tree
+            if compiled or n.parsed: return ctx.funDef(n, load())
+            return ctx.funDef(n, load)
+        return lazy
+    if not hasattr(n, "scopeNames"):
+        resolver.resolveFunction(n)
+    body = compile(n.body)
+    def run(ctx):
+        return ctx.funDef(n, body)
+    return run
+
+@compiles(CLASS)
+def class_(n): return lambda ctx: ctx.classDef(n)
+
+@compiles(IF)
+def if_(n):
+    cond = compile(n.condition)
+    then = compile(n.thenPart)
+    else_ = compile(n.elsePart)
+    def run(ctx):
+        if cond(ctx): then(ctx)
+        else: else_(ctx)
+    return run
+
+@compiles(WHILE)
+def while_(n):
+    cond = compile(n.condition)
+    body = compile(n.body)
+    def run(ctx):
+        while cond(ctx):
+            body(ctx)
+            if ctx.completion and ctx.leaveLoop(): break
+    return run
+
+@compiles(FOR)
+def for_(n):
+    setup = compile(n.setup)
+    cond = n.condition and compile(n.condition) or constant(True)
+    update = compile(n.update)
+    body = compile(n.body)
+    def run(ctx):
+        setup(ctx)
+        while cond(ctx):
+            body(ctx)
+            if ctx.completion and ctx.leaveLoop(): break
+            update(ctx)
+    return run
+
+@compiles(FOR_IN)
+def for_in(n):
+    set = writer(ustr(n.iterator.value), n.iterator)
+    object_ = compile(n.object)
+    body = compile(n.body)
+    def run(ctx):
+        for k, v in object_(ctx):
+            set(ctx, k)
+            body(ctx)
+            if ctx.completion and ctx.leaveLoop(): break
+    return run
+
+@compiles(BREAK)
+def break_(n):
+    def run(ctx):
+        ctx.completion = BREAK
+    return run
+
+@compiles(CONTINUE)
+def continue_(n):
+    def run(ctx):
+        ctx.completion = CONTINUE
+    return run
+
+@compiles(RETURN)
+def return_(n):
+    value = compile(n.value)
+    def run(ctx):
+        ctx.returnValue = value(ctx)
+        ctx.completion = RETURN
+    return run
+
+@compiles(SWITCH)
+def switch(n):
+    discriminant = compile(n.discriminant)
+    labels = [case.type_ == CASE and compile(case.caseLabel) or None
+                for case in n.cases]
+    bodies = [[compile(x) for x in case.statements] for case in n.cases]
+    default = n.defaultIndex
+    table = getattr(n, "jumpTable", None)
+    def run(ctx):
+        desc = discriminant(ctx)
+        if table is not None:
+            start = caseIndex(table, desc, default)
+        else:
+            start = default
+            i = 0
+            for label in labels:
+                if label and desc == label(ctx):
+                    start = i
+                    break
+                i += 1
+        for statements in start >= 0 and bodies[start:] or ():
+            for code in statements:
+                code(ctx)
+                if ctx.completion: break
+            if ctx.completion:
+                if ctx.completion == BREAK: ctx.completion = None
+                break
+    return run
+
+@compiles(TRY)
+def try_(n):
+    block = compile(n.tryBlock)
+    catches = [(c.scopeNames, compile(c.block)) for c in n.catchClauses]
+    finally_ = getattr(n, "finallyBlock", None)
+    finally_ = finally_ and compile(finally_)
+    def run(ctx):
+        try:
+            block(ctx)
+        except Exception, e:
+            if not catches: raise
+            for names, code in catches:
+                catchCtx = JS_Context(context=ctx.context, parent=ctx, 
+                                        frame=[e], names=names)
+                code(catchCtx)
+                ctx.complete(catchCtx)
+        finally:
+            if finally_: ctx.finally_(None, finally_)
+    return run
+
+@compiles(THROW)
+def throw(n):
+    exception = compile(n.exception)
+    def run(ctx):
+        raise exception(ctx)
+    return run
+
+#
+# expressions
+#
+@compiles(ASSIGN)
+def assign(n):
+    left = n[0]
+    right = compile(n[1])
+    op = n.assignOp
+    if left.type_ == IDENTIFIER:
+        name = ustr(left.value)
+        get = reader(name, left)
+        set = writer(name, left)
+        if op == PLUS and getattr(left, "builder", False):
+            get = rawReader(name, left)
+            def run(ctx):
+                set(ctx, ctx.appendString(get(ctx), right(ctx)))
+        elif op:
+            def run(ctx):
+                return set(ctx, ctx.assignOp(get(ctx), right(ctx), op))
+        else:
+            def run(ctx):
+                return set(ctx, right(ctx))
+        return run
+
+    elif left.type_ in (DOT, INDEX):
+        object_ = compile(left[0])
+        prop = property_(left)
+        def run(ctx):
+            obj = ctx.toObject(object_(ctx))
+            return ctx.setProperty(obj, prop(ctx), right(ctx), left, op)
+        return run
+
+    def run(ctx):
+        ctx.err(ReferenceError, "invalid assignment left-hand side", n)
+    return run
+
+@compiles(INCREMENT, DECREMENT)
+def increment(n):
+    target = n[0]
+    op = n.type_ == INCREMENT and PLUS or MINUS
+    postfix = getattr(n, "postfix", False)
+    if target.type_ == IDENTIFIER:
+        name = ustr(target.value)
+        get = reader(name, target)
+        set = writer(name, target)
+        delta = op == PLUS and 1 or -1
+        def run(ctx):
+            x = get(ctx)
+            if type(x) is int:
+                y = set(ctx, x + delta)
+            else:
+                x = toNumber(x)
+                y = set(ctx, ctx.arithmOp(x, 1, op))
+            if postfix: return x
+            return y
+    else:
+        object_ = compile(target[0])
+        prop = property_(target)
+        def run(ctx):
+            obj = ctx.toObject(object_(ctx))
+            p = prop(ctx)
+            x = toNumber(ctx.getProperty(obj, p, target))
+            y = ctx.arithmOp(x, 1, op)
+            ctx.setProperty(obj, p, y, target)
+            if postfix: return x
+            return y
+    return run
+
+@compiles(DOT, INDEX)
+def member(n):
+    object_ = compile(n[0])
+    prop = property_(n)
+    def run(ctx):
+        return ctx.getProperty(object_(ctx), prop(ctx), n)
+    return run
+
+@compiles(CALL, NEW, NEW_WITH_ARGS)
+def call(n):
+    t = n.type_
+    callee = n[0]
+    if t == NEW: args = []
+    else: args = [compile(x) for x in n[1]]
+    if callee.type_ in (DOT, INDEX):
+        object_ = compile(callee[0])
+        prop = property_(callee)
+        def run(ctx):
+            this = object_(ctx)
+            fun = ctx.getProperty(this, prop(ctx), callee)
+            return ctx.call(fun, this, [a(ctx) for a in args], t, n)
+    else:
+        fun = compile(callee)
+        def run(ctx):
+            f = fun(ctx)
+            return ctx.call(f, ctx.context, [a(ctx) for a in args], t, n)
+    return run
+
+@compiles(ARRAY_INIT)
+def array_init(n):
+    items = [compile(x) for x in n]
+    def run(ctx):
+        return array_proto(*[item(ctx) for item in items])
+    return run
+
+@compiles(OBJECT_INIT)
+def object_init(n):
+    props = [x for x in n if x.type_ == PROPERTY_INIT]
+    names = tuple([ustr(x[0].value) for x in props])
+    values = [compile(x[1]) for x in props]
+    def run(ctx):
+        return object_literal(names, [v(ctx) for v in values])
+    return run
+
+# operators with type feedback, see TypeFeedback
+def binary(n, generic):
+    t = n.type_
+    a = compile(n[0])
+    b = compile(n[1])
+    feedback = n.feedback = TypeFeedback(t)
+    def run(ctx):
+        x = a(ctx)
+        y = b(ctx)
+        type_ = feedback.type
+        if type(x) is type_ and type(y) is type_:
+            z = feedback.fast(x, y)
+            if z is not missing: return z
+        elif type_ is not False:
+            feedback.miss(x, y)
+        return generic(ctx, x, y, t)
+    return run
+
+@compiles(PLUS, MINUS, MUL, DIV, MOD)
+def arithm(n):
+    return binary(n, JS_Context.arithm.im_func)
+
+@compiles(BITWISE_OR, BITWISE_AND, BITWISE_XOR, URSH, RSH, LSH)
+def bitwise(n):
+    t = n.type_
+    a = compile(n[0])
+    b = compile(n[1])
+    def run(ctx):
+        return ctx.bitwiseOp(toInt(a(ctx)), toInt(b(ctx)), t)
+    return run
+
+@compiles(GT, LT, EQ, NE, GE, LE, STRICT_EQ, STRICT_NE)
+def compare(n):
+    return binary(n, JS_Context.compareOp.im_func)
+
+@compiles(AND)
+def and_(n):
+    a = compile(n[0])
+    b = compile(n[1])
+    return lambda ctx: a(ctx) and b(ctx)
+
+@compiles(OR)
+def or_(n):
+    a = compile(n[0])
+    b = compile(n[1])
+    return lambda ctx: a(ctx) or b(ctx)
+
+@compiles(HOOK)
+def hook(n):
+    cond = compile(n[0])
+    then = compile(n[1])
+    else_ = compile(n[2])
+    def run(ctx):
+        if cond(ctx): return then(ctx)
+        return else_(ctx)
+    return run
+
+@compiles(NOT)
+def not_(n):
+    a = compile(n[0])
+    return lambda ctx: not a(ctx)
+
+@compiles(UNARY_PLUS)
+def unary_plus(n):
+    a = compile(n[0])
+    return lambda ctx: +toNumber(a(ctx))
+
+@compiles(UNARY_MINUS)
+def unary_minus(n):
+    a = compile(n[0])
+    return lambda ctx: -toNumber(a(ctx))
+
+@compiles(BITWISE_NOT)
+def bitwise_not(n):
+    a = compile(n[0])
+    def run(ctx):
+        try:
+            return ~toInt(a(ctx))
+        except TypeError:
+            return ~0
+    return run
+
+@compiles(VOID)
+def void(n):
+    a = compile(n[0])
+    def run(ctx):
+        a(ctx)
+        return undefined
+    return run
+
+@compiles(TYPEOF)
+def typeof_(n):
+    a = compile(n[0])
+    isIdentifier = n[0].type_ == IDENTIFIER
+    def run(ctx):
+        try:
+            return typeof(a(ctx))
+        except ReferenceError:
+            if isIdentifier: return "undefined"
+            raise
+    return run
+
+@compiles(IN)
+def in_(n):
+    a = compile(n[0])
+    b = compile(n[1])
+    return lambda ctx: a(ctx) in b(ctx)
+
+@compiles(INSTANCEOF)
+def instanceof(n):
+    a = compile(n[0])
+    b = compile(n[1])
+    return lambda ctx: ctx.instanceOf(a(ctx), b(ctx))
+
+@compiles(DELETE)
+def delete(n):
+    target = n[0]
+    object_ = compile(target[0])
+    prop = property_(target)
+    def run(ctx):
+        delattr(ctx.toObject(object_(ctx)), prop(ctx))
+    return run
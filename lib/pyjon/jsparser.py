@@ -65,12 +65,30 @@ __date__ = "2011-01-24"
 
 __all__ = ["parse"]
 
-import re, sys
+import os, re, sys, hashlib, marshal, threading, zlib
+from array import array
+from collections import OrderedDict
 import defs, lexer
 
 defs.map(globals())
 
+# attributes of nodes, which are caches of the engines and are not pickled
+transient = ("ic", "feedback")
+
 class Node(list):
+    # Attributes of every node and those the engines add when running it 
+    # are in slots, numbers are frequent leaves. Statements and other 
+    # nodes keep their own attributes in a __dict__, made on first use.
+    # A node knows its source by the span start:end of the SourceFile 
+    # shared by the nodes of the script (not by the tokenizer, which keeps
+    # its tokens too), so trees can be pickled.
+    __slots__ = ("type_", "value", "lineno", "start", "end", "file", 
+                 "isHex", "integer", "slot", "ic", "feedback", "__dict__")
+
+    # comments and whitespace are not kept, they are for node2js
+    commentBefore = ""
+    whitespaces = ""
+
     def __init__(self, t, type_=None, args=[], **attrs):
         list.__init__(self)
 
@@ -92,7 +110,7 @@ class Node(list):
         else:
             self.type_ = type_
             self.lineno = t.lineno
-        self.tokenizer = t
+        self.file = t.file
 
         for arg in args:
             self.append(arg)
@@ -101,8 +119,6 @@ class Node(list):
             if attr != "type":
                 setattr(self, attr, attrs[attr])
 
-        self.commentBefore = ""
-        self.whitespaces = ""
         #self.commentBefore = t.commentBefore
         #t.commentBefore = ""
         #self.whitespaces = getattr(t.token, "whitespaces", "") 
@@ -124,8 +140,8 @@ class Node(list):
     def __str__(self):
         a = list((str(i), v) for i, v in enumerate(self))
         for attr in dir(self):
-            if attr[0] == "_": continue
-            elif attr == "tokenizer":
+            if attr[0] == "_" or not hasattr(self, attr): continue
+            elif attr == "file":
                 a.append((attr, "[object Object]"))
             #elif attr == "whitespaces": a.append((attr, repr(getattr(self, attr))))
             elif attr in ("append", "count", "extend", "getSource", "index",
@@ -165,13 +181,24 @@ class Node(list):
     def getSource(self):
         if getattr(self, "start", None) is not None:
             if getattr(self, "end", None) is not None:
-                return self.tokenizer.source[self.start:self.end]
-            return self.tokenizer.source[self.start:]
+                return self.file.text[self.start:self.end]
+            return self.file.text[self.start:]
         if getattr(self, "end", None) is not None:
-            return self.tokenizer.source[:self.end]
-        return self.tokenizer.source[:]
+            return self.file.text[:self.end]
+        return self.file.text[:]
+
+    filename = property(lambda self: self.file.filename)
+
+    def __getstate__(self):
+        state = dict([(attr, getattr(self, attr)) for attr in Node.__slots__
+                      if attr != "__dict__" and attr not in transient
+                      and hasattr(self, attr)])
+        state.update(getattr(self, "__dict__", {}))
+        return state
 
-    filename = property(lambda self: self.tokenizer.filename)
+    def __setstate__(self, state):
+        for attr, value in state.iteritems():
+            setattr(self, attr, value)
 
     def __nonzero__(self): return True
 
@@ -743,6 +770,8 @@ class StaticContext():
             f.body = x2.AssignExpression()
             if (getattr(f.body, "isGenerator", None)):
                 raise self.tz.newSyntaxError("Generator returns a value")
+        elif getattr(self.tz, "lazy", False) and f.type_ == FUNCTION:
+            self.skipBody(f)
         else :
             f.body = Script(self.tz, True)
 
@@ -755,6 +784,42 @@ class StaticContext():
             self.parentScript.funDecls.append(f)
         return f
 
+    def skipBody(self, f):
+        """
+        Skips the body of function f up to its closing brace, only the 
+        balance of braces is checked. f becomes LazyFunction, parsing the
+        body when it is needed.
+        """
+        tz = self.tz
+        f.bodyStart = tz.token.start
+        f.bodyLine = tz.token.lineno
+        identifiers = set()
+        # whether the parens open belong to if, while, for or with, after
+        # those a slash begins a regexp, after other operands it divides
+        parens = []
+        depth = 1
+        tt = LEFT_CURLY
+        while True:
+            if tt == RIGHT_PAREN:
+                scanOperand = parens.pop() if parens else True
+            else:
+                scanOperand = tt not in operandEnds
+            previous, tt = tt, tz.get(scanOperand)
+            if tt == END:
+                raise tz.newSyntaxError("Missing } in compound statement")
+            elif tt == IDENTIFIER:
+                identifiers.add(tz.token.value)
+            elif tt == LEFT_PAREN:
+                parens.append(previous in (IF, WHILE, FOR, WITH))
+            elif tt == LEFT_CURLY:
+                depth += 1
+            elif tt == RIGHT_CURLY:
+                depth -= 1
+                if not depth: break
+        tz.unget()
+        f.identifiers = identifiers
+        f.__class__ = LazyFunction
+
     def IdentifierDefinition(self):
         self.tz.mustMatch(IDENTIFIER)
         return Node(self.tz)
@@ -1368,7 +1433,70 @@ class Header(Node):
     def __init__(self, t):
         Node.__init__(self, t)
 
-def parse(source, filename=None, starting_line_number=1):
+# tokens ending an operand, a slash after them divides
+operandEnds = (IDENTIFIER, NUMBER, STRING, REGEXP, RIGHT_BRACKET, THIS, 
+               NULL, TRUE, FALSE, INCREMENT, DECREMENT)
+
+#
+# Lazy functions
+#
+# A lazy parse skips bodies of functions, checking only that their braces
+# match, and keeps where they begin:
+#
+#   f.bodyStart, f.bodyLine   position of the opening brace
+#   f.identifiers             names appearing in the body (see resolver)
+#
+# The body is parsed when it is first asked for, most functions of a 
+# library are never called on a request. The resolver leaves the body
+# unresolved and keeps the layouts of the enclosing scopes in f.scopes,
+# the body is resolved in them when it is parsed. Syntax errors in the 
+# body are found then too.
+#
+lazyLock = threading.RLock()
+
+def parseBody(f):
+    t = lexer.Tokenizer(f.file.text, f.file.filename, f.bodyLine)
+    t.file = f.file
+    t.cursor = f.bodyStart
+    t.lazy = True
+    t.mustMatch(LEFT_CURLY)
+    body = Script(t, True)
+    t.mustMatch(RIGHT_CURLY)
+    scopes = f.__dict__.pop("scopes", None)
+    if scopes is not None:
+        import resolver
+        resolver.resolveFunction(f, scopes, body)
+    return body
+
+class LazyFunction(Node):
+    __slots__ = ()
+
+    parsed = property(lambda self: "parsedBody" in self.__dict__)
+
+    def getBody(self):
+        body = self.__dict__.get("parsedBody")
+        if body is None:
+            # shared trees are used by several threads
+            with lazyLock:
+                body = self.__dict__.get("parsedBody")
+                if body is None:
+                    body = self.__dict__["parsedBody"] = parseBody(self)
+        return body
+
+    def setBody(self, body):
+        self.__dict__["parsedBody"] = body
+
+    body = property(getBody, setBody)
+
+    # saved parsed, without the scopes of the resolver
+    def __getstate__(self):
+        body = self.body
+        state = Node.__getstate__(self)
+        del state["parsedBody"]
+        state["body"] = body
+        return state
+
+def parse(source, filename=None, starting_line_number=1, lazy=False):
     """Parse some Javascript
 
     Args:
@@ -1376,14 +1504,411 @@ def parse(source, filename=None, starting_line_number=1):
         filename: the filename to include in messages
         starting_line_number: the line number of the first line of the
             passed in source, for output messages
+        lazy: whether bodies of functions are parsed when they are first
+            used (see LazyFunction)
     Returns:
         the parsed source code data structure
     Raises:
         lexer.ParseError
     """
     t = lexer.Tokenizer(source, filename, starting_line_number)
-    n = Script(t)
-    if not t.done:
-        raise t.newSyntaxError("Syntax error")
+    t.lazy = lazy
+    try:
+        n = Script(t)
+        if not t.done:
+            raise t.newSyntaxError("Syntax error")
+    except lexer.ParseError:
+        if not lazy: raise
+        # a slash skipped as a regexp or the other way round, or an error
+        # the parser reports better
+        return parse(source, filename, starting_line_number)
     return n
 
+#
+# Streaming
+#
+# statements() parses a script read in chunks one top level statement at
+# a time, each is run and dropped before the next one is parsed (see 
+# PyJS.stream_), so a large script never is in memory as a whole. A 
+# statement is taken when the next one begins in what has been read, as
+# it could go on otherwise (a = 1 may be followed by + 2). Chunks are 
+# scanned for brackets as they come, and the buffer is parsed only when a
+# statement may have ended in the chunk: at a semicolon, a closing bracket
+# or a new line outside of brackets. So a large statement (an array of 
+# generated data) is parsed once, when it is all read, or twice if the 
+# next statement does not begin in the same chunk. Every statement is a
+# script of its own, whose source is the text of the statement only, so
+# functions are hoisted to the top of their statement, not of the file.
+#
+chunkSize = 1 << 13
+
+# tokens after which a slash divides, elsewhere it begins a regexp
+scanOperandEnds = operandEnds + (RIGHT_PAREN,)
+
+def scan(buffer, state):
+    """ scans buffer from where state = (cursor, bracket depth, previous
+        token) tells, returns the state where it stopped and whether a 
+        statement may end in what was scanned
+    """
+    cursor, depth, previous = state
+    t = lexer.Tokenizer(buffer)
+    t.cursor = cursor
+    ready = False
+    try:
+        while True:
+            tt = t.get(previous not in scanOperandEnds)
+            # the last token may go on in the next chunk
+            if tt == END or t.token.end >= len(buffer): break
+            if tt in (LEFT_PAREN, LEFT_BRACKET, LEFT_CURLY):
+                depth += 1
+            elif tt in (RIGHT_PAREN, RIGHT_BRACKET, RIGHT_CURLY):
+                depth = max(depth - 1, 0)
+                if not depth: ready = True
+            elif not depth and (tt == SEMICOLON or 
+                                "\n" in buffer[cursor:t.token.start]):
+                ready = True
+            cursor, previous = t.token.end, tt
+    except lexer.ParseError:
+        # a string or comment going on in the next chunk
+        pass
+    return (cursor, depth, previous), ready
+
+def parseStatement(buffer, filename, lineno, lazy, last):
+    """ first statement of buffer as a script and the start and line 
+        number of the statement following it, None if there is none in 
+        buffer, or it may go on and last is false
+    """
+    t = lexer.Tokenizer(buffer, filename, lineno)
+    t.lazy = lazy
+    if t.peek(True) == END:
+        return None
+    n = Node(t, SCRIPT, **scriptInit())
+    x = StaticContext(t, n, n, False, False, NESTING_TOP)
+    n.append(x.Statement())
+    # the next token may go on too (els may be else) 
+    if t.get(True) != END and (last or t.token.end < len(buffer)):
+        start, lineno = t.token.start, t.token.lineno
+    elif last:
+        start = len(buffer)
+    else:
+        return None
+    t.file.text = buffer[:start]
+    return n, start, lineno
+
+def statements(source, filename=None, starting_line_number=1, lazy=False):
+    """ top level statements of source, a file object, an iterable of
+        strings or a string, each as a script of its own, see parse()
+    """
+    if isinstance(source, basestring):
+        chunks = iter([source])
+    elif hasattr(source, "read"):
+        chunks = iter(lambda: source.read(chunkSize), "")
+    else:
+        chunks = iter(source)
+    buffer, lineno = "", starting_line_number
+    state, ready = (0, 0, None), False
+    # a chunk is read ahead, so that the last statement is known to be 
+    # the last one when it is parsed
+    ahead = next(chunks, None)
+    last = ahead is None
+    while True:
+        if not ready and not last:
+            buffer += ahead
+            ahead = next(chunks, None)
+            last = ahead is None
+            state, ready = scan(buffer, state)
+            continue
+        try:
+            parsed = parseStatement(buffer, filename, lineno, lazy, last)
+        except lexer.ParseError:
+            if not last:
+                parsed = None
+            elif lazy:
+                parsed = parseStatement(buffer, filename, lineno, False, last)
+            else:
+                raise
+        if parsed is None:
+            if last: return
+            ready = False
+            continue
+        n, start, lineno = parsed
+        buffer = buffer[start:]
+        cursor, depth, previous = state
+        state = (max(cursor - start, 0), depth, previous)
+        yield n
+
+#
+# Binary parse trees
+#
+# dumps() saves a tree in flat arrays, loads() makes it again without the
+# tokenizer and the parser. Nodes are numbered in the order they are found
+# and saved as
+#
+#   classes     class of every node (index into nodeClasses)
+#   types       type_ of every node
+#   lines, starts, ends
+#               lineno, start and end of every node, -1 if it has none
+#   kids        numbers of the list items of all nodes one after another
+#   offsets     where the items of every node begin in kids
+#   values      value of every node, index into pool or -1 if it has none
+#   attrNodes, attrNames, attrValues
+#               node, name and value of every other attribute, names and 
+#               values are indices into pool
+#   pool        attribute values: (LITERAL, constant), (NODE, number), 
+#               (LIST, (value, ...)) or (LABELS, {label: value})
+#
+# with the source text and its SHA-1. The format is compressed marshal, as
+# bytecode.dumps() is, and therefore bound to the python version. 
+# compileFile() writes the .jsc file of a script at deploy time, the parse
+# cache loads it instead of parsing the script (see loadCompiled()).
+#
+magic = "PJAS"
+version = 1
+
+nodeClasses = []
+LITERAL, NODE, LIST, LABELS = range(4)
+# attributes saved in the arrays, or not at all
+arrayAttrs = ("type_", "value", "lineno", "start", "end", "file", "shared")
+
+def digest(source):
+    if isinstance(source, unicode):
+        source = source.encode("utf-8")
+    return hashlib.sha1(source).digest()
+
+def dumps(n):
+    """ serializes tree n into string
+    """
+    nodes, numbers, pool, entries = [], {}, [], {}
+    def number(x):
+        if id(x) not in numbers:
+            numbers[id(x)] = len(nodes)
+            nodes.append(x)
+        return numbers[id(x)]
+    def encode(x):
+        if isinstance(x, Node):
+            return (NODE, number(x))
+        elif type(x) is list:
+            return (LIST, tuple(map(encode, x)))
+        elif isinstance(x, defs.StringMap):
+            return (LABELS, dict([(k, encode(v)) 
+                                  for k, v in vars(x.table).iteritems()]))
+        return (LITERAL, x)
+    def add(entry):
+        # 1, 1.0 and True are equal keys, marshal tells them apart
+        key = marshal.dumps(entry)
+        if key not in entries:
+            entries[key] = len(pool)
+            pool.append(entry)
+        return entries[key]
+
+    classes, types, kids, offsets, values = \
+        array("B"), array("i"), array("i"), array("i"), array("i")
+    spans = dict([(attr, array("i")) for attr in ("lineno", "start", "end")])
+    attrNodes, attrNames, attrValues = array("i"), array("i"), array("i")
+    number(n)
+    i = 0
+    while i < len(nodes):
+        x = nodes[i]
+        if x.__class__ not in nodeClasses: nodeClasses.append(x.__class__)
+        classes.append(nodeClasses.index(x.__class__))
+        types.append(x.type_)
+        for attr in spans:
+            spans[attr].append(getattr(x, attr, -1))
+        offsets.append(len(kids))
+        kids.extend([number(y) for y in x])
+        if hasattr(x, "value"):
+            values.append(add(encode(x.value)))
+        else:
+            values.append(-1)
+        state = x.__getstate__()
+        for attr in sorted(state):
+            if attr not in arrayAttrs:
+                attrNodes.append(i)
+                attrNames.append(add((LITERAL, attr)))
+                attrValues.append(add(encode(state[attr])))
+        i += 1
+    offsets.append(len(kids))
+
+    text, filename = n.file.text, n.file.filename
+    data = (text, filename, 
+            tuple([c.__name__ for c in nodeClasses]), classes.tostring(),
+            types.tostring(), spans["lineno"].tostring(), 
+            spans["start"].tostring(), spans["end"].tostring(), 
+            kids.tostring(), offsets.tostring(), values.tostring(), 
+            attrNodes.tostring(), attrNames.tostring(), 
+            attrValues.tostring(), tuple(pool))
+    return magic + chr(version) + digest(text) + \
+           zlib.compress(marshal.dumps(data))
+
+def loads(data, filename=None):
+    """ loads tree serialized by dumps(), filename replaces the saved one
+    """
+    if data[:len(magic)] != magic or data[len(magic)] != chr(version):
+        raise ValueError("not a pyjon tree of version %i" % version)
+    text, savedName, classNames, classes, types, lines, starts, ends, \
+        kids, offsets, values, attrNodes, attrNames, attrValues, pool = \
+        marshal.loads(zlib.decompress(data[len(magic) + 21:]))
+    file = lexer.SourceFile(text, filename or savedName)
+    nodeClass = [globals()[name] for name in classNames]
+    types = array("i", types)
+    lines = array("i", lines)
+    starts = array("i", starts)
+    ends = array("i", ends)
+    new = list.__new__
+    nodes = []
+    for i, c in enumerate(array("B", classes)):
+        x = new(nodeClass[c])
+        x.type_ = types[i]
+        x.file = file
+        lineno, start, end = lines[i], starts[i], ends[i]
+        if lineno != -1: x.lineno = lineno
+        if start != -1: x.start = start
+        if end != -1: x.end = end
+        nodes.append(x)
+
+    def decode(entry):
+        kind, x = entry
+        if kind == LITERAL:
+            return x
+        elif kind == NODE:
+            return nodes[x]
+        elif kind == LIST:
+            return map(decode, x)
+        labels = defs.StringMap()
+        for k, v in x.iteritems(): labels.set(k, decode(v))
+        return labels
+
+    kids = array("i", kids)
+    offsets = array("i", offsets)
+    extend = list.extend
+    for i, x in enumerate(nodes):
+        if offsets[i] < offsets[i + 1]:
+            extend(x, [nodes[k] for k in kids[offsets[i]:offsets[i + 1]]])
+    for i, v in enumerate(array("i", values)):
+        if v != -1: nodes[i].value = decode(pool[v])
+    for i, name, v in zip(array("i", attrNodes), array("i", attrNames), 
+                          array("i", attrValues)):
+        setattr(nodes[i], pool[name][1], decode(pool[v]))
+    return nodes[0]
+
+def compiledName(filename):
+    return os.path.splitext(filename)[0] + ".jsc"
+
+def compileFile(filename):
+    """ writes tree of script filename into its .jsc file, returns the
+        name of that
+    """
+    with open(filename) as f:
+        n = parse(f.read(), filename)
+    path = compiledName(filename)
+    with open(path, "wb") as f:
+        f.write(dumps(n))
+    return path
+
+def loadCompiled(filename, sourceDigest=None):
+    """ tree of script filename from its .jsc file, None if there is none,
+        it is older than the script, or it is not made from the source of 
+        sourceDigest (see digest())
+    """
+    path = compiledName(filename)
+    try:
+        if os.path.exists(filename) and \
+                os.path.getmtime(filename) > os.path.getmtime(path):
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    if sourceDigest is not None and \
+            data[len(magic) + 1:len(magic) + 21] != sourceDigest:
+        return None
+    try:
+        return loads(data, filename)
+    except (ValueError, EOFError, TypeError, zlib.error):
+        # of another version or python version, the script is parsed
+        return None
+
+#
+# Parse cache
+#
+# Scripts evaluated over and over (the same library on every request) are
+# parsed once, or loaded from their .jsc file. Trees are kept by the SHA-1
+# of their source, the filename, the first line number and whether they 
+# are lazy, the least recently used one is dropped when there are more 
+# than size of them. A tree is shared by everyone asking for the same 
+# source, so no one may change it: prepare(n) is run on a new tree before
+# it is shared (PyJS optimizes and resolves it there), variant tells apart
+# trees prepared differently. Lazy function bodies are parsed and resolved
+# under a lock. Shared trees are marked
+#
+#   n.shared = True
+#
+# The cache may be used by several threads at once.
+#
+class ParseCache(object):
+    def __init__(self, size=64):
+        if size < 1:
+            raise ValueError("size must be positive")
+        self.size = size
+        self.lock = threading.Lock()
+        self.trees = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # trees loaded from .jsc files
+        self.compiled = 0
+
+    def parse(self, source, filename=None, starting_line_number=1,
+                prepare=None, variant=None, lazy=False):
+        """ shared parse tree of source, see parse()
+        """
+        sourceDigest = digest(source)
+        key = (sourceDigest, filename, starting_line_number, variant, lazy)
+        with self.lock:
+            n = self.trees.pop(key, None)
+            if n is not None:
+                # the most recently used tree goes last
+                self.trees[key] = n
+                self.hits += 1
+                return n
+            self.misses += 1
+        # parsed out of the lock, not to hold up other threads, a script 
+        # compiled at deploy time is loaded instead
+        n = None
+        if filename is not None and starting_line_number == 1:
+            n = loadCompiled(filename, sourceDigest)
+        if n is None:
+            n = parse(source, filename, starting_line_number, lazy)
+        else:
+            self.compiled += 1
+        if prepare is not None:
+            n = prepare(n)
+        n.shared = True
+        with self.lock:
+            # another thread may have parsed it meanwhile
+            if key in self.trees:
+                return self.trees[key]
+            self.trees[key] = n
+            while len(self.trees) > self.size:
+                self.trees.popitem(last=False)
+                self.evictions += 1
+        return n
+
+    def stats(self):
+        with self.lock:
+            return dict(trees=len(self.trees), hits=self.hits, 
+                        misses=self.misses, evictions=self.evictions,
+                        compiled=self.compiled)
+
+    def clear(self):
+        with self.lock:
+            self.trees.clear()
+            self.hits = self.misses = self.evictions = self.compiled = 0
+
+# the cache of PyJS.eval_ and load_
+cache = ParseCache()
+
+if __name__ == "__main__":
+    # python -m pyjon.jsparser script.js ... writes script.jsc, ...
+    for filename in sys.argv[1:]:
+        print compileFile(filename)
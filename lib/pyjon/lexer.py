@@ -54,9 +54,9 @@ __author__ = "Burzak"
 __author_email__ = "buzzilo@gmail.com"
 __date__ = "2011-01-24"
 
-__all__ = ["ParseError", "Tokenizer"]
+__all__ = ["ParseError", "SourceFile", "Tokenizer", "CharTokenizer"]
 
-import defs, ast
+import defs, ast, re
 
 # Set constants in the local scope.
 defs.map(globals())
@@ -89,7 +89,69 @@ def parseInt(x):
 def parseFloat(x):
     return float(x)
 
-class Token : pass
+#
+# Master regexps of the tokenizer
+#
+# A token and the whitespace and comments in front of it are matched by 
+# one regexp, the name of the group matched tells the kind of token. 
+# Newlines are skipped unless they are tokens (scanNewlines), a newline 
+# ending a line comment is skipped always. Regexp literals are matched 
+# where an operand is expected only. There is a master regexp for each of
+# the four cases. Whitespace and comments are matched in a lookahead and 
+# taken by a backreference, so that a failing token cannot give back a 
+# part of them (python has no atomic groups).
+#
+skipping = r"(?:[ \t\n]+|//[^\n]*\n?|/\*.*?\*/)*"
+skippingLine = r"(?:[ \t]+|//[^\n]*\n?|/\*.*?\*/)*"
+skipRe = re.compile(skipping, re.S)
+skipLineRe = re.compile(skippingLine, re.S)
+
+# longest operators first, as the trie would match them
+operators = [op for op, name in defs.opTypeNames if op not in ('\n', '.')]
+operators.sort(key=len, reverse=True)
+
+tokenPatterns = r"""
+    (?P<ident>[a-zA-Z$_][a-zA-Z0-9$_]*)
+  | (?P<op>%s)
+  | (?P<number>0[xX][0-9a-fA-F]* | 0[0-7]+
+      | (?:[1-9][0-9]*(?:\.[0-9]*)? | 0(?:\.[0-9]*)? | \.[0-9]+)
+        (?:[eE][+-]?[0-9]*)?)
+  | (?P<string>"[^"\\]*(?:\\.[^"\\]*)*" | '[^'\\]*(?:\\.[^'\\]*)*')
+  | (?P<dot>\.)
+""" % "|".join(map(re.escape, operators))
+
+regexpPattern = r"""
+    (?P<regexp>/(?P<source>(?:[^/\\\[]|\\.|\[(?:[^\]\\]|\\.)*\])*)/
+                (?P<modifiers>[a-z]*))
+  | (?P<badregexp>/)
+"""
+
+def master(skipping, patterns):
+    patterns = [r"(?P<comment>/\*)"] + patterns
+    return re.compile(r"(?=(%s))\1(?:%s)" % (skipping, "|".join(patterns)), 
+                      re.S | re.X)
+
+tokenRe = master(skipping, [tokenPatterns])
+operandRe = master(skipping, [regexpPattern, tokenPatterns])
+tokenLineRe = master(skippingLine, [tokenPatterns, r"(?P<newline>\n)"])
+operandLineRe = master(skippingLine, [regexpPattern, tokenPatterns, 
+                                      r"(?P<newline>\n)"])
+
+opTypes = dict([(op, defs.tokenIds[name]) for op, name in defs.opTypeNames])
+
+class Token(object):
+    # the tokenizer keeps tokens in a ring of four and sets their fields
+    # as it scans, no token has other attributes than these
+    __slots__ = ("type_", "value", "assignOp", "start", "end", "lineno")
+
+class SourceFile(object):
+    # source and filename of a script, shared by the nodes parsed from it,
+    # which refer to their source by start and end
+    def __init__(self, text, filename=""):
+        self.text = text
+        self.filename = filename
+
+    __repr__ = lambda self: "<SourceFile %s>" % (self.filename or "?")
 
 class Tokenizer() :
     """
@@ -107,8 +169,8 @@ class Tokenizer() :
         self.unexpectedEOF = False
         self.filename = f
         self.lineno = l
+        self.file = SourceFile(self.source, f)
 
-    char = property(lambda self: self.source[self.cursor:self.cursor+1])
     # We need to set scanOperand to true here because the first thing
     # might be a regexp.
     done = property(lambda self: self.peek(True) == END)
@@ -141,6 +203,161 @@ class Tokenizer() :
         self.scanNewlines = False
         return tt
 
+    # Eat comments and whitespace.
+    def skip(self) :
+        input = self.source
+        cursor = self.cursor
+        m = (self.scanNewlines and skipLineRe or skipRe).match(input, cursor)
+        end = m.end()
+        if end > cursor:
+            self.lineno += input.count("\n", cursor, end)
+            self.cursor = end
+
+    def lex(self, token, scanOperand) :
+        """ skips to the next token and scans it by a master regexp
+        """
+        input = self.source
+        cursor = self.cursor
+        if scanOperand:
+            master = self.scanNewlines and operandLineRe or operandRe
+        else:
+            master = self.scanNewlines and tokenLineRe or tokenRe
+        m = master.match(input, cursor)
+        if m is None:
+            # at the end or at something that is not a token
+            self.skip()
+            if (self.cursor == len(input)) :
+                token.type_ = END
+                token.start = token.end = self.cursor
+                if not hasattr(token, "lineno"):
+                    token.lineno = 1
+                return
+            ch = input[self.cursor]
+            if ch == '"' or ch == "'":
+                raise self.newSyntaxError("Unterminated string literal")
+            raise self.newSyntaxError("Illegal token")
+
+        kind = m.lastgroup
+        start = m.start(kind)
+        if start > cursor:
+            self.lineno += input.count("\n", cursor, start)
+        token.start = start
+        token.lineno = self.lineno
+        self.cursor = end = m.end()
+        if kind == "ident":
+            text = m.group(kind)
+            token.type_ = defs.jsKeywords.get(text) or IDENTIFIER
+            token.value = text
+        elif kind == "op":
+            text = m.group(kind)
+            if text in defs.assignOps and input.startswith('=', end):
+                self.cursor += 1
+                token.type_ = ASSIGN
+                token.assignOp = opTypes[text]
+                text += '='
+            else:
+                token.type_ = opTypes[text]
+                token.assignOp = None
+            token.value = text
+        elif kind == "number":
+            token.type_ = NUMBER
+            token.value = self.number(m.group(kind))
+        elif kind == "string":
+            text = m.group(kind)
+            token.type_ = STRING
+            if '\\' in text:
+                # safely translate JS string into python bytes
+                token.value = ast.literal_eval(text) # no eval() here!
+            else:
+                token.value = text[1:-1]
+        elif kind == "dot":
+            token.type_ = DOT
+            token.assignOp = None
+            token.value = '.'
+        elif kind == "regexp":
+            token.type_ = REGEXP
+            token.value = {
+                "regexp" : m.group("source"),
+                "modifiers" : m.group("modifiers")
+            }
+        elif kind == "newline":
+            token.type_ = NEWLINE
+            token.value = '\n'
+            self.lineno += 1
+        elif kind == "comment":
+            self.cursor = start
+            raise self.newSyntaxError("Unterminated comment")
+        else:
+            self.cursor = start
+            raise self.newSyntaxError("Unterminated regex")
+        token.end = self.cursor
+
+    def number(self, text) :
+        if text[:2] in ("0x", "0X"):
+            return parseInt(text)
+        exponent = 'e' in text or 'E' in text
+        if exponent and not text[-1].isdigit():
+            raise self.newSyntaxError("Missing exponent")
+        if '.' in text:
+            return parseFloat(text)
+        elif text[0] == '0':
+            # octal, 0 with an exponent is still 0
+            return not exponent and parseInt(text) or 0
+        elif exponent:
+            return parseFloat(text)
+        return int(text)
+
+    def get(self, scanOperand=False) :
+        """
+        /*
+         * Tokenizer.get :: void -> token.type_
+         *
+         * Consume input *only* if there is no lookahead.
+         */
+        """
+        while (self.lookahead) :
+            self.lookahead -= 1
+            self.tokenIndex = (self.tokenIndex + 1) & 3
+            token = self.tokens.get(self.tokenIndex)
+            if (token.type_ != NEWLINE or self.scanNewlines) :
+                return token.type_
+
+        self.tokenIndex = (self.tokenIndex + 1) & 3
+        token = self.tokens.get(self.tokenIndex)
+        if (not token) :
+            token = Token()
+            self.tokens[self.tokenIndex] = token
+
+        self.lex(token, scanOperand)
+        return token.type_
+
+    """
+    /*
+     * Tokenizer.unget :: void -> undefined
+     *
+     * Match depends on unget returning undefined.
+     */
+    """
+    def unget(self) :
+        self.lookahead += 1
+        if (self.lookahead == 4): raise "PANIC: too much lookahead!"
+        self.tokenIndex = (self.tokenIndex - 1) & 3
+
+    def newSyntaxError(self, m) :
+        e = SyntaxError_(m, self.filename, self.lineno)
+        e.source = self.source
+        if self.lookahead:
+            e.cursor = self.tokens[(self.tokenIndex + self.lookahead) & 3].start
+
+        return e
+
+#
+# Tokenizer reading the source one character at a time, as it was before 
+# the master regexps, kept for comparison (bench.tokens).
+#
+class CharTokenizer(Tokenizer) :
+    char = property(lambda self: self.source[self.cursor:self.cursor+1])
+
     # Eat comments and whitespace.
     def skip(self) :
         input = self.source
@@ -157,7 +374,7 @@ class Tokenizer() :
                 while True :
                     ch = self.char
                     self.cursor += 1
-                    if (ch == None) :
+                    if (ch == '') :
                         raise self.newSyntaxError("Unterminated comment")
 
                     if (ch == '*') :
@@ -173,7 +390,7 @@ class Tokenizer() :
                 while True :
                     ch = self.char
                     self.cursor += 1
-                    if (ch == None) :
+                    if (ch == '') :
                         return
 
                     if (ch == "\n") :
@@ -336,7 +553,7 @@ class Tokenizer() :
 
             elif (ch == '[') :
                 while True :
-                    if (ch == None) :
+                    if (ch == '') :
                         raise self.newSyntaxError("Unterminated character class")
 
                     if (ch == '\\') :
@@ -347,7 +564,7 @@ class Tokenizer() :
                     if ch == ']': break;
                     regexp += ch
 
-            elif (ch == None) :
+            elif (ch == '') :
                 raise self.newSyntaxError("Unterminated regex")
 
             if ch == '/': break
@@ -416,36 +633,17 @@ class Tokenizer() :
         token.type_ = defs.jsKeywords.get(id) or IDENTIFIER
         token.value = id
 
-    def get(self, scanOperand=False) :
-        """
-        /*
-         * Tokenizer.get :: void -> token.type_
-         *
-         * Consume input *only* if there is no lookahead.
-         * Dispatch to the appropriate lexing function depending on the input.
-         */
-        """
-        while (self.lookahead) :
-            self.lookahead -= 1
-            self.tokenIndex = (self.tokenIndex + 1) & 3
-            token = self.tokens.get(self.tokenIndex)
-            if (token.type_ != NEWLINE or self.scanNewlines) :
-                return token.type_
-
+    # Dispatch to the appropriate lexing function depending on the input.
+    def lex(self, token, scanOperand) :
         self.skip()
 
-        self.tokenIndex = (self.tokenIndex + 1) & 3
-        token = self.tokens.get(self.tokenIndex)
-        if (not token) :
-            token = Token()
-            self.tokens[self.tokenIndex] = token
-
         input = self.source
         if (self.cursor == len(input)) :
             token.type_ = END
+            token.start = token.end = self.cursor
             if not hasattr(token, "lineno"):
                 token.lineno = 1
-            return token.type_
+            return
 
         token.start = self.cursor
         token.lineno = self.lineno
@@ -476,24 +674,3 @@ class Tokenizer() :
             raise self.newSyntaxError("Illegal token")
 
         token.end = self.cursor
-        return token.type_
-
-    """
-    /*
-     * Tokenizer.unget :: void -> undefined
-     *
-     * Match depends on unget returning undefined.
-     */
-    """
-    def unget(self) :
-        self.lookahead += 1
-        if (self.lookahead == 4): raise "PANIC: too much lookahead!"
-        self.tokenIndex = (self.tokenIndex - 1) & 3
-
-    def newSyntaxError(self, m) :
-        e = SyntaxError_(m, self.filename, self.lineno)
-        e.source = self.source
-        if self.lookahead:
-            e.cursor = self.tokens[(self.tokenIndex + self.lookahead) & 3].start
-
-        return e
@@ -52,7 +52,7 @@ class NodeToJS():
         try:
             self.check(n, attrs=["append", "count", "extend", "filename", "getSource",
                                  "indentLevel", "index", "insert", "lineno", "pop",
-                                 "remove", "reverse", "sort", "tokenizer", "type", "type_",
+                                 "remove", "reverse", "sort", "file", "type", "type_",
                                  "commentBefore", "whitespaces"],
                           optattrs=["end", "start", "value", "labels", 
                                     "assignWhitespace","parenthesized"])
@@ -88,7 +88,8 @@ class NodeToJS():
         finally:
             if not self.had_error:
                 current = self.stack.pop()
-                realkeys = [x for x in dir(n) if x[:2] != "__"]
+                realkeys = [x for x in dir(n) if x[:2] != "__" and
+                        hasattr(n, x)]
                 for key in realkeys:
                     if key not in current['attrs']:
                         raise ProgrammerError, "key '%s' unchecked on node %s!" % (
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+#
+# Optimization passes for PyJS.
+# ------------------------------------------------------------------------------
+#
+# Rewrites a parse tree between jsparser.parse() and its execution, so that
+# work which does not depend on the run is done only once:
+#
+#   inline      calls of small functions, whose body is a single return of
+#               an expression of their parameters, are replaced by the
+#               expression with the arguments put in place of parameters
+#   fold        operators with constant operands are replaced by their result
+#   dce         branches of if, ?:, && and || on constant conditions, loops
+#               which never run and statements after return, break,
+#               continue and throw are dropped
+#   switch      switch statements with constant case labels get a jump table
+#               n.jumpTable = {label value: case index}, which the engines
+#               look the discriminant up in instead of comparing it with
+#               every label
+#
+# Passes run in this order, any of them can be left out. Constant operators
+# are folded by the tree walker itself, so that the result never differs
+# from what the engines would compute. Nothing declaring a variable or
+# a function is dropped, as declarations are hoisted.
+#
+# Usage:
+#
+#   n = optimizer.optimize(jsparser.parse(source), ["fold", "dce"])
+#
+# or PyJS(optimize=True) for all the passes.
+#
+
+__all__ = ["optimize", "passes"]
+
+import copy
+
+import defs
+from resolver import children, childAttrs, declarations
+import interpr
+from interpr import *
+
+defs.map(globals())
+
+# names of passes in order of application and the passes by name, filled
+# in by @optimization
+passes = []
+optimizations = {}
+
+def optimization(name):
+    def register(f):
+        passes.append(name)
+        optimizations[name] = f
+        return f
+    return register
+
+def optimize(n, names=None):
+    """ runs passes of given names (all if None) on script n, returns
+        the optimized script
+    """
+    names = names is None and passes or names
+    for name in names:
+        if name not in optimizations:
+            raise ValueError("unknown optimization %r" % name)
+    for name in passes:
+        if name in names:
+            n = optimizations[name](n)
+    return n
+
+#
+# tree rewriting
+#
+isNode = lambda x: hasattr(x, "type_")
+
+def replace(n, f):
+    """ replaces every child x of n by f(x)
+    """
+    for i, x in enumerate(n):
+        if isNode(x): n[i] = f(x)
+    for attr in childAttrs:
+        x = getattr(n, attr, None)
+        if isNode(x): setattr(n, attr, f(x))
+    if n.type_ == SWITCH:
+        n.cases = [f(x) for x in n.cases]
+    elif n.type_ == TRY:
+        n.catchClauses = [f(x) for x in n.catchClauses]
+    elif n.type_ in (RETURN, YIELD) and isNode(n.value):
+        n.value = f(n.value)
+
+def transform(n, f):
+    """ replaces every node x of tree n by f(x), bottom up
+    """
+    replace(n, lambda x: transform(x, f))
+    return f(n)
+
+def walk(n):
+    yield n
+    for x in children(n):
+        for y in walk(x): yield y
+
+def clone(n, bound={}):
+    """ copy of expression n, identifiers named in bound are replaced by
+        copies of their nodes
+    """
+    if n.type_ == IDENTIFIER and n.value in bound:
+        return clone(bound[n.value])
+    x = copy.copy(n)
+    # annotations of execution belong to the original
+    for attr in ("slot", "ic"):
+        if hasattr(x, attr): delattr(x, attr)
+    replace(x, lambda y: clone(y, bound))
+    return x
+
+def node(n, type_, value=None):
+    """ new node of type_ at the source position of n
+    """
+    x = list.__new__(n.__class__)
+    for attr in ("file", "lineno", "start", "end", "parenthesized"):
+        if hasattr(n, attr): setattr(x, attr, getattr(n, attr))
+    x.type_ = type_
+    x.value = value
+    return x
+
+def declares(n):
+    """ True if n declares a variable or a function
+    """
+    return n.type_ in (VAR, LET, CONST, FUNCTION) or bool(declarations(n, []))
+
+#
+# constants
+#
+constants = (NUMBER, STRING, TRUE, FALSE, NULL)
+
+# operators folded when their operands are constant
+operators = (PLUS, MINUS, MUL, DIV, MOD, UNARY_PLUS, UNARY_MINUS,
+             BITWISE_OR, BITWISE_XOR, BITWISE_AND, BITWISE_NOT,
+             LSH, RSH, URSH, NOT, AND, OR, HOOK, GROUP, TYPEOF,
+             EQ, NE, STRICT_EQ, STRICT_NE, LT, LE, GT, GE)
+
+def constant(n, value):
+    """ literal of value in place of n, None if value has no literal
+    """
+    if isBoolean(value):
+        return node(n, value and TRUE or FALSE, value and "true" or "false")
+    elif isNumber(value) and not (isNaN(value) or isInfinity(value)):
+        return node(n, NUMBER, value)
+    elif isString(value):
+        return node(n, STRING, value)
+
+def truth(n):
+    """ truth value of constant node n, None if it is not constant
+    """
+    t = n.type_
+    if t == NUMBER: return toNumber(n.value) != 0
+    elif t == STRING: return len(n.value) > 0
+    elif t == TRUE: return True
+    elif t in (FALSE, NULL): return False
+
+#
+# passes
+#
+@optimization("inline")
+def inline(n):
+    # any other binding of the name, eval or with might make the call
+    # refer to something else
+    bindings = {}
+    for x in walk(n):
+        t = x.type_
+        if t == WITH or t == IDENTIFIER and x.value == "eval":
+            return n
+        names = ()
+        if t == FUNCTION:
+            names = list(x.params)
+            if x.functionForm == 0: names.append(x.name)
+        elif t in (VAR, LET, CONST):
+            names = [y.value for y in x if isinstance(y.value, basestring)]
+        elif t in (ASSIGN, INCREMENT, DECREMENT, DELETE) and \
+                x[0].type_ == IDENTIFIER:
+            names = [x[0].value]
+        elif t == FOR_IN and x.iterator.type_ == IDENTIFIER:
+            names = [x.iterator.value]
+        elif t == TRY:
+            names = [c.varName for c in x.catchClauses]
+        for name in names:
+            if not isinstance(name, basestring): continue
+            bindings[name] = bindings.get(name, 0) + 1
+
+    def inlinable(f):
+        if f.type_ != FUNCTION or f.functionForm != 0 or \
+                bindings.get(f.name) != 1 or \
+                len(set(f.params)) != len(f.params) or \
+                len(f.body) != 1 or f.body[0].type_ != RETURN or \
+                not isNode(f.body[0].value):
+            return False
+        def simple(x):
+            if x.type_ in constants: return True
+            elif x.type_ == IDENTIFIER: return x.value in f.params
+            elif x.type_ in operators:
+                for y in x:
+                    if not simple(y): return False
+                return True
+            return False
+        return simple(f.body[0].value)
+
+    def expand(f, call):
+        args = list(call[1])
+        if len(args) != len(f.params): return None
+        expression = f.body[0].value
+        used = set([x.value for x in walk(expression)
+                        if x.type_ == IDENTIFIER])
+        bound = {}
+        for name, arg in zip(f.params, args):
+            # arguments are evaluated once by the call, so only those
+            # without side effects may be copied in or left out
+            if arg.type_ not in constants and \
+                    not (arg.type_ == IDENTIFIER and name in used):
+                return None
+            bound[name] = arg
+        x = clone(expression, bound)
+        x.parenthesized = True
+        return x
+
+    def substitute(x, scope):
+        # functions are visible in the body declaring them
+        if x.type_ == SCRIPT:
+            scope = dict(scope)
+            for y in x:
+                if inlinable(y): scope[y.name] = y
+        replace(x, lambda y: substitute(y, scope))
+        if x.type_ == CALL and x[0].type_ == IDENTIFIER and \
+                x[0].value in scope:
+            return expand(scope[x[0].value], x) or x
+        return x
+
+    return substitute(n, {})
+
+# constant operators are evaluated by the tree walker, a context without
+# any variables is enough for them
+evaluator = None
+
+@optimization("fold")
+def fold(n):
+    global evaluator
+    if evaluator is None: evaluator = interpr.JS_Context()
+    def fold(x):
+        if x.type_ not in operators: return x
+        for y in x:
+            if y.type_ not in constants: return x
+        try:
+            value = evaluator.exec_(x)
+        except Exception, e:
+            # left for the run to fail the same way
+            return x
+        return constant(x, value) or x
+    return transform(n, fold)
+
+@optimization("dce")
+def dce(n):
+    def empty(x): return node(x, BLOCK)
+    def dce(x):
+        t = x.type_
+        if t == IF:
+            value = truth(x.condition)
+            if value is None: return x
+            live, dead = x.thenPart, x.elsePart
+            if not value: live, dead = dead, live
+            if isNode(dead) and declares(dead): return x
+            if isNode(live): return live
+            return empty(x)
+        elif t == HOOK:
+            value = truth(x[0])
+            if value is None: return x
+            if value: return x[1]
+            return x[2]
+        elif t in (AND, OR):
+            # like the tree walker, the value is the operand deciding it
+            value = truth(x[0])
+            if value is None: return x
+            if value == (t == AND): return x[1]
+            return x[0]
+        elif t == WHILE:
+            if truth(x.condition) is False and not declares(x.body):
+                return empty(x)
+        elif t in (SCRIPT, BLOCK):
+            unreachable(x)
+        elif t == SWITCH:
+            for case in x.cases: unreachable(case.statements)
+        return x
+    def unreachable(block):
+        # statements after a jump, but declarations
+        for i, y in enumerate(block):
+            if y.type_ in (RETURN, BREAK, CONTINUE, THROW):
+                block[i + 1:] = [z for z in block[i + 1:] if declares(z)]
+                break
+    return transform(n, dce)
+
+@optimization("switch")
+def switch(n):
+    def label(x):
+        if x.type_ == NUMBER: return toNumber(x.value)
+        elif x.type_ == STRING: return x.value
+        return nan
+    def table(x):
+        if x.type_ != SWITCH: return x
+        labels = [(i, label(case.caseLabel)) for i, case in
+                    enumerate(x.cases) if case.type_ == CASE]
+        for i, value in labels:
+            if isNaN(value): return x
+        if labels:
+            # the first of equal labels wins, as it is compared first
+            x.jumpTable = {}
+            for i, value in labels:
+                x.jumpTable.setdefault(value, i)
+        return x
+    return transform(n, table)
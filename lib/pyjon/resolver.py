@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+#
+# Scope resolution for PyJS.
+# ------------------------------------------------------------------------------
+#
+# Walks a parse tree once before it is executed and gives every variable
+# a static address, so that the interpreter reads and writes variables by
+# index instead of searching dictionaries of the whole scope chain.
+#
+# Every function gets a layout of its local variables:
+#
+#   f.scopeNames = [param, ..., "arguments", var or function, ...]
+#
+# which is the layout of the frame list of the JS_Context executing the
+# function. "arguments" is left out unless the body refers to it or calls
+# eval, then calls need not build the arguments object. Catch clauses get
+# a layout of one slot for the exception.
+#
+# Every identifier referring to a variable (and every declaration of one)
+# gets an address:
+#
+#   n.slot = (depth, index)
+#
+# where depth is the number of scopes to go up from the current one,
+# or None if the variable is global (declared at top level or not at all),
+# then it is stored in the global object as before.
+#
+# Local variables, which statements x += y append to, keep a string 
+# builder instead of the string while it is built up (see 
+# interpr.StringBuilder). The targets of these statements get
+#
+#   n.builder = True
+#
+# and every identifier referring to such variable gets
+#
+#   n.flatten = True
+#
+# telling the engines to turn the builder into string when it is read.
+#
+# Bodies of lazy functions, which are not parsed yet, are left alone, the
+# function gets the enclosing layouts instead
+#
+#   f.scopes = [scope, ...]
+#
+# and its body is resolved in them when it is parsed (see 
+# jsparser.LazyFunction). Variables it may refer to keep no builder.
+#
+
+__all__ = ["resolve", "resolveFunction"]
+
+import defs
+
+defs.map(globals())
+
+# attributes of nodes holding sub-nodes, besides of the list items
+childAttrs = ("condition", "thenPart", "elsePart", "body", "setup", "update",
+              "object", "iterator", "discriminant", "tryBlock", "finallyBlock",
+              "expression", "initializer", "exception", "caseLabel",
+              "statements", "block", "guard", "variables")
+
+def children(n):
+    # bodies of lazy functions are not parsed for walking the tree
+    if not getattr(n, "parsed", True): return
+    for x in n:
+        if x is not None: yield x
+    for attr in childAttrs:
+        x = getattr(n, attr, None)
+        if x is not None: yield x
+    if n.type_ == SWITCH:
+        for x in n.cases: yield x
+    elif n.type_ == TRY:
+        for x in n.catchClauses: yield x
+    elif n.type_ in (RETURN, YIELD) and n.value is not None:
+        yield n.value
+
+def declarations(body, names):
+    """ collects names of variables and functions declared in function
+        body, nested functions are not entered
+    """
+    for n in children(body):
+        t = n.type_
+        if t == FUNCTION:
+            if n.functionForm == 0 and getattr(n, "name", None):
+                names.append(n.name)
+            continue
+        elif t in (VAR, LET, CONST):
+            for x in n:
+                if isinstance(x.value, basestring): names.append(x.value)
+        declarations(n, names)
+    return names
+
+class Scope(dict):
+    """ layout of function scope, name: index, refs are the identifiers
+        referring to its variables by name, hidden are names appearing in
+        lazy functions
+    """
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.refs = {}
+        self.hidden = set()
+
+def appends(n, targets):
+    """ collects targets of statements x += y, where x is an identifier
+    """
+    for x in children(n):
+        if x.type_ == SEMICOLON:
+            e = getattr(x, "expression", None)
+            if e is not None and e.type_ == ASSIGN and \
+                    e.assignOp == PLUS and e[0].type_ == IDENTIFIER:
+                targets.append(e[0])
+        appends(x, targets)
+    return targets
+
+def usesArguments(body):
+    """ tells whether function body refers to arguments or eval, nested
+        functions are not entered, they have arguments of their own
+    """
+    for n in children(body):
+        t = n.type_
+        if t == FUNCTION: continue
+        elif t == IDENTIFIER and n.value in ("arguments", "eval"):
+            return True
+        elif usesArguments(n): return True
+    return False
+
+def lookup(scopes, name):
+    depth = 0
+    for scope in reversed(scopes):
+        if name in scope:
+            return (depth, scope[name])
+        depth += 1
+    return None
+
+def resolveNode(n, scopes):
+    t = n.type_
+    if t == FUNCTION:
+        if n.functionForm == 0 and getattr(n, "name", None):
+            n.slot = lookup(scopes, n.name)
+        if not getattr(n, "parsed", True):
+            n.scopes = scopes
+            for scope in scopes:
+                if isinstance(scope, Scope):
+                    scope.hidden.update(n.identifiers)
+            return
+        resolveFunction(n, scopes)
+        return
+
+    elif t == IDENTIFIER:
+        if isinstance(n.value, basestring):
+            n.slot = lookup(scopes, n.value)
+            if n.slot:
+                scope = scopes[-1 - n.slot[0]]
+                if isinstance(scope, Scope):
+                    scope.refs.setdefault(n.value, []).append(n)
+
+    elif t == TRY:
+        resolveNode(n.tryBlock, scopes)
+        for catch in n.catchClauses:
+            if isinstance(catch.varName, basestring):
+                catch.scopeNames = [catch.varName]
+                inner = scopes + [{catch.varName: 0}]
+            else:
+                catch.scopeNames = []
+                inner = scopes + [{}]
+            if getattr(catch, "guard", None):
+                resolveNode(catch.guard, inner)
+            resolveNode(catch.block, inner)
+        if getattr(n, "finallyBlock", None):
+            resolveNode(n.finallyBlock, scopes)
+        return
+
+    elif t == DOT:
+        # property name is not a variable
+        resolveNode(n[0], scopes)
+        return
+
+    elif t == PROPERTY_INIT:
+        resolveNode(n[1], scopes)
+        return
+
+    for x in children(n):
+        resolveNode(x, scopes)
+
+def resolveFunction(f, scopes=[], body=None):
+    """ resolves function node f (or anything having params and body),
+        scopes are layouts of enclosing scopes, outermost first, body is
+        the body of f, if it is being parsed
+    """
+    if body is None: body = f.body
+    # parameters take first slots, so that arguments are copied into 
+    # frame by position, the last one wins if names are repeated
+    names = list(f.params)
+    scope = Scope([(name, i) for i, name in enumerate(names)])
+    declared = declarations(body, [])
+    if usesArguments(body): declared.insert(0, "arguments")
+    for name in declared:
+        if name not in scope:
+            scope[name] = len(names)
+            names.append(name)
+    f.scopeNames = names
+    resolveNode(body, scopes + [scope])
+    for x in appends(body, []):
+        if x.value in scope.hidden: continue
+        refs = scope.refs.get(x.value, ())
+        for y in refs:
+            if y is x: break
+        else: continue
+        x.builder = True
+        for y in refs: y.flatten = True
+
+def resolve(n):
+    """ resolves top level script n
+    """
+    resolveNode(n, [])
+    return n
@@ -0,0 +1,685 @@
+import copy, os, pickle, shutil, StringIO, tempfile, threading, unittest
+
+from pyjon import bytecode, interpr, jsparser, lexer, optimizer, resolver
+
+
+class EngineTestsMixin(object):
+    # This does not inherit from TestCase so that the same tests are run
+    # against every engine by the TestCase subclasses below.
+
+    engine = None # subclasses must specify
+    optimize = False
+
+    def setUp(self):
+        self.js = interpr.PyJS(engine=self.engine, optimize=self.optimize)
+
+    def eval(self, source, var='r'):
+        self.js.eval_(source)
+        return self.js[var]
+
+    def test_shared_functions(self):
+        with open('core/shared-functions.js') as f:
+            source = f.read()
+        self.assertEqual(self.eval(source + 'var r = add(1, 2)'), 3)
+
+    def test_recursion(self):
+        self.assertEqual(self.eval('function fib(n) { if (n < 2) return n; '
+                                   'return fib(n-1) + fib(n-2) } '
+                                   'var r = fib(10)'), 55)
+
+    def test_closure(self):
+        self.assertEqual(self.eval('function mk() { var c = 0; '
+                                   'return function() { return ++c } } '
+                                   'var f = mk(); f(); var r = f()'), 2)
+
+    def test_return_from_loop(self):
+        self.assertEqual(self.eval('function f() { for (var i = 0; i < 10; i++) '
+                                   '{ if (i == 3) return i } return 99 } '
+                                   'var r = f()'), 3)
+
+    def test_break_continue(self):
+        self.assertEqual(self.eval('var a = []; for (var i = 0; i < 5; i++) { '
+                                   'if (i == 1) continue; if (i == 3) break; '
+                                   'a.push(i) } var r = a.join()'), '0,2')
+
+    def test_switch(self):
+        self.assertEqual(self.eval('function g(x) { switch (x) { '
+                                   'case 1: x = 5; break; default: x = 7 } '
+                                   'return x } var r = g(1) + g(2)'), 12)
+
+    def test_increment(self):
+        self.assertEqual(self.eval('var i = 5; '
+                                   'var r = [i++, i, ++i, i--, --i].join()'),
+                         '5,6,7,7,5')
+
+    def test_try_catch(self):
+        self.assertEqual(self.eval('var r; try { null.x } '
+                                   'catch (e) { r = "caught" }'), 'caught')
+
+    def test_scopes(self):
+        self.assertEqual(self.eval('var x = 1; function f(a) { '
+                                   'function g() { return a + x + y } '
+                                   'var y = 10; x = 2; return g() } '
+                                   'var r = f(100) + x'), 114)
+
+    def test_hoisting(self):
+        self.assertEqual(self.eval('var x = "global"; function f() { '
+                                   'var r = x; var x = 1; return r } '
+                                   'var r = typeof f()'), 'undefined')
+
+    def test_completion(self):
+        self.assertEqual(self.eval('var log = []; function f(x) { '
+                                   'for (var i = 0; ; i++) { try { '
+                                   'if (i == x) null.x; if (i > 3) return -1 '
+                                   '} catch (e) { return i } '
+                                   'finally { log.push(i) } } } '
+                                   'var r = [f(2), f(9), log.join("")].join()'),
+                         '2,-1,01201234')
+
+    def test_throwing_finally(self):
+        self.assertEqual(self.eval('var s = []; function f() { for (;;) { '
+                                   'try { try { return 1 } finally { '
+                                   's.push("f"); throw new Error("c") } } '
+                                   'catch (e) { s.push(e.message); break } } } '
+                                   'f(); var r = s.join()'), 'f,c')
+
+    def test_function_objects(self):
+        self.eval('var fs = []; for (var i = 0; i < 3; i++) '
+                  '{ fs.push(function() { return this.x }) } '
+                  'fs[0].prototype.x = 1; '
+                  'var r = [new fs[0]().x, fs[0].prototype === fs[1].prototype ? 1 : 0, '
+                  '(7).toString(2)].join()')
+        self.assertEqual(self.js['r'], '1,0,111')
+        fs = self.js['fs']
+        self.assertTrue(type(fs[0]) is type(fs[1]))
+        self.assertTrue(type(interpr.number_proto(1)) is 
+                        type(interpr.number_proto(2)))
+
+    def test_primitives(self):
+        self.assertEqual(self.eval('String.prototype.shout = function() { '
+                                   'return this + "!" + this.length }; '
+                                   'var s = "abc"; s.x = 1; '
+                                   'var r = [s.shout(), s[1], s.length, '
+                                   '(10).toString(2), true.toString(), '
+                                   'typeof s.x].join()'),
+                         'abc!3,b,3,1010,true,undefined')
+
+    def test_inline_cache(self):
+        self.eval('function P() {} P.prototype.f = function() { return 1 }; '
+                  'var p = new P(), q = { f: function() { return 4 } }; '
+                  'var a = []; for (var i = 0; i < 4; i++) { '
+                  'if (i == 1) P.prototype.f = function() { return 2 }; '
+                  'if (i == 2) p.f = function() { return 3 }; '
+                  'a.push(p.f()) } '
+                  'for (var i = 0; i < 2; i++) { a.push([p, q][i].f()) } '
+                  'var r = a.join("")')
+        self.assertEqual(self.js['r'], '123334')
+        # __proto__ assigned after the cache learned it from the class
+        self.assertEqual(self.eval('Array.prototype.p = 1; '
+                                   'var o = [], b = { p: 2 }, a = []; '
+                                   'for (var i = 0; i < 4; i++) { '
+                                   'if (i == 2) o.__proto__ = b; '
+                                   'a.push(o.p) } var r = a.join("")'),
+                         '1122')
+
+    def test_stack_trace(self):
+        source = ('function inner(o) {\n'
+                  '  return o.x.y }\n'
+                  'function outer() { return inner({}) }\n'
+                  'for (var i = 0; i < 3; i++) inner({ x: {} });\n'
+                  'var r; try { outer() } catch (e) { r = e.stack }')
+        self.assertEqual(self.eval(source), 
+                         'inner()@:2\nouter()@:3\n@:5')
+        self.assertEqual(len(self.js.callStack), 1)
+        for mode in ("off", "full"):
+            self.js = interpr.PyJS(engine=self.engine, stack=mode)
+            self.eval(source)
+            self.assertEqual(len(self.js.callStack), 1)
+        self.assertEqual(self.js['r'], 'inner()@:2\nouter()@:3\n@:5')
+
+    def test_stack_overflow_lines(self):
+        # frames beyond maxStack are not pushed, their call sites must not
+        # overwrite the line of the last frame that was
+        source = ('function inner() { measure() }\n'
+                  'function middle() {\n'
+                  '  var x = 1;\n'
+                  '  inner() }\n'
+                  'function outer() { middle() }\n'
+                  'outer()')
+        maxStack = interpr.JS_Context.maxStack
+        interpr.JS_Context.maxStack = 2
+        try:
+            for mode in ("functions", "full"):
+                frames = []
+                self.js = interpr.PyJS(engine=self.engine, stack=mode)
+                self.js.globals.measure = lambda this: frames.append(
+                    [f[2] for f in self.js.callStack])
+                self.eval(source)
+                self.assertEqual(frames, [[6, 5]])
+        finally:
+            interpr.JS_Context.maxStack = maxStack
+
+    def test_type_feedback(self):
+        # operators see ints, then floats and strings
+        self.assertEqual(self.eval('function op(a, b) { return [a + b, '
+                                   'a * b, a / b, a % b, a < b ? 1 : 0].join() } '
+                                   'var r = [], args = [[7, 2], [-7, 2], '
+                                   '[3037000500, 3037000500], [7, 0], '
+                                   '[2.5, 0.5], ["a", 1]]; '
+                                   'for (var i = 0; i < args.length; i++) '
+                                   'r.push(op(args[i][0], args[i][1])); '
+                                   'r = r.join(";")'),
+                         '9,14,3.5,1,0;-5,-14,-3.5,-1,1;'
+                         '6074001000,9223372037000250000,1.0,0,0;'
+                         '7,0,Infinity,NaN,0;3.0,1.25,5.0,0.0,0;a1,NaN,NaN,NaN,0')
+
+    def test_arrays(self):
+        self.assertEqual(self.eval('var a = [1, 2, 3]; a[5] = 6; '
+                                   'var b = []; b[1000000] = 1; b[0] = 0; '
+                                   'var n = b.length; b.pop(); b[1] = 2; '
+                                   'var k = []; for (var p in b) k.push(p); '
+                                   'var c = new Array(5000); c[4999] = 1; '
+                                   'var r = [a.length, a.join("-"), n, '
+                                   'b.length, k.join(""), Array(3).length, '
+                                   'c.length, typeof c[0], [null, undefined].join()'
+                                   '].join(";")'),
+                         '6;1-2-3---6;1000001;1000000;01;3;5000;undefined;,')
+
+    def test_array_length(self):
+        self.assertEqual(self.eval('var a = [1, 2, 3]; a.length = 1; '
+                                   'var b = []; b[100000] = 1; b[5] = 5; '
+                                   'b.length = 10; var n = b.length; '
+                                   'b.length = 1000000; b.length = 6; '
+                                   'var c = [1]; c.length = 3; '
+                                   'var r = [a.join(), a.length, n, '
+                                   'b.join(), c.join("-"), c.length].join(";")'),
+                         '1;1;10;,,,,,5;1--;3')
+
+    def test_array_methods(self):
+        self.assertEqual(self.eval('var a = [3, 1, 2], o = { k: 10 }, s = 0; '
+                                   'a.forEach(function(x) { s += x }); '
+                                   'var b = [1, 2, 3, 4], e = [1, 2, 3]; '
+                                   'var rm = b.splice(1, 2, "x", "y"); '
+                                   'e.reverse(); e.shift(); e.unshift(7); '
+                                   'var r = [a.map(function(x, i) { '
+                                   'return x * this.k + i }, o), '
+                                   'a.filter(function(x) { return x > 1 }), '
+                                   's, a.reduce(function(p, x) { '
+                                   'return p + x }, "")'
+                                   ', b, rm, [10, 9, undefined, 1].sort(), '
+                                   '[10, 9, 1].sort(function(x, y) { '
+                                   'return x - y }), e, '
+                                   '[1, "1"].indexOf("1"), a.indexOf(o), '
+                                   'a.concat([4], 5).length].join(";")'),
+                         '30,11,22;3,2;6;312;1,x,y,4;2,3;1,10,9,;1,9,10;'
+                         '7,2,1;1;-1;5')
+        self.assertRaises(interpr.TypeError_, self.eval, 
+                          '[].reduce(function() {})')
+
+    def test_index_of(self):
+        self.assertEqual(self.eval('var a = [3, 2, "a,b", true, 1, 3]; '
+                                   'var r = [a.indexOf(1.5 * 2), '
+                                   'a.indexOf(4 / 2), '
+                                   'a.indexOf(["a", "b"].join()), '
+                                   'a.indexOf(1 == 1), a.indexOf("3"), '
+                                   'a.lastIndexOf(3), a.lastIndexOf(3, -2), '
+                                   'a.lastIndexOf(true, 2)].join()'),
+                         '0,1,2,3,-1,5,0,-1')
+
+    def test_string_builder(self):
+        self.assertEqual(self.eval('function render(items) { '
+                                   'var html = "<ul>", n = 0, x = 5, h; '
+                                   'for (var i = 0; i < items.length; i++) { '
+                                   'html += "<li>" + items[i] + "</li>"; '
+                                   'if (i == 1) n = html.length } '
+                                   'function tail() { return html.length } '
+                                   'h = html; html += "</ul>"; '
+                                   'x += 2; x += "a"; '
+                                   'return [h, html, n, tail(), typeof html, '
+                                   'x].join("|") } var r = render(["a", 1])'),
+                         '<ul><li>a</li><li>1</li>|'
+                         '<ul><li>a</li><li>1</li></ul>|24|29|string|7a')
+
+    def test_replacement_quotes(self):
+        self.assertEqual(self.eval('var r = ["abc".replace(/(b)/, "\'$1\'"), '
+                                   '"abc".replace(/(b)/, "$1`")].join(";")'),
+                         "a'b'c;ab`c")
+
+    def test_regexp(self):
+        self.assertEqual(self.eval('var r = ["a1b22".replace(/(\\d)/g, "<$1>"), '
+                                   '"john smith".replace(/(\\w+)\\s(\\w+)/, '
+                                   '"$2, $1"), "abc".replace(/b/, "[$`$\'$$]"), '
+                                   '"a.b".replace(".", "$&$&"), '
+                                   '"x1y2".replace(/\\d/g, function(m, i) { '
+                                   'return m * 2 + i }), '
+                                   '"a1b2c".split(/(\\d)/).join(), '
+                                   '"abc".split("").length, '
+                                   '"a1b2".match(/\\d/g).join(""), '
+                                   '"a1b2".match(/([a-z])(\\d)/).index, '
+                                   '"abc".search(/c/), "a\\n".search(/a$/), '
+                                   'new RegExp("B", "i").test("abc")].join(";")'),
+                         'a<1>b<2><2>;smith, john;a[ac$]c;a..b;x3y7;'
+                         'a,1,b,2,c;3;12;0;2;-1;true')
+
+    def test_call_depth(self):
+        self.js = interpr.PyJS(engine=self.engine, maxDepth=30)
+        self.assertEqual(self.eval('function d(n) { return n ? 1 + d(n - 1) '
+                                   ': 0 } var r = [d(20)]; try { d(40) } '
+                                   'catch (e) { r.push("caught") } '
+                                   'r.push(d(25)); r = r.join()'), 
+                         '20,caught,25')
+        self.assertEqual(self.js.depth, [0])
+        self.assertEqual(len(self.js.callStack), 1)
+
+    def test_arguments(self):
+        self.assertEqual(self.eval('function a() { return arguments.length } '
+                                   'function b(x, y) { return [x, y] } '
+                                   'function c(x) { return (function() { '
+                                   'return arguments[0] })(x + 1) } '
+                                   'function d(arguments) { return arguments } '
+                                   'var r = [a(1, 2, 3), b(1), b(1, 2, 3), '
+                                   'c(1), d(5)].join(";")'),
+                         '3;1,;1,2;2;5')
+
+    def test_shapes(self):
+        self.assertEqual(self.eval('function P(x) { this.x = x } '
+                                   'P.prototype.get = function() { '
+                                   'return this.x }; '
+                                   'var a = new P(1), b = new P(2), '
+                                   'c = {x: 3, y: 4}, d = {x: 5, y: 6}; '
+                                   'delete d.x; c.x = 7; var big = {}; '
+                                   'for (var i = 0; i < 100; i++) '
+                                   'big["p" + i] = i; var k = []; '
+                                   'for (var p in c) k.push(p); '
+                                   'var r = [a.get() + b.get(), k, c.x, d.x, '
+                                   'd.y, "x" in d, big.p99].join()'), 
+                         '3,x,y,7,,6,false,99')
+        shape = interpr.shapeOf(self.js['a'])
+        self.assertTrue(shape is interpr.shapeOf(self.js['b']))
+        self.assertEqual(interpr.shapeOf(self.js['c']).names, ('x', 'y'))
+        # objects losing properties or with many are left to __dict__
+        self.assertEqual(interpr.shapeOf(self.js['d']), None)
+        self.assertEqual(interpr.shapeOf(self.js['big']), None)
+
+    def test_prototype(self):
+        self.assertEqual(self.eval('function P(x) { this.x = x } '
+                                   'P.prototype.get = function() { '
+                                   'return this.x * 2 }; '
+                                   'var r = new P(21).get()'), 42)
+
+
+class TreeEngineTests(EngineTestsMixin, unittest.TestCase):
+    engine = "tree"
+
+
+class ClosureEngineTests(EngineTestsMixin, unittest.TestCase):
+    engine = "closure"
+
+
+class VMEngineTests(EngineTestsMixin, unittest.TestCase):
+    engine = "vm"
+
+    def test_deep_recursion(self):
+        # calls are not nested in python, only maxDepth limits them
+        self.assertEqual(self.eval('function d(n) { return n ? 1 + d(n - 1) '
+                                   ': 0 } var r = d(5000)'), 5000)
+
+
+class OptimizedEngineTests(EngineTestsMixin, unittest.TestCase):
+    engine = "closure"
+    optimize = True
+
+
+class BytecodeTests(unittest.TestCase):
+    source = ('function f(o) { var s = ""; for (var k in o) { '
+              'try { if (k == "b") break; s += k } finally { s += "." } } '
+              'return s } var r = f({ a: 1 }) + typeof nothing')
+
+    def compile(self, source):
+        return bytecode.compile(resolver.resolve(jsparser.parse(source)))
+
+    def test_dumps_loads(self):
+        data = bytecode.dumps(self.compile(self.source))
+        js = interpr.PyJS()
+        js.run_(data)
+        self.assertEqual(js['r'], 'a.undefined')
+
+    def test_dis(self):
+        listing = bytecode.dis(self.compile(self.source))
+        self.assertTrue('FOR_ITER' in listing)
+        self.assertTrue('f(o), line 1' in listing)
+
+    def test_bad_data(self):
+        self.assertRaises(ValueError, bytecode.loads, 'not a bytecode')
+
+
+
+class SlotsTests(unittest.TestCase):
+    def test_compact_objects(self):
+        js = interpr.PyJS()
+        self.assertFalse(hasattr(interpr.JS_Context(parent=js), '__dict__'))
+        self.assertEqual(js.maxDepth, interpr.defaultMaxDepth)
+        n = jsparser.parse('x = 1; if (x) { y = x }')
+        number = n[0].expression[1]
+        self.assertEqual((number.value, number.integer), (1, False))
+        # nodes with attributes of their own have them in their __dict__
+        self.assertFalse(number.__dict__)
+        self.assertTrue(n[1].thenPart)
+        x = copy.copy(n[1])
+        self.assertEqual((x.type_, x.lineno, x.thenPart), 
+                         (n[1].type_, n[1].lineno, n[1].thenPart))
+        t = lexer.Tokenizer('a + 1')
+        t.get()
+        self.assertFalse(hasattr(t.token, '__dict__'))
+
+    def test_picklable_tree(self):
+        source = 'function f(o) { return o.x + 1 }\nvar y = f({x: 2});'
+        n = jsparser.parse(source, 'f.js')
+        interpr.PyJS().execute(n)
+        self.assertTrue(n[0].body[0].value[0].ic)
+        x = pickle.loads(pickle.dumps(n, 2))
+        self.assertTrue(x[1].file is x[0].body.file)
+        self.assertEqual((x[1].filename, x[1].lineno), ('f.js', 2))
+        self.assertEqual(x[1].getSource(), n[1].getSource())
+        self.assertFalse(hasattr(x[0].body[0].value[0], 'ic'))
+        js = interpr.PyJS()
+        js.execute(x)
+        self.assertEqual(js['y'], 3)
+
+
+class LexerTests(unittest.TestCase):
+    source = ('var a = 0x1F + 017 + 1.5e3 + .5 - "a\\"b" / \'c\'; // x\n'
+              'a >>>= b.c /* y */ !== /[/]\\//gi; if (a) { a++ }')
+
+    def tokens(self, cls, source, scanOperand=True):
+        t, tokens = cls(source), []
+        while t.get(scanOperand) != lexer.END:
+            tk = t.token
+            tokens.append((tk.type_, tk.value, tk.start, tk.end, tk.lineno,
+                           tk.type_ == lexer.ASSIGN and tk.assignOp))
+            scanOperand = tk.type_ not in (lexer.IDENTIFIER, lexer.NUMBER,
+                                           lexer.STRING, lexer.REGEXP, 
+                                           lexer.RIGHT_PAREN, 
+                                           lexer.RIGHT_BRACKET)
+        return tokens
+
+    def test_same_tokens(self):
+        tokens = self.tokens(lexer.Tokenizer, self.source)
+        self.assertEqual(tokens, self.tokens(lexer.CharTokenizer, 
+                                             self.source))
+        self.assertEqual(tokens[3][1], 31)
+        self.assertEqual(tokens[5][1], 15)
+        self.assertTrue('a"b' in [tk[1] for tk in tokens])
+
+    def test_errors(self):
+        for source in ['x = 1 /* no end', 'x = /abc', 'x = 1e', 'x = "a',
+                       'x = #']:
+            self.assertRaises(lexer.ParseError, jsparser.parse, source)
+        self.assertEqual(len(jsparser.parse('x = 1 // end')), 1)
+
+
+class ParseCacheTests(unittest.TestCase):
+    def test_lru(self):
+        cache = jsparser.ParseCache(2)
+        a = cache.parse('a = 1')
+        self.assertTrue(a.shared)
+        self.assertTrue(cache.parse('a = 1') is a)
+        self.assertFalse(cache.parse('a = 1', 'a.js') is a)
+        cache.parse('b = 1')
+        self.assertFalse(cache.parse('a = 1') is a)
+        self.assertEqual(cache.stats(), 
+                         dict(trees=2, hits=1, misses=4, evictions=2,
+                              compiled=0))
+        self.assertRaises(lexer.ParseError, cache.parse, 'a = ')
+        self.assertEqual(cache.stats()["trees"], 2)
+
+    def test_shared_by_threads(self):
+        source = ('function f(o) { return o.x + o.y } var s = 0; '
+                  'for (var i = 0; i < 200; i++) '
+                  '  s += f(i % 2 ? {x: 1, y: 2} : {y: 2, x: 1, z: 3})')
+        results = []
+        def run():
+            for i in range(5):
+                js = interpr.PyJS()
+                js.eval_(source)
+                results.append(js['s'])
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(results, [600] * 20)
+
+
+class CompiledTreeTests(unittest.TestCase):
+    source = ('function f(o) { for (var k in o) if (k == "b") break; '
+              'return k }\nvar r = [f({a: 1, b: 2}), /x+/g.test("xx"), 1.5, '
+              'true, 0x10].join();\ntry { null.x } catch (e) { r += "!" }')
+
+    def test_round_trip(self):
+        n = jsparser.parse(self.source, 'f.js')
+        data = jsparser.dumps(n)
+        x = jsparser.loads(data)
+        self.assertEqual(jsparser.dumps(x), data)
+        self.assertEqual((x[1].filename, x[1].getSource()), 
+                         ('f.js', n[1].getSource()))
+        self.assertTrue(x[0].body.funDecls is not n[0].body.funDecls)
+        js = interpr.PyJS()
+        js.execute(x)
+        self.assertEqual(js['r'], 'b,true,1.5,true,16!')
+        self.assertRaises(ValueError, jsparser.loads, 'not a tree')
+
+    def test_jsc_files(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'f.js')
+            with open(path, 'w') as f: f.write(self.source)
+            self.assertEqual(jsparser.compileFile(path), 
+                             os.path.join(tmp, 'f.jsc'))
+            digest = jsparser.digest(self.source)
+            self.assertTrue(jsparser.loadCompiled(path, digest))
+            self.assertEqual(jsparser.loadCompiled(path, 'x' * 20), None)
+            compiled = jsparser.cache.stats()["compiled"]
+            js = interpr.PyJS()
+            js.eval_(self.source, path)
+            self.assertEqual(js['r'], 'b,true,1.5,true,16!')
+            self.assertEqual(jsparser.cache.stats()["compiled"], compiled + 1)
+            # a script changed after compiling is parsed
+            os.utime(os.path.join(tmp, 'f.jsc'), (0, 0))
+            self.assertEqual(jsparser.loadCompiled(path, digest), None)
+        finally:
+            shutil.rmtree(tmp)
+
+
+class LazyParseTests(unittest.TestCase):
+    source = ('function f(a) { var s = ""; s += a; '
+              'function g() { return s.length + "}" } '
+              'var b = /[}]/.test(s), c = (a) / 2; return s + g() + b }\n'
+              'var r = f(4);')
+
+    def test_skipped_bodies(self):
+        n = jsparser.parse(self.source, lazy=True)
+        f = n[0]
+        self.assertTrue(isinstance(f, jsparser.LazyFunction))
+        self.assertFalse(f.parsed)
+        self.assertEqual(f.getSource(), 
+                         jsparser.parse(self.source)[0].getSource())
+        self.assertTrue(set(['s', 'a', 'g', 'length']) <= f.identifiers)
+        self.assertEqual(f.body.lineno, 1)
+        self.assertTrue(f.parsed)
+        self.assertFalse(f.body[2].parsed)
+        x = pickle.loads(pickle.dumps(jsparser.parse(self.source, lazy=True)))
+        self.assertEqual(len(x[0].body), 5)
+        self.assertRaises(lexer.ParseError, jsparser.parse,
+                          'function f() { if (x) { }', lazy=True)
+
+    def test_engines(self):
+        for engine in ('tree', 'closure', 'vm'):
+            js = interpr.PyJS(engine=engine)
+            js.eval_(self.source)
+            self.assertEqual(js['r'], '41}false')
+            # errors in bodies are found when they are called
+            js.eval_('function h() { var = 1 } var q = 1')
+            self.assertEqual(js['q'], 1)
+            self.assertRaises(lexer.ParseError, js.eval_, 'h()')
+
+    def test_called_again(self):
+        source = ('function outer() { function inner() { return 2 } '
+                  'return inner() } outer(); var r = outer()')
+        for engine in ('closure', 'closure', 'tree', 'vm'):
+            js = interpr.PyJS(engine=engine)
+            js.eval_(source)
+            self.assertEqual(js['r'], 2)
+
+
+class StreamTests(unittest.TestCase):
+    source = ('var a = [] // list\n/* x; */ a.push("x;y"\n+ 1);\n'
+              'function f(x) { return x / 2 }\n'
+              'a.push(/a}b/.test("a}b")); a.push(f(5)); var r = a.join()\n')
+
+    def test_statements(self):
+        chunks = [self.source[i:i + 3] for i in range(0, len(self.source), 3)]
+        scripts = list(jsparser.statements(iter(chunks)))
+        self.assertEqual([n[0].lineno for n in scripts], [1, 2, 4, 5, 5, 5])
+        # every statement keeps the source of its own
+        self.assertEqual(scripts[2].file.text, 
+                         'function f(x) { return x / 2 }\n')
+        self.assertEqual(len(list(jsparser.statements(self.source))), 6)
+        self.assertRaises(lexer.ParseError, list, 
+                          jsparser.statements(['var a = 1;\n', 'a = ']))
+        # new lines in brackets end no statement
+        chunks = ['var a = [0'] + [',\n%i' % i for i in range(1, 50)] + \
+                 ['];\nvar b = a']
+        self.assertEqual([len(n[0][0].initializer) for n in 
+                          jsparser.statements(chunks)][0], 50)
+
+    def test_cut_tokens(self):
+        for source, cut, r in [('var r; if ([] instanceof Array) r = 1\n'
+                                'else r = 2\n', 'els', 1),
+                               ('var a = [], r = 3; r = a\n'
+                                'instanceof Array\n', 'inst', True)]:
+            # the first chunk ends in the middle of the keyword
+            padding = jsparser.chunkSize - source.index(cut) - len(cut)
+            source = '//' + 'x' * (padding - 3) + '\n' + source
+            self.assertEqual(source.index(cut) + len(cut), jsparser.chunkSize)
+            js = interpr.PyJS()
+            js.stream_(StringIO.StringIO(source))
+            self.assertEqual(js['r'], r)
+
+    def test_engines(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'f.js')
+            with open(path, 'w') as f: f.write(self.source)
+            for engine in ('tree', 'closure', 'vm'):
+                js = interpr.PyJS(engine=engine)
+                with open(path) as f: js.stream_(f)
+                self.assertEqual(js['r'], 'x;y1,true,2.5')
+        finally:
+            shutil.rmtree(tmp)
+
+
+class ResolverTests(unittest.TestCase):
+    def test_arguments_slot(self):
+        n = resolver.resolve(jsparser.parse(
+                'function f(a, b) { var c; return function() { '
+                'return arguments } } '
+                'function g(a) { return eval("a") }'))
+        self.assertEqual(n[0].scopeNames, ['a', 'b', 'c'])
+        self.assertEqual(n[0].body[1].value.scopeNames, ['arguments'])
+        self.assertEqual(n[1].scopeNames, ['a', 'arguments'])
+
+
+class OptimizerTests(unittest.TestCase):
+    def optimize(self, source, passes=None):
+        return optimizer.optimize(jsparser.parse(source), passes)
+
+    def test_fold(self):
+        n = self.optimize('var x = 1 + 2 * -3, y = "a" + 1 + !0, z = 1 / 0',
+                          ["fold"])
+        values = [(x.initializer.type, x.initializer.value) for x in n[0]]
+        self.assertEqual(values[:2], [('NUMBER', -5), ('STRING', 'a1true')])
+        # Infinity has no literal
+        self.assertEqual(values[2][0], 'DIV')
+
+    def test_dce(self):
+        n = self.optimize('if (1 > 2) x(); else { y() } '
+                          'while (false) x(); if (0) { var v } '
+                          'function f() { return 1; x(); function g() {} }',
+                          ["fold", "dce"])
+        self.assertEqual([x.type for x in n], 
+                         ['BLOCK', 'BLOCK', 'IF', 'FUNCTION'])
+        self.assertEqual([x.type for x in n[3].body], ['RETURN', 'FUNCTION'])
+
+    def test_inline(self):
+        source = ('function sq(a) { return a * a } '
+                  'function f(a) { return sq(a) + sq(2) + sq(g()) } '
+                  'function g() { var t = 3; return t } ')
+        n = self.optimize(source, ["inline"])
+        calls = [x[0].value for x in optimizer.walk(n) if x.type == 'CALL']
+        self.assertEqual(calls, ['sq', 'g'])
+        # reassigned functions are not inlined
+        n = self.optimize(source + 'sq = g', ["inline"])
+        calls = [x[0].value for x in optimizer.walk(n) if x.type == 'CALL']
+        self.assertEqual(calls, ['sq', 'sq', 'sq', 'g'])
+        js = interpr.PyJS(optimize=True)
+        js.eval_(source + 'var r = f(4)')
+        self.assertEqual(js['r'], 29)
+
+    def test_switch(self):
+        source = ('function f(x) { switch (x) { case -1: return "m"; '
+                  'case "a": case 1 + 1: return "b"; case 2: return "c"; '
+                  'default: return "d" } } '
+                  'var r = [f(2), f("a"), f(-1), f([2]), f(3)].join("")')
+        n = self.optimize(source, ["fold", "switch"])
+        self.assertEqual(n[0].body[0].jumpTable, {-1: 0, "a": 1, 2: 2})
+        for engine in ("tree", "closure", "vm"):
+            js = interpr.PyJS(engine=engine, optimize=["fold", "switch"])
+            js.eval_(source)
+            self.assertEqual(js['r'], 'bbmdd')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, interpr.PyJS, optimize=["nothing"])
+
+
+class RegExpTests(unittest.TestCase):
+    def test_translate(self):
+        for source, pattern in [('a$', 'a\\Z'), ('[$^]', '[$^]'), 
+                                ('[^]', '[\\s\\S]'), ('[]', '(?!)'),
+                                ('\\u0041\\cJ', '\\x41\\x0a'), 
+                                ('\\$', '\\$')]:
+            self.assertEqual(interpr.translateRegExp(source), pattern)
+        self.assertEqual(interpr.translateRegExp('a$', True), 'a$')
+
+    def test_cache(self):
+        self.assertTrue(interpr.compileRegExp('a+', 'i') is 
+                        interpr.compileRegExp('a+', 'i'))
+        self.assertRaises(interpr.SyntaxError_, interpr.compileRegExp, '(')
+
+
+class ConversionTests(unittest.TestCase):
+    def test_string_to_number(self):
+        nan = interpr.nan
+        for s, x in [('', 0), (' \t\n', 0), ('42', 42), (' 42 ', 42),
+                     ('-7', -7), ('+7', 7), ('1.', 1.0), ('.5', 0.5),
+                     ('-1.5e3', -1500.0), ('2E-2', 0.02), ('0x1f', 31),
+                     ('0X1F', 31), ('Infinity', interpr.inf), 
+                     ('-Infinity', -interpr.inf), 
+                     ('\xc2\xa012\xe2\x80\xa8', 12)]:
+            self.assertEqual(interpr.toNumber(s), x)
+        for s in ('-0x10', '1e', '.', '12a', '1 2', 'infinity', 'NaN',
+                  '\xd9\xa1\xd9\xa2'):
+            self.assertTrue(interpr.isNaN(interpr.toNumber(s)), s)
+        for s, x in [(u'42', 42), (u' -1.5 ', -1.5), (u'\xa00x1f\u3000', 31)]:
+            self.assertEqual(interpr.stringToNumber(s), x)
+        for s in (u'\u0661\u0662', u'4\uff12'):
+            self.assertTrue(interpr.isNaN(interpr.stringToNumber(s)), s)
+
+    def test_cache(self):
+        for i in range(interpr.numberCacheSize + 10):
+            self.assertEqual(interpr.toNumber(str(i)), i)
+        self.assertTrue(len(interpr.numberCache) <= interpr.numberCacheSize)
+        self.assertEqual(interpr.toNumber('7' * 40), float('7' * 40))
+        self.assertFalse('7' * 40 in interpr.numberCache)
+
+
+if __name__ == '__main__':
+    unittest.main()